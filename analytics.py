@@ -0,0 +1,111 @@
+"""Calibration analytics of a user's resolved predictions.
+
+All the metrics of all categories are computed in one vectorised pass over
+NumPy arrays: per-category sums are taken with ``np.bincount`` over the
+rows' category codes.
+"""
+from __future__ import annotations
+
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+LEVELS: tuple[float, ...] = (0.5, 0.9)
+# Hit rates closer to the nominal ones than this many standard errors are
+# considered calibrated
+TOLERANCE: float = 2.0
+
+
+class Calibration(NamedTuple):
+    """Calibration metrics of a set of predictions.
+
+    Rates, widths and scores are pairs for the 50% and the 90% intervals.
+    ``direction`` is "over" when outcomes fall outside the intervals more
+    often than they should (intervals too narrow), "under" when less often
+    and "ok" when the difference is within the sampling error.
+    """
+
+    category: Optional[str]
+    count: int
+    hit_rate: tuple[float, float]
+    width: tuple[float, float]
+    winkler: tuple[float, float]
+    direction: str
+
+
+def _winkler(low, high, outcome, alpha: float):
+    """Interval score of central (1 - alpha) intervals, lower is better."""
+    return (
+        (high - low)
+        + (2 / alpha) * np.clip(low - outcome, 0, None)
+        + (2 / alpha) * np.clip(outcome - high, 0, None)
+    )
+
+
+def breakdown(rows: list) -> tuple[Optional[Calibration], list[Calibration]]:
+    """Compute calibration overall and for every category.
+
+    Args:
+        rows (list): (category, low_50, hi_50, low_90, hi_90, outcome) of
+        resolved predictions, see Storage.resolved
+
+    Returns:
+        tuple: overall Calibration, or None without rows, and per-category
+        ones ordered by the number of predictions, largest first
+    """
+    if not rows:
+        return None, []
+    categories, codes = np.unique(
+        np.array([r[0] for r in rows], dtype=object).astype(str),
+        return_inverse=True,
+    )
+    values = np.array([r[1:6] for r in rows], dtype=float)
+    low_50, hi_50, low_90, hi_90, outcome = values.T
+    size = len(categories)
+
+    # Per-row metrics, one column per level
+    hits = np.stack([
+        (low_50 <= outcome) & (outcome <= hi_50),
+        (low_90 <= outcome) & (outcome <= hi_90),
+    ], axis=1).astype(float)
+    widths = np.stack([hi_50 - low_50, hi_90 - low_90], axis=1)
+    scores = np.stack([
+        _winkler(low_50, hi_50, outcome, 1 - LEVELS[0]),
+        _winkler(low_90, hi_90, outcome, 1 - LEVELS[1]),
+    ], axis=1)
+
+    def sums(column: np.ndarray) -> np.ndarray:
+        # Per-category sums followed by the overall one
+        per_category = np.bincount(codes, weights=column, minlength=size)
+        return np.append(per_category, column.sum())
+
+    counts = sums(np.ones(len(rows)))
+    metrics = [
+        np.stack([sums(m[:, i]) for i in range(2)], axis=1) / counts[:, None]
+        for m in (hits, widths, scores)
+    ]
+    hit_rate, width, winkler = metrics
+
+    # Combined deviation of both hit rates from nominal in standard errors
+    nominal = np.array(LEVELS)
+    z = (
+        ((hit_rate - nominal) * counts[:, None]).sum(axis=1)
+        / np.sqrt(counts * (nominal * (1 - nominal)).sum())
+    )
+    direction = np.where(
+        z < -TOLERANCE, "over", np.where(z > TOLERANCE, "under", "ok"))
+
+    results = [
+        Calibration(
+            category=str(categories[i]) if i < size else None,
+            count=int(counts[i]),
+            hit_rate=tuple(hit_rate[i].tolist()),
+            width=tuple(width[i].tolist()),
+            winkler=tuple(winkler[i].tolist()),
+            direction=str(direction[i]),
+        )
+        for i in range(size + 1)
+    ]
+    overall = results.pop()
+    results.sort(key=lambda c: (-c.count, c.category))
+    return overall, results
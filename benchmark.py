@@ -0,0 +1,357 @@
+"""Load test of the bot's handlers with simulated users.
+
+The real handlers run against a seeded SQLite database in a temporary
+directory. Telegram is replaced by fake events and a stub client which
+records what the bot sends, so nothing leaves the machine. Thousands of
+users follow scripts of real conversations concurrently (the add wizard,
+listing with pagination, calibration checks, entering outcomes) and the
+latency of every handler call is recorded.
+
+Usage: python benchmark.py [--users N] [--rounds N] [--output FILE]
+                           [--compare BASELINE] [--tolerance FRACTION]
+
+The report is JSON with p50/p95/p99 latencies in milliseconds and the
+throughput of every handler; with --compare the run fails if any
+handler's p95 grew by more than the tolerance against an earlier report.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from types import SimpleNamespace
+from typing import Optional
+
+import numpy as np
+
+import ru_calibration_bot
+from helpers import SELECT_QUERY_HEADER
+
+CATEGORIES: tuple[str, ...] = (
+    "работа", "здоровье", "политика", "спорт", "погода", "финансы")
+# Scripts users follow and how often they pick each of them
+SCRIPT_WEIGHTS: dict[str, float] = {
+    "add_wizard": 0.3,
+    "list_and_paginate": 0.3,
+    "check_calibration": 0.2,
+    "enter_outcome": 0.2,
+}
+# Pages a user reads through before leaving a listing
+PAGES_READ: int = 3
+# Seconds to wait for the bot's reply
+REPLY_TIMEOUT: float = 30.0
+
+
+class StubClient:
+    """Stands in for TelegramClient and records what the bot sends."""
+
+    def __init__(self):
+        self.handlers: list = []
+        self.replies: dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.sent: int = 0
+
+    async def start(self, *args, **kwargs) -> StubClient:
+        return self
+
+    def add_event_handler(self, callback, builder):
+        self.handlers.append((builder, callback))
+
+    def build_reply_markup(self, buttons):
+        return buttons
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def send_message(self, entity, message="", **kwargs):
+        self.sent += 1
+        self.replies[entity].put_nowait((message, kwargs.get("buttons")))
+        return SimpleNamespace(id=self.sent)
+
+    async def send_file(self, entity, file, **kwargs):
+        return await self.send_message(entity, kwargs.get("caption", ""))
+
+    async def upload_file(self, file, **kwargs):
+        return file
+
+    async def disconnect(self):
+        pass
+
+
+class FakeMessage(SimpleNamespace):
+    """NewMessage event of a user's text."""
+
+    def __init__(self, client: StubClient, user_id: int, text: str):
+        super().__init__(
+            client=client,
+            sender_id=user_id,
+            chat_id=user_id,
+            message=SimpleNamespace(raw_text=text, document=None),
+            pattern_match=None,
+        )
+
+    async def get_sender(self):
+        return SimpleNamespace(id=self.sender_id)
+
+
+class FakeCallback(SimpleNamespace):
+    """CallbackQuery event of a pressed inline button."""
+
+    def __init__(self, client: StubClient, user_id: int, data: bytes):
+        super().__init__(
+            client=client,
+            sender_id=user_id,
+            chat_id=user_id,
+            query=SimpleNamespace(data=data, chat_instance=0),
+            data=data,
+            data_match=None,
+            pattern_match=None,
+        )
+
+    async def get_sender(self):
+        return SimpleNamespace(id=self.sender_id)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+def create_bot(workdir: str) -> ru_calibration_bot.App:
+    """Build the bot wired to the stub client and a local database."""
+    config = ru_calibration_bot.Config(
+        telegram_token="benchmark",
+        api_id=1,
+        api_hash="benchmark",
+        storage="sqlite",
+        sqlite_path=os.path.join(workdir, "predictions.db"),
+        sessions_path="",
+        chart_cache_dir=os.path.join(workdir, "charts"),
+        metrics_port=0,
+        # Measure the handlers, not the limits in front of them
+        rate_limit_cheap="1000000000/1",
+        rate_limit_expensive="1000000000/1",
+        rate_limit_write="1000000000/1",
+        outbox_chat_interval=0.001,
+        outbox_rate=1e9,
+        # Dates are far ahead, nothing would be reminded of
+        reminders=False,
+    )
+    return ru_calibration_bot.create_app(config, StubClient())
+
+
+class Benchmark:
+    """Simulated users of a bot and the latencies of its handlers.
+
+    Args:
+        app (App): the bot wired to a StubClient
+        seed (int): seed of users' choices
+    """
+
+    def __init__(self, app: ru_calibration_bot.App, seed: int = 0):
+        self.app = app
+        self.client: StubClient = app.client
+        self.random = random.Random(seed)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+
+    async def seed(self, users: int, predictions: int):
+        """Give every user predictions, half of them with outcomes."""
+        start = date.today() - timedelta(days=730)
+        for user_id in self.user_ids(users):
+            rows = []
+            for i in range(predictions):
+                low = self.random.uniform(0, 100)
+                outcome = (
+                    low + self.random.gauss(10, 10) if i % 2 else None)
+                rows.append((
+                    start + timedelta(days=i % 730),
+                    f"Предсказание номер {i}",
+                    self.random.choice(CATEGORIES),
+                    "штука",
+                    low + 5, low + 15, low, low + 20,
+                    outcome,
+                ))
+            await self.app.storage.add_many(user_id, rows)
+
+    @staticmethod
+    def user_ids(users: int) -> range:
+        return range(1000, 1000 + users)
+
+    async def _run(self, handler, event):
+        start = time.perf_counter()
+        await handler(event)
+        self.latencies[handler.__name__].append(time.perf_counter() - start)
+
+    async def message(self, user_id: int, text: str):
+        """Send the bot a text message."""
+        event = FakeMessage(self.client, user_id, text)
+        handler = self.app.router.resolve(event)
+        if handler is not None:
+            await self._run(handler, event)
+
+    async def press(self, user_id: int, data: bytes):
+        """Press an inline button."""
+        event = FakeCallback(self.client, user_id, data)
+        for builder, callback in self.app.router.callbacks:
+            if builder.filter(event):
+                await self._run(callback, event)
+                return
+
+    async def next_page(self, user_id: int) -> Optional[bytes]:
+        """Wait for a listing, return the data of its next page button."""
+        replies = self.client.replies[user_id]
+        while True:
+            text, buttons = await asyncio.wait_for(
+                replies.get(), REPLY_TIMEOUT)
+            if SELECT_QUERY_HEADER in text:
+                break
+        for button in buttons or ():
+            if button.text == "Следующий":
+                return button.data
+        return None
+
+    async def add_wizard(self, user_id: int):
+        await self.message(user_id, "Добавить предсказание")
+        low = self.random.randint(0, 100)
+        for text in (
+            "Сколько займет задача",
+            self.random.choice(CATEGORIES),
+            "день",
+            str(low + 2), str(low + 5), str(low), str(low + 8),
+            self.random.choice(("-", "31.12.2099")),
+        ):
+            await self.message(user_id, text)
+        await self.press(user_id, "Добавить сохранить".encode())
+
+    async def list_and_paginate(self, user_id: int):
+        # Replies of earlier scripts aren't read
+        replies = self.client.replies[user_id]
+        while not replies.empty():
+            replies.get_nowait()
+        await self.message(user_id, "Показать предсказания")
+        await self.press(user_id, b"list_whole")
+        for _ in range(PAGES_READ):
+            data = await self.next_page(user_id)
+            if data is None:
+                break
+            await self.press(user_id, data)
+
+    async def check_calibration(self, user_id: int):
+        await self.message(user_id, "Проверить калибровку")
+        if self.random.random() < 0.5:
+            await self.message(user_id, "общая")
+        else:
+            await self.message(user_id, self.random.choice(CATEGORIES))
+
+    async def enter_outcome(self, user_id: int):
+        rows, _, _ = await self.app.storage.page(user_id, "empty", 1, "next")
+        if not rows:
+            return
+        await self.message(user_id, "Результат предсказания")
+        await self.message(
+            user_id, f"{rows[0][0]}; {self.random.uniform(0, 100):.2f}")
+
+    async def user(self, user_id: int, rounds: int):
+        """Play a user's scripts one after another."""
+        names = list(SCRIPT_WEIGHTS)
+        weights = list(SCRIPT_WEIGHTS.values())
+        for name in self.random.choices(names, weights, k=rounds):
+            await getattr(self, name)(user_id)
+
+    def report(self, duration: float) -> dict:
+        """Summarize the recorded latencies."""
+        handlers = {}
+        for name, values in sorted(self.latencies.items()):
+            p50, p95, p99 = np.percentile(values, (50, 95, 99)) * 1000
+            handlers[name] = {
+                "count": len(values),
+                "p50_ms": round(float(p50), 3),
+                "p95_ms": round(float(p95), 3),
+                "p99_ms": round(float(p99), 3),
+                "mean_ms": round(float(np.mean(values)) * 1000, 3),
+                "throughput": round(len(values) / duration, 1),
+            }
+        updates = sum(h["count"] for h in handlers.values())
+        return {
+            "duration_s": round(duration, 3),
+            "updates": updates,
+            "throughput": round(updates / duration, 1),
+            "messages_sent": self.client.sent,
+            "handlers": handlers,
+        }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return the handlers whose p95 latency regressed against a baseline."""
+    regressions = []
+    for name, stats in report["handlers"].items():
+        before = baseline.get("handlers", {}).get(name)
+        if before and stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {before['p95_ms']} ms -> {stats['p95_ms']} ms")
+    return regressions
+
+
+async def run(args, workdir: str) -> dict:
+    app = create_bot(workdir)
+    startup = await app.start()
+    benchmark = Benchmark(app, args.seed)
+    await benchmark.seed(args.users, args.predictions)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        benchmark.user(user_id, args.rounds)
+        for user_id in benchmark.user_ids(args.users)
+    ))
+    duration = time.perf_counter() - start
+
+    await app.stop()
+    report = benchmark.report(duration)
+    report["startup_s"] = {
+        name: round(seconds, 3) for name, seconds in startup.items()}
+    report["config"] = {
+        "users": args.users,
+        "rounds": args.rounds,
+        "predictions": args.predictions,
+        "seed": args.seed,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="scripts every user plays")
+    parser.add_argument("--predictions", type=int, default=100,
+                        help="predictions seeded per user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the report to")
+    parser.add_argument("--compare", help="earlier report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative growth of p95 latency")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report = asyncio.run(run(args, workdir))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
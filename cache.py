@@ -0,0 +1,83 @@
+"""In-process caches of per-user data."""
+from __future__ import annotations
+
+from typing import Iterable, Optional
+from uuid import uuid4
+
+from cachetools import LRUCache, TTLCache
+
+
+class CategoryCache:
+    """Bounded cache of users' category sets.
+
+    Entries expire ``ttl`` seconds after being stored and the least
+    recently used ones are evicted once ``maxsize`` users are cached.
+    Writers keep it correct: an insert adds its category to a cached set,
+    a deletion drops the user's entry.
+
+    Args:
+        maxsize (int): maximum number of cached users
+        ttl (float): seconds an entry stays valid
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of lookups answered from the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, user_id: int) -> Optional[frozenset[str]]:
+        """Return a user's cached categories or None."""
+        categories = self._cache.get(user_id)
+        if categories is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return categories
+
+    def put(self, user_id: int, categories: Iterable[str]):
+        """Store a user's categories."""
+        self._cache[user_id] = frozenset(categories)
+
+    def add(self, user_id: int, category: str):
+        """Add a category to a user's cached set if there is one."""
+        categories = self._cache.get(user_id)
+        if categories is not None and category not in categories:
+            self._cache[user_id] = categories | {category}
+
+    def invalidate(self, user_id: int):
+        """Forget a user's categories."""
+        self._cache.pop(user_id, None)
+
+
+class DataVersions:
+    """Tokens naming the current version of users' predictions.
+
+    A user's token stays the same until any of their predictions changes,
+    so it can key anything computed from the predictions. Changes drop the
+    token and a new random one is made on the next request; a token
+    evicted to keep the size bounded is replaced the same way, which can
+    only cause a needless recomputation.
+
+    Args:
+        maxsize (int): maximum number of remembered users
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self._tokens = LRUCache(maxsize=maxsize)
+
+    def get(self, user_id: int) -> str:
+        """Return the token of a user's current data."""
+        token = self._tokens.get(user_id)
+        if token is None:
+            token = self._tokens[user_id] = uuid4().hex
+        return token
+
+    def bump(self, user_id: int):
+        """Mark a user's data as changed."""
+        self._tokens.pop(user_id, None)
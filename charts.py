@@ -0,0 +1,194 @@
+"""Calibration charts rendered to images with imgkit.
+
+A chart is an HTML page with CSS bars turned into a PNG by wkhtmltoimage.
+Rendering runs in a process pool so it neither blocks the event loop nor
+competes with it for the GIL. Images are cached on disk under a digest
+of the numbers they show, so a chart is rendered once per change of the
+user's resolved predictions, and cached images stay valid across restarts
+and are shared by the worker processes.
+"""
+from __future__ import annotations
+
+import asyncio
+import glob
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from typing import Optional
+
+import imgkit
+
+from storage import Storage
+
+# Latest months shown on the chart over time
+MONTHS_SHOWN: int = 24
+IMAGE_OPTIONS: dict = {
+    "format": "png",
+    "width": 800,
+    "encoding": "UTF-8",
+    "quiet": "",
+}
+STYLE: str = """
+body { font-family: sans-serif; margin: 24px; color: #222; width: 752px; }
+h2 { font-size: 20px; margin: 24px 0 8px; }
+.legend span { display: inline-block; margin-right: 16px; }
+.swatch { width: 12px; height: 12px; display: inline-block; }
+.row { margin: 6px 0; }
+.label { font-size: 14px; margin-bottom: 2px; }
+.track { position: relative; height: 14px; background: #eee; margin: 2px 0; }
+.bar { position: absolute; top: 0; bottom: 0; left: 0; }
+.target { position: absolute; top: -2px; bottom: -2px; width: 2px;
+          background: #222; }
+.c50 { background: #4c8bf5; }
+.c90 { background: #f5a04c; }
+.months { display: flex; align-items: flex-end; height: 180px;
+          border-bottom: 1px solid #999; position: relative; }
+.month { flex: 1; display: flex; align-items: flex-end; margin: 0 1px;
+         height: 100%; }
+.month div { flex: 1; }
+.line { position: absolute; left: 0; right: 0; height: 0;
+        border-top: 1px dashed #222; }
+.ticks { display: flex; font-size: 10px; }
+.ticks span { flex: 1; text-align: center; }
+"""
+
+
+def _bar(rate: float, target: int, css: str) -> str:
+    return (
+        '<div class="track">'
+        f'<div class="bar {css}" style="width: {rate * 100:.1f}%"></div>'
+        f'<div class="target" style="left: {target}%"></div>'
+        "</div>"
+    )
+
+
+def chart_html(by_category: list, by_month: list) -> str:
+    """Build the chart page.
+
+    Args:
+        by_category (list): rows of Storage.calibration_breakdown
+        by_month (list): rows of Storage.calibration_breakdown
+
+    Returns:
+        str: HTML page
+    """
+    parts = [
+        f"<html><head><meta charset='utf-8'><style>{STYLE}</style></head>"
+        "<body><div class='legend'>"
+        "<span><i class='swatch c50'></i> попадания в 50% интервал</span>"
+        "<span><i class='swatch c90'></i> попадания в 90% интервал</span>"
+        "<span>| - идеальная калибровка</span></div>"
+        "<h2>По категориям</h2>"
+    ]
+    for category, resolved, hits_50, hits_90 in by_category:
+        parts.append(
+            f"<div class='row'><div class='label'>{escape(category)}:"
+            f" {hits_50 / resolved:.0%} и {hits_90 / resolved:.0%}"
+            f" из {resolved}</div>"
+            f"{_bar(hits_50 / resolved, 50, 'c50')}"
+            f"{_bar(hits_90 / resolved, 90, 'c90')}</div>"
+        )
+    months = by_month[-MONTHS_SHOWN:]
+    if months:
+        parts.append(
+            "<h2>По месяцам</h2><div class='months'>"
+            "<div class='line' style='bottom: 50%'></div>"
+            "<div class='line' style='bottom: 90%'></div>"
+        )
+        for _, _, resolved, hits_50, hits_90 in months:
+            parts.append(
+                "<div class='month'>"
+                f"<div class='c50' style='height: {hits_50 / resolved:.1%}'>"
+                "</div>"
+                f"<div class='c90' style='height: {hits_90 / resolved:.1%}'>"
+                "</div></div>"
+            )
+        parts.append("</div><div class='ticks'>")
+        parts.extend(
+            f"<span>{month:02d}.{year % 100:02d}</span>"
+            for year, month, *_ in months
+        )
+        parts.append("</div>")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def render_png(html: str) -> bytes:
+    """Render a page to PNG, runs in a worker process."""
+    return imgkit.from_string(html, False, options=IMAGE_OPTIONS)
+
+
+class ChartRenderer:
+    """Calibration charts of users, rendered in worker processes.
+
+    Args:
+        cache_dir (str): directory for rendered images
+        max_workers (int): number of rendering processes
+    """
+
+    def __init__(self, cache_dir: str, max_workers: int = 2):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._pending: dict[str, asyncio.Future] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def close(self):
+        """Stop the rendering processes."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def chart(self, storage: Storage, user_id: int) -> Optional[str]:
+        """Return the path of a user's current chart.
+
+        The aggregates are read on every request, a chart is only
+        rendered if no image of them is cached. Concurrent requests of the
+        same chart share one rendering.
+
+        Args:
+            storage (Storage): opened storage
+            user_id (int): whose chart to draw
+
+        Returns:
+            str: PNG file or None if the user has no resolved predictions
+        """
+        by_category, by_month = await storage.calibration_breakdown(user_id)
+        if not by_category:
+            return None
+        digest = hashlib.sha1(
+            repr((by_category, by_month)).encode()).hexdigest()[:16]
+        path = os.path.join(self.cache_dir, f"{user_id}_{digest}.png")
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+        task = self._pending.get(path)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(
+                self._render(user_id, path, by_category, by_month))
+            self._pending[path] = task
+            task.add_done_callback(lambda _: self._pending.pop(path, None))
+        return await asyncio.shield(task)
+
+    async def _render(
+        self, user_id: int, path: str, by_category: list, by_month: list
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(
+            self._executor, render_png, chart_html(by_category, by_month))
+        await loop.run_in_executor(None, self._store, user_id, path, png)
+        return path
+
+    def _store(self, user_id: int, path: str, png: bytes):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+        # Images of the user's previous data won't be requested again
+        for old in glob.glob(os.path.join(self.cache_dir, f"{user_id}_*.png")):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
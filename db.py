@@ -0,0 +1,373 @@
+"""Asynchronous access to the bot's database."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Optional, Sequence
+
+from metrics import QUERY_SECONDS, statement_name
+
+logger = logging.getLogger(__name__)
+
+# Prepared statements kept open per connection
+STATEMENT_CACHE_SIZE: int = 64
+
+
+class PoolTimeoutError(Exception):
+    """No connection became available within the acquire timeout."""
+
+
+class Connection:
+    """A pooled DB-API connection with coroutine methods.
+
+    Every call is executed in the pool's thread executor so the event loop
+    never waits on the database driver. With ``prepare`` set, statements
+    having parameters are prepared on the server once per connection and
+    their cursors are reused for later executions of the same text.
+    """
+
+    def __init__(self, raw, executor: ThreadPoolExecutor, prepare=False):
+        self.raw = raw
+        self._executor = executor
+        self.prepare = prepare
+        self._statements: dict = {}
+        self.last_used: float = time.monotonic()
+        self.rowcount: int = -1
+        self.lastrowid: Optional[int] = None
+        # The last call submitted to the executor, it keeps running in its
+        # thread when the coroutine awaiting it is cancelled
+        self._call: Optional[Future] = None
+
+    async def _run(self, func: Callable, *args):
+        self._call = self._executor.submit(func, *args)
+        return await asyncio.wrap_future(self._call)
+
+    async def settle(self):
+        """Wait for the call in flight, e.g. of a cancelled query, to end."""
+        call = self._call
+        if call is not None and not call.done():
+            await asyncio.wait([asyncio.wrap_future(call)])
+
+    def close_when_settled(self):
+        """Close the connection once the call in flight, if any, ends."""
+        def close(_=None):
+            try:
+                self.raw.close()
+            except Exception as e:
+                logger.debug(f"Error while closing a connection: {e}")
+        if self._call is None:
+            try:
+                self._executor.submit(close)
+            except RuntimeError:
+                # The pool's executor is shut down already
+                close()
+        else:
+            # Runs in the call's thread, or right away if it's over
+            self._call.add_done_callback(close)
+
+    def _prepared(self, query: str):
+        cursor = self._statements.pop(query, None)
+        if cursor is None:
+            if len(self._statements) >= STATEMENT_CACHE_SIZE:
+                oldest = next(iter(self._statements))
+                self._statements.pop(oldest).close()
+            cursor = self.raw.cursor(prepared=True)
+        # Keep the most recently used statements at the end
+        self._statements[query] = cursor
+        return cursor
+
+    def forget_statements(self):
+        """Drop prepared statements, e.g. after the session was renewed."""
+        for cursor in self._statements.values():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        self._statements.clear()
+
+    def _execute(self, query: str, params, many: bool, fetch: bool):
+        if self.prepare and params is not None:
+            cursor = self._prepared(query)
+            try:
+                if many:
+                    cursor.executemany(query, params)
+                else:
+                    cursor.execute(query, params)
+                rows = cursor.fetchall() if fetch else None
+            except Exception:
+                self._statements.pop(query, None)
+                cursor.close()
+                raise
+            return rows, cursor.rowcount, cursor.lastrowid
+        cursor = self.raw.cursor()
+        try:
+            if many:
+                cursor.executemany(query, params)
+            elif params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(query, params)
+            rows = cursor.fetchall() if fetch else None
+            return rows, cursor.rowcount, cursor.lastrowid
+        finally:
+            cursor.close()
+
+    async def fetchall(self, query: str, params: Sequence = None) -> list:
+        """Run a query and return all the rows it produced."""
+        with QUERY_SECONDS.time(statement_name(query)):
+            rows, self.rowcount, _ = await self._run(
+                self._execute, query, params, False, True)
+        return rows
+
+    async def fetchone(self, query: str, params: Sequence = None):
+        """Run a query and return its first row or None."""
+        rows = await self.fetchall(query, params)
+        return rows[0] if rows else None
+
+    async def execute(self, query: str, params: Sequence = None) -> int:
+        """Run a statement without fetching, return affected rows count."""
+        with QUERY_SECONDS.time(statement_name(query)):
+            _, self.rowcount, self.lastrowid = await self._run(
+                self._execute, query, params, False, False)
+        return self.rowcount
+
+    async def executemany(self, query: str, seq_params: Sequence) -> int:
+        """Run a statement for every parameters set in seq_params."""
+        with QUERY_SECONDS.time(statement_name(query)):
+            _, self.rowcount, self.lastrowid = await self._run(
+                self._execute, query, seq_params, True, False)
+        return self.rowcount
+
+    async def commit(self):
+        """Commit the current transaction."""
+        await self._run(self.raw.commit)
+
+    async def rollback(self):
+        """Roll back the current transaction."""
+        await self._run(self.raw.rollback)
+
+
+class Pool:
+    """Bounded pool of database connections.
+
+    Connections are opened lazily up to ``maxsize``, ``minsize`` of them
+    are opened eagerly by :meth:`open`. A connection which was idle for
+    longer than ``health_check_interval`` seconds is pinged before it is
+    handed out and is replaced if the ping fails.
+
+    ``connect`` must return connections in autocommit mode: plain reads
+    then never keep a stale snapshot open, and :meth:`transaction` starts
+    an explicit transaction for writes.
+
+    Args:
+        connect (Callable): zero-argument function returning a new DB-API
+        connection
+        minsize (int): number of connections opened on start
+        maxsize (int): maximum number of simultaneously opened connections
+        acquire_timeout (float): seconds to wait for a free connection
+        health_check_interval (float): idle seconds after which a
+        connection is checked before use
+        prepare (bool): use server-side prepared statements for queries
+        with parameters
+        begin (str): statement starting a transaction
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        minsize: int = 1,
+        maxsize: int = 10,
+        acquire_timeout: float = 10.0,
+        health_check_interval: float = 30.0,
+        prepare: bool = False,
+        begin: str = "BEGIN",
+    ):
+        if minsize < 0 or maxsize < 1 or minsize > maxsize:
+            raise ValueError(
+                f"Invalid pool size: minsize={minsize}, maxsize={maxsize}")
+        self._connect = connect
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.prepare = prepare
+        self.begin = begin
+        self._executor = ThreadPoolExecutor(
+            max_workers=maxsize, thread_name_prefix="db")
+        self._idle: list[Connection] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._size: int = 0
+        self._closed: bool = False
+        # Set whenever a connection is closed, close waits on it
+        self._shrunk = asyncio.Event()
+
+    @property
+    def size(self) -> int:
+        """Number of opened connections."""
+        return self._size
+
+    @property
+    def in_use(self) -> int:
+        """Number of connections currently handed out."""
+        return self._size - len(self._idle)
+
+    async def _new_connection(self) -> Connection:
+        loop = asyncio.get_running_loop()
+        raw = await loop.run_in_executor(self._executor, self._connect)
+        self._size += 1
+        return Connection(raw, self._executor, self.prepare)
+
+    async def _discard(self, conn: Connection):
+        self._size -= 1
+        self._shrunk.set()
+        try:
+            await conn._run(conn.raw.close)
+        except RuntimeError:
+            # Returned after close gave up waiting and shut the executor
+            conn.close_when_settled()
+        except Exception as e:
+            logger.debug(f"Error while closing a connection: {e}")
+
+    async def _is_healthy(self, conn: Connection) -> bool:
+        def ping():
+            raw = conn.raw
+            if hasattr(raw, "ping"):
+                try:
+                    raw.ping()
+                except Exception:
+                    # A reconnect loses server-side statements
+                    conn.forget_statements()
+                    raw.reconnect(attempts=1, delay=0)
+                return
+            cursor = raw.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+        try:
+            await conn._run(ping)
+            return True
+        except Exception as e:
+            logger.warning(f"Dropping a broken database connection: {e}")
+            return False
+
+    async def open(self):
+        """Open ``minsize`` connections."""
+        self._semaphore = asyncio.Semaphore(self.maxsize)
+        for _ in range(self.minsize):
+            self._idle.append(await self._new_connection())
+        logger.info(
+            f"Database pool opened with {self._size} connections"
+            f" (max {self.maxsize})"
+        )
+
+    async def close(self, timeout: float = 30.0):
+        """Forbid new acquisitions and close all the connections.
+
+        Borrowed connections are closed as they are returned; after
+        ``timeout`` seconds the pool stops waiting for them.
+        """
+        self._closed = True
+        while self._idle:
+            await self._discard(self._idle.pop())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._size > 0 and loop.time() < deadline:
+            self._shrunk.clear()
+            try:
+                await asyncio.wait_for(
+                    self._shrunk.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Closing the database pool with {self._size}"
+                    " connections still borrowed")
+        self._executor.shutdown(wait=False)
+
+    async def _get(self) -> Connection:
+        while self._idle:
+            conn = self._idle.pop()
+            idle_for = time.monotonic() - conn.last_used
+            if idle_for < self.health_check_interval:
+                return conn
+            if await self._is_healthy(conn):
+                return conn
+            await self._discard(conn)
+        return await self._new_connection()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow a connection for the duration of the block.
+
+        If the block fails or is cancelled, the connection is rolled back
+        once its call in flight ends, before it goes back to the pool.
+
+        Raises:
+            PoolTimeoutError: if no connection is freed in time
+        """
+        if self._closed:
+            raise RuntimeError("Database pool is closed")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.maxsize)
+        try:
+            await asyncio.wait_for(
+                self._semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutError(
+                f"No database connection available after"
+                f" {self.acquire_timeout} seconds"
+            ) from None
+        conn = None
+        try:
+            conn = await self._get()
+            yield conn
+        except BaseException:
+            if conn is not None:
+                try:
+                    # A cancelled query may still run in its thread
+                    await conn.settle()
+                    await conn.rollback()
+                except Exception:
+                    await self._discard(conn)
+                    conn = None
+                except BaseException:
+                    # Cancelled again while waiting, the connection can't
+                    # be reused
+                    self._size -= 1
+                    self._shrunk.set()
+                    conn.close_when_settled()
+                    conn = None
+            raise
+        finally:
+            if conn is not None:
+                conn.last_used = time.monotonic()
+                if self._closed:
+                    await self._discard(conn)
+                else:
+                    self._idle.append(conn)
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Borrow a connection and commit on success, roll back otherwise."""
+        async with self.acquire() as conn:
+            await conn.execute(self.begin)
+            yield conn
+            await conn.commit()
+
+    async def fetchall(self, query: str, params: Sequence = None) -> list:
+        """Run a query on a pooled connection and return all rows."""
+        async with self.acquire() as conn:
+            return await conn.fetchall(query, params)
+
+    async def fetchone(self, query: str, params: Sequence = None):
+        """Run a query on a pooled connection and return the first row."""
+        async with self.acquire() as conn:
+            return await conn.fetchone(query, params)
+
+    async def execute(self, query: str, params: Sequence = None) -> int:
+        """Run a single autocommitted statement, return affected rows."""
+        async with self.acquire() as conn:
+            return await conn.execute(query, params)
@@ -0,0 +1,319 @@
+"""Scaling benchmark of the bot's database statements.
+
+Seeds raw_predictions with rows of simulated users whose numbers of
+predictions follow a Zipf distribution, so a few users have most of the
+rows, and grows the table through the given sizes. At every size each
+statement the handlers issue is timed for the heaviest, a median and the
+lightest user, and its plan is checked: a hot statement which reads a
+whole table or index fails the run.
+
+Usage: python dbbench.py [--sizes 10000,100000,1000000] [--users N]
+                         [--skew S] [--repeats N] [--output FILE]
+
+SQLite runs in a temporary file unless --path is given. With --backend
+mysql or postgres the database is configured like the bot's (.env), and
+the seeded rows stay there, so point it at a scratch database.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Optional
+
+import numpy as np
+
+from reminders import SCAN_BATCH
+from storage import BACKENDS, LIST_FILTERS, Storage, create_storage
+
+logger = logging.getLogger(__name__)
+
+# Seeded users' ids start here, away from Telegram's ones
+FIRST_USER: int = 10 ** 12
+# Rows inserted per transaction
+BATCH_SIZE: int = 10000
+# Distinct categories of a user's predictions
+CATEGORIES: int = 12
+# Share of predictions with a known outcome
+RESOLVED_SHARE: float = 0.6
+# Predictions per page, as many as the bot asks for
+PAGE_SIZE: int = 30
+# Statements whose parameters are ids of a user's predictions
+OWNED_IDS_COUNT: int = 10
+# Statements which change rows, they are executed instead of fetched
+WRITES: frozenset[str] = frozenset(
+    {"UPDATE_BOUNDS", "SET_OUTCOME", "DELETE_PREDICTION"})
+
+
+class Seeder:
+    """Grows raw_predictions with predictions of skewed users.
+
+    Args:
+        storage (Storage): opened storage
+        users (int): number of users
+        skew (float): exponent of the Zipf distribution of rows per user
+        seed (int): seed of the generated data
+    """
+
+    def __init__(self, storage: Storage, users: int, skew: float,
+                 seed: int = 0):
+        self.storage = storage
+        weights = np.arange(1, users + 1, dtype=float) ** -skew
+        self.weights = weights / weights.sum()
+        self.random = np.random.default_rng(seed)
+        self.counts = np.zeros(users, dtype=np.int64)
+        self.rows: int = 0
+
+    def _batch(self, size: int) -> list:
+        owners = self.random.choice(len(self.counts), size, p=self.weights)
+        np.add.at(self.counts, owners, 1)
+        days = self.random.integers(0, 1000, size)
+        categories = self.random.zipf(1.5, size) % CATEGORIES
+        lows = self.random.uniform(0, 100, size)
+        errors = self.random.normal(10, 10, size)
+        resolved = self.random.random(size) < RESOLVED_SHARE
+        start = date.today() - timedelta(days=1000)
+        return [
+            self.storage._params("add", (
+                FIRST_USER + int(owner),
+                start + timedelta(days=int(day)),
+                "Сколько займет задача",
+                f"категория {category}",
+                "день",
+                low + 5, low + 15, low, low + 20,
+                low + error if known else None,
+                # Due a month after, so many wait for a reminder
+                start + timedelta(days=int(day) + 30),
+            ))
+            for owner, day, category, low, error, known in zip(
+                owners, days, categories, lows, errors, resolved)
+        ]
+
+    async def grow(self, rows: int):
+        """Insert predictions until the seeded ones number rows."""
+        while self.rows < rows:
+            params = self._batch(min(BATCH_SIZE, rows - self.rows))
+            async with self.storage.transaction() as conn:
+                await conn.executemany(
+                    self.storage.INSERT_PREDICTION, params)
+            self.rows += len(params)
+        async with self.storage.acquire() as conn:
+            await conn.fetchall(self.storage.ANALYZE)
+
+    def profiles(self) -> dict[str, int]:
+        """Return users to measure by profile: heavy, median and light."""
+        order = np.argsort(self.counts, kind="stable")
+        order = order[self.counts[order] > 0]
+        return {
+            "heavy": int(order[-1]),
+            "median": int(order[len(order) // 2]),
+            "light": int(order[0]),
+        }
+
+
+def hot_statements(storage: Storage, user_id: int, rows: list) -> dict:
+    """Statements the handlers issue with parameters for a user.
+
+    Args:
+        storage (Storage): storage whose statements to use
+        user_id (int): the user
+        rows (list): the user's first predictions, in COLUMNS order
+
+    Returns:
+        dict: statement's name in metrics -> (statement, parameters)
+    """
+    first = rows[0]
+    pred_id, category, bounds = first[0], first[4], first[6:10]
+    ids = [r[0] for r in rows[:OWNED_IDS_COUNT]]
+    owned_query, owned_params = storage._with_ids(storage.OWNED_IDS, ids, 2)
+    statements = {
+        "HAS_PREDICTIONS": (storage.HAS_PREDICTIONS, (user_id,)),
+        "CATEGORIES": (storage.CATEGORIES, (user_id,)),
+        "CALIBRATION_ALL": (storage.CALIBRATION_ALL, (user_id,)),
+        "CALIBRATION_CATEGORY": (
+            storage.CALIBRATION_CATEGORY, (user_id, category)),
+        "CALIBRATION_BY_CATEGORY": (
+            storage.CALIBRATION_BY_CATEGORY, (user_id,)),
+        "CALIBRATION_BY_MONTH": (storage.CALIBRATION_BY_MONTH, (user_id,)),
+        "RESOLVED": (storage.RESOLVED, (user_id,)),
+        "OWNED_IDS": (owned_query, (user_id, *owned_params)),
+        # Writes leave the rows as they are: the same bounds, and ids no
+        # prediction has
+        "UPDATE_BOUNDS": (
+            storage.UPDATE_BOUNDS,
+            storage._params(
+                "update_bounds", (user_id, pred_id, *bounds)),
+        ),
+        "SET_OUTCOME": (
+            storage.SET_OUTCOME,
+            storage._params("set_outcome", (user_id, 0, 0)),
+        ),
+        "DELETE_PREDICTION": (
+            storage.DELETE_PREDICTION,
+            storage._params("delete", (user_id, 0)),
+        ),
+        "SELECT_CHECKPOINT": (storage.SELECT_CHECKPOINT, ("dbbench",)),
+        # The reminders' scan is the same for every user
+        "DUE_PREDICTIONS": (
+            storage.DUE_PREDICTIONS,
+            (date.today(), 1, 0, date.min, 0, SCAN_BATCH),
+        ),
+        "PENDING_REMINDERS": storage._with_ids(
+            storage.PENDING_REMINDERS, ids),
+    }
+    for kind, condition in LIST_FILTERS.items():
+        # The first page and the last one
+        statements[f"PAGE_NEXT_{kind}"] = (
+            storage.PAGE_NEXT.format(filter=condition),
+            (user_id, 0, PAGE_SIZE + 1),
+        )
+        statements[f"PAGE_PREV_{kind}"] = (
+            storage.PAGE_PREV.format(filter=condition),
+            (user_id, 2 ** 62, PAGE_SIZE + 1),
+        )
+    return statements
+
+
+async def measure(storage: Storage, name: str, query: str, params: tuple,
+                  repeats: int) -> dict:
+    """Time a statement on one connection.
+
+    Returns:
+        dict: p50, p95 and mean in milliseconds
+    """
+    seconds = []
+    async with storage.acquire() as conn:
+        run = conn.execute if name in WRITES else conn.fetchall
+        for _ in range(repeats):
+            start = time.perf_counter()
+            await run(query, params)
+            seconds.append(time.perf_counter() - start)
+    p50, p95 = np.percentile(seconds, (50, 95)) * 1000
+    return {
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "mean_ms": round(float(np.mean(seconds)) * 1000, 3),
+    }
+
+
+async def run(storage: Storage, args) -> dict:
+    """Seed every size in turn, time and explain the statements."""
+    seeder = Seeder(storage, args.users, args.skew, args.seed)
+    statements: dict[str, dict] = {}
+    for size in args.sizes:
+        start = time.perf_counter()
+        await seeder.grow(size)
+        logger.info(
+            f"Seeded {size} rows in {time.perf_counter() - start:.1f} s")
+        profiles = seeder.profiles()
+        for profile, index in profiles.items():
+            user_id = FIRST_USER + index
+            rows, _, _ = await storage.page(
+                user_id, "whole", OWNED_IDS_COUNT, "next")
+            for name, (query, params) in hot_statements(
+                storage, user_id, rows
+            ).items():
+                stats = statements.setdefault(
+                    name, {"full_scan": False, "plan": [], "curve": {}})
+                point = stats["curve"].setdefault(
+                    size, {"rows": size, "user_rows": {}})
+                point["user_rows"][profile] = int(seeder.counts[index])
+                point[profile] = await measure(
+                    storage, name, query, params, args.repeats)
+                if profile != "heavy":
+                    continue
+                plan, full_scan = await storage.explain(query, params)
+                stats["plan"] = plan
+                if full_scan and size >= args.min_plan_rows:
+                    stats["full_scan"] = True
+                    logger.warning(
+                        f"{name} reads a whole table at {size} rows:"
+                        f" {plan}")
+    for stats in statements.values():
+        stats["curve"] = list(stats["curve"].values())
+    return {
+        "backend": args.backend,
+        "users": args.users,
+        "skew": args.skew,
+        "repeats": args.repeats,
+        "sizes": args.sizes,
+        "full_scans": sorted(
+            name for name, stats in statements.items() if stats["full_scan"]),
+        "statements": statements,
+    }
+
+
+def open_storage(backend: str, path: Optional[str]) -> Storage:
+    """Create the storage to benchmark, configured like stats.py."""
+    if backend == "sqlite":
+        return create_storage(backend, path=path)
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    options = dict(
+        host=os.getenv("HOST"),
+        user=os.getenv("USER"),
+        password=os.getenv("PASSWORD"),
+        database=os.getenv("DATABASE"),
+        minsize=1,
+        maxsize=1,
+    )
+    if backend == "postgres" and os.getenv("PORT"):
+        options["port"] = int(os.getenv("PORT"))
+    return create_storage(backend, **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backend", choices=BACKENDS, default="sqlite")
+    parser.add_argument("--path", help="SQLite file, temporary by default")
+    parser.add_argument(
+        "--sizes", default="10000,100000,1000000",
+        type=lambda value: sorted(int(s) for s in value.split(",")),
+        help="comma separated numbers of seeded rows to measure at")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="exponent of the Zipf distribution of rows")
+    parser.add_argument("--repeats", type=int, default=50,
+                        help="executions of a statement per measurement")
+    parser.add_argument("--min-plan-rows", type=int, default=10000,
+                        help="smallest size at which full scans fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the report to")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def bench(path: Optional[str]) -> dict:
+        storage = open_storage(args.backend, path)
+        await storage.open()
+        try:
+            await storage.migrate()
+            return await run(storage, args)
+        finally:
+            await storage.close()
+
+    if args.backend == "sqlite" and args.path is None:
+        with tempfile.TemporaryDirectory() as workdir:
+            report = asyncio.run(
+                bench(os.path.join(workdir, "predictions.db")))
+    else:
+        report = asyncio.run(bench(args.path))
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    for name in report["full_scans"]:
+        print(f"Full scan: {name}", file=sys.stderr)
+    sys.exit(1 if report["full_scans"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Streaming export of users' predictions to CSV or JSON Lines."""
+from __future__ import annotations
+
+import asyncio
+import csv
+import gzip
+import io
+import json
+from tempfile import SpooledTemporaryFile
+
+from storage import Storage
+
+# Exported columns, the same as storage.COLUMNS without the owner
+FIELDS: tuple[str, ...] = (
+    "id",
+    "date",
+    "task_description",
+    "task_category",
+    "unit_of_measure",
+    "pred_low_50_conf",
+    "pred_high_50_conf",
+    "pred_low_90_conf",
+    "pred_high_90_conf",
+    "actual_outcome",
+    "resolve_by",
+)
+FORMATS: tuple[str, ...] = ("csv", "jsonl")
+# Exports smaller than this are kept in memory, larger go to disk
+SPOOL_SIZE: int = 1 << 20
+BATCH_SIZE: int = 500
+
+
+class _Writer:
+    """Encodes rows of raw_predictions into an open binary file."""
+
+    def __init__(self, file, fmt: str, compress: bool):
+        self._gzip = (
+            gzip.GzipFile(fileobj=file, mode="wb") if compress else None)
+        self._text = io.TextIOWrapper(
+            self._gzip or file, encoding="utf-8", newline="")
+        self._csv = csv.writer(self._text) if fmt == "csv" else None
+        if self._csv:
+            self._csv.writerow(FIELDS)
+
+    def write(self, rows: list):
+        for row in rows:
+            # Drop user_id, the second of storage.COLUMNS
+            values = [
+                value.isoformat() if hasattr(value, "isoformat") else value
+                for value in (row[0], *row[2:])
+            ]
+            if self._csv:
+                self._csv.writerow(
+                    "" if value is None else value for value in values)
+            else:
+                self._text.write(
+                    json.dumps(dict(zip(FIELDS, values)), ensure_ascii=False)
+                    + "\n"
+                )
+
+    def close(self):
+        # Leave the underlying file open for the upload
+        self._text.detach()
+        if self._gzip:
+            self._gzip.close()
+
+
+async def export_predictions(
+    storage: Storage,
+    user_id: int,
+    fmt: str = "csv",
+    compress: bool = False,
+    batch_size: int = BATCH_SIZE,
+) -> tuple[SpooledTemporaryFile, int]:
+    """Write all of a user's predictions to a temporary file.
+
+    Rows are read in batches and encoded as they arrive, so memory use
+    doesn't depend on the number of predictions. Encoding and writing run
+    in the default executor to keep the event loop free for other users.
+
+    Args:
+        storage (Storage): opened storage
+        user_id (int): whose predictions to export
+        fmt (str): one of FORMATS
+        compress (bool): whether to gzip the file
+        batch_size (int): rows fetched per query
+
+    Returns:
+        tuple[SpooledTemporaryFile, int]: file positioned at its start and
+        the number of exported predictions
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt}")
+    loop = asyncio.get_running_loop()
+    file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    count = 0
+    try:
+        writer = _Writer(file, fmt, compress)
+        async for rows in storage.iter_predictions(user_id, batch_size):
+            await loop.run_in_executor(None, writer.write, rows)
+            count += len(rows)
+        await loop.run_in_executor(None, writer.close)
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+    return file, count
+
+
+def file_name(fmt: str, compress: bool) -> str:
+    """Name of an export file in the given format."""
+    return f"predictions.{fmt}" + (".gz" if compress else "")
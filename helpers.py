@@ -1,15 +1,20 @@
 """Helper functions for the bot."""
 from __future__ import annotations
+from datetime import date
+from html import escape
 from typing import Union
 
-import re
-
-from itertools import chain
-
 SMILES_NUMBER: int = 60
 SMALL_DIAMOND = "\U0001F538"
 PENCIL = "\U0000270F"
 BLACK_SQUARE = "\U000025AA"
+CONFIDENCE_VERDICTS: dict[str, str] = {
+    "over": "интервалы слишком узкие, Вы излишне уверены",
+    "under": "интервалы слишком широкие, Вы недостаточно уверены",
+    "ok": "калибровка в пределах случайных отклонений",
+}
+SELECT_QUERY_HEADER: str = (
+    "Предсказания, сделанные Вами на текущий момент:\n\n")
 
 
 def create_message_categories(ans: list[str]):
@@ -22,47 +27,87 @@ def create_message_categories(ans: list[str]):
         str: message ready to be sent to a user
     """
     return ('Ваши категории: '
-            f'{"; ".join(chain.from_iterable(ans))}'
+            f'{"; ".join(ans)}'
             )
 
 
-def create_message_select_query(ans):
-    """Create a coherent message out of a given predictions' list.
+def create_prediction_block(row) -> str:
+    """Create a prediction's part of a listing.
 
     Args:
-        ans (list[str]): list of user's predictions
+        row (Sequence): prediction in the order of storage.COLUMNS
+
+    Returns:
+        str: HTML block with user's values escaped
+    """
+    date = row[2]
+    if hasattr(date, "strftime"):
+        date = date.strftime("%d/%m/%Y")
+    (task_description, task_category, unit_of_measure, pred_low_50_conf,
+     pred_high_50_conf, pred_low_90_conf, pred_high_90_conf,
+     actual_outcome) = row[3:11]
+    return (
+        f"<b>№: {row[0]}</b>\n"
+        f"<b>{date}</b>\n\n{PENCIL}"
+        f" {escape(str(task_description))}\n\n"
+        f"<b>Категория:</b> {escape(str(task_category))}\n"
+        f"<b>Единица измерения:</b> {escape(str(unit_of_measure))}\n\n"
+        "<b>ГРАНИЦЫ</b>\n"
+        f"{SMALL_DIAMOND} <b>Нижняя 50%:</b> {pred_low_50_conf}\n"
+        f"{SMALL_DIAMOND} <b>Верхняя 50%:</b> {pred_high_50_conf}\n"
+        f"{SMALL_DIAMOND} <b>Нижняя 90%:</b> {pred_low_90_conf}\n"
+        f"{SMALL_DIAMOND} <b>Верхняя 90%:</b> {pred_high_90_conf}\n\n"
+        f"{BLACK_SQUARE} <b>Результат:</b> {actual_outcome or ''}\n"
+        f"{'_' * SMILES_NUMBER}\n\n"
+    )
+
+
+def _calibration_line(calibration) -> str:
+    hit_50, hit_90 = calibration.hit_rate
+    width_50, width_90 = calibration.width
+    winkler_50, winkler_90 = calibration.winkler
+    return (
+        f"попаданий в 50% - {hit_50:.2f}, в 90% - {hit_90:.2f}; ширина"
+        f" интервалов {width_50:.3g} / {width_90:.3g}; оценка Винклера"
+        f" {winkler_50:.3g} / {winkler_90:.3g}; "
+        f"{CONFIDENCE_VERDICTS[calibration.direction]}"
+    )
+
+
+def create_message_breakdown(overall, categories: list, limit: int = 4096):
+    """Create a message with calibration overall and by categories.
+
+    Categories which don't fit in the limit are only counted. Lengths are
+    measured as Telegram does, see render.text_length.
+
+    Args:
+        overall (analytics.Calibration): calibration of all predictions
+        categories (list[analytics.Calibration]): calibration by categories
+        limit (int): maximum message length
 
     Returns:
         str: message ready to be sent to a user
     """
-    text = ""
-    for n, i in enumerate(ans):
-        id = i[0]
-        date = i[2]
-        task_description = i[3]
-        task_category = i[4]
-        unit_of_measure = i[5]
-        pred_low_50_conf = i[6]
-        pred_high_50_conf = i[7]
-        pred_low_90_conf = i[8]
-        pred_high_90_conf = i[9]
-        actual_outcome = i[10]
-
-        text += (
-            f"<b>№: {str(id)}</b>\n"
-            f"<b>{date}</b>\n\n{PENCIL}"
-            f" {task_description}\n\n<b>Категория:</b> {task_category}\n"
-            f"<b>Единица измерения:</b> {unit_of_measure}\n\n"
-            "<b>ГРАНИЦЫ</b>\n"
-            f"{SMALL_DIAMOND} <b>Нижняя 50%:</b> {pred_low_50_conf}\n"
-            f"{SMALL_DIAMOND} <b>Верхняя 50%:</b> {pred_high_50_conf}\n"
-            f"{SMALL_DIAMOND} <b>Нижняя 90%:</b> {pred_low_90_conf}\n"
-            f"{SMALL_DIAMOND} <b>Верхняя 90%:</b> {pred_high_90_conf}\n\n"
-            f"{BLACK_SQUARE} <b>Результат:</b> {actual_outcome or ''}\n"
-            f"{'_' * SMILES_NUMBER}\n\n"
+    # render imports this module
+    from render import text_length
+
+    lines = [
+        f"<b>Общая калибровка</b> ({overall.count}):"
+        f" {_calibration_line(overall)}\n"
+    ]
+    length = text_length(lines[0])
+    for n, calibration in enumerate(categories):
+        line = (
+            f"<b>{escape(calibration.category)}</b> ({calibration.count}):"
+            f" {_calibration_line(calibration)}\n"
         )
-    message = "Предсказания, сделанные Вами на текущий момент:\n\n" + text
-    return message
+        # Leave room for the last line, lines are joined by newlines
+        if length + 1 + text_length(line) > limit - 100:
+            lines.append(f"И еще категорий: {len(categories) - n}")
+            break
+        lines.append(line)
+        length += 1 + text_length(line)
+    return "\n".join(lines)
 
 
 def one_message(ans: dict[str, str]):
@@ -71,6 +116,11 @@ def one_message(ans: dict[str, str]):
     Args:
         ans (dict[str, str]): dictionary with inputed values
     """
+    resolve_by = ans.get("resolve_by")
+    due = (
+        f"{date.fromisoformat(resolve_by):%d.%m.%Y}" if resolve_by
+        else "без напоминания"
+    )
     message = (
         f"{PENCIL} {ans['prediction']}\n\n"
         f"<b>Категория:</b> {ans['category']}\n"
@@ -79,34 +129,12 @@ def one_message(ans: dict[str, str]):
         f"{SMALL_DIAMOND} <b>Нижняя 50%:</b> {ans['low_50']}\n"
         f"{SMALL_DIAMOND} <b>Верхняя 50%:</b> {ans['hi_50']}\n"
         f"{SMALL_DIAMOND} <b>Нижняя 90%:</b> {ans['low_90']}\n"
-        f"{SMALL_DIAMOND} <b>Верхняя 90%:</b> {ans['hi_90']}"
+        f"{SMALL_DIAMOND} <b>Верхняя 90%:</b> {ans['hi_90']}\n\n"
+        f"<b>Дата результата:</b> {due}"
     )
     return message
 
 
-def check_click(load: str) -> bool:
-    """Check user's input isn't any of the buttons.
-
-    Args:
-        load (str): message we have got
-
-    Returns:
-        bool: True if its a regular message and False if
-        it's one of the bot buttons
-    """
-    commands = [
-        "Добавить предсказание",
-        "Обновить предсказание",
-        "Удалить предсказание",
-        "Результат предсказания",
-        "Проверить калибровку"
-    ]
-    for comm in commands:
-        if re.match(comm, load):
-            return False
-    return True
-
-
 async def err_message(
     client,
     who: Union[str, int],
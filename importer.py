@@ -0,0 +1,224 @@
+"""Bulk import of predictions and outcomes from CSV or JSON Lines files.
+
+A file holds either new predictions, with the columns of an export, or
+outcomes of saved predictions, with just ``id`` and ``actual_outcome``.
+The kind of every row is told by its fields, so an export can be imported
+back as is.
+"""
+from __future__ import annotations
+
+import asyncio
+import csv
+import gzip
+import io
+import json
+from datetime import date as date_type
+from datetime import datetime
+from itertools import islice
+from typing import IO, Iterator, Optional, Union
+
+from journal import WriteBehind
+from storage import Storage
+from validators import (
+    validate_category,
+    validate_description,
+    validate_number,
+    validate_resolution_date,
+    validate_unit,
+)
+
+# Bigger files are refused before downloading
+MAX_FILE_SIZE: int = 10 * 1024 * 1024
+BATCH_SIZE: int = 500
+BOUNDS: tuple[str, ...] = (
+    "pred_low_50_conf",
+    "pred_high_50_conf",
+    "pred_low_90_conf",
+    "pred_high_90_conf",
+)
+EXTENSIONS: dict[str, tuple[str, bool]] = {
+    ".csv": ("csv", False),
+    ".jsonl": ("jsonl", False),
+    ".csv.gz": ("csv", True),
+    ".jsonl.gz": ("jsonl", True),
+}
+
+
+def file_format(name: str) -> Optional[tuple[str, bool]]:
+    """Tell an uploaded file's format by its name.
+
+    Args:
+        name (str): file name
+
+    Returns:
+        tuple[str, bool]: format and whether the file is gzipped or None
+        for unsupported files
+    """
+    name = (name or "").lower()
+    # Longest extensions first, .csv.gz before .gz
+    for extension in sorted(EXTENSIONS, key=len, reverse=True):
+        if name.endswith(extension):
+            return EXTENSIONS[extension]
+    return None
+
+
+def _records(file: IO[bytes], fmt: str) -> Iterator[tuple[int, object]]:
+    """Yield (line number, record) of a file one at a time."""
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_num, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError:
+            yield line_num, None
+
+
+def _field(record: dict, name: str) -> str:
+    value = record.get(name)
+    return "" if value is None else str(value).strip()
+
+
+def _date(value: str) -> date_type:
+    if not value:
+        return datetime.now().date()
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"дата {value} не похожа на ГГГГ-ММ-ДД или ДД/ММ/ГГГГ")
+
+
+def parse_record(record) -> tuple[str, tuple]:
+    """Validate a record and convert it into a storage call's arguments.
+
+    Args:
+        record: parsed row of a file
+
+    Raises:
+        ValueError: with a message for the user if the row isn't valid
+
+    Returns:
+        tuple[str, tuple]: "add" with add's arguments after user_id or
+        "set_outcome" with (prediction id, outcome)
+    """
+    if not isinstance(record, dict):
+        raise ValueError("строка не является корректным JSON объектом")
+    if _field(record, "task_description"):
+        description = _field(record, "task_description")
+        category = _field(record, "task_category").lower()
+        unit = _field(record, "unit_of_measure")
+        if not validate_description(description):
+            raise ValueError("недопустимый текст предсказания")
+        if not validate_category(category):
+            raise ValueError("категория должна быть одним словом")
+        if not validate_unit(unit):
+            raise ValueError("единица измерения должна быть одним словом")
+        bounds = []
+        for name in BOUNDS:
+            value = _field(record, name)
+            if not validate_number(value):
+                raise ValueError(f"{name} должно быть числом")
+            bounds.append(value)
+        outcome = _field(record, "actual_outcome") or None
+        if outcome is not None and not validate_number(outcome):
+            raise ValueError("actual_outcome должно быть числом")
+        # Exported predictions may be past their resolution date
+        resolve_by = _field(record, "resolve_by")
+        if not validate_resolution_date(
+                resolve_by or "-", "%Y-%m-%d", future=False):
+            raise ValueError("resolve_by должно быть датой ГГГГ-ММ-ДД")
+        if resolve_by in ("", "-"):
+            resolve_by = None
+        return "add", (
+            _date(_field(record, "date")), description, category, unit,
+            *bounds, outcome, resolve_by,
+        )
+    pred_id = _field(record, "id")
+    outcome = _field(record, "actual_outcome")
+    if not pred_id.isdigit() or not validate_number(outcome):
+        raise ValueError(
+            "ожидались либо поля предсказания, либо номер предсказания"
+            " и его результат"
+        )
+    return "set_outcome", (pred_id, outcome)
+
+
+def _parse_batch(records: Iterator, size: int) -> list[tuple]:
+    batch = []
+    for line_num, record in islice(records, size):
+        try:
+            op, args = parse_record(record)
+        except ValueError as e:
+            batch.append((line_num, None, str(e)))
+        else:
+            batch.append((line_num, op, args))
+    return batch
+
+
+async def import_file(
+    storage: Union[Storage, WriteBehind],
+    user_id: int,
+    file: IO[bytes],
+    name: str,
+    batch_size: int = BATCH_SIZE,
+) -> list[tuple[Optional[int], Optional[str]]]:
+    """Import predictions and outcomes from an uploaded file.
+
+    The file is parsed batch by batch in the default executor, every
+    batch is applied in one transaction per kind of rows. Through a
+    WriteBehind journal rows are applied in order with the user's other
+    edits, and outcomes of strangers' predictions are reported through
+    its on_rejected rather than in the returned report.
+
+    Args:
+        storage (Storage | WriteBehind): opened storage or the journal in
+        front of it
+        user_id (int): whose predictions to add or resolve
+        file (IO[bytes]): file positioned at its start
+        name (str): file name telling its format, see file_format
+        batch_size (int): rows per transaction
+
+    Returns:
+        list[tuple[int, str]]: line number and an error message or None
+        for every row of the file; an unreadable file ends the report with
+        an error without a line number
+    """
+    fmt, compress = file_format(name)
+    if compress:
+        file = gzip.GzipFile(fileobj=file, mode="rb")
+    records = _records(file, fmt)
+    loop = asyncio.get_running_loop()
+    report = []
+    while True:
+        try:
+            batch = await loop.run_in_executor(
+                None, _parse_batch, records, batch_size)
+        except (ValueError, OSError, csv.Error) as e:
+            # Not a text file or a broken archive
+            report.append((None, f"файл не удалось прочитать: {e}"))
+            break
+        if not batch:
+            break
+        errors = {line: error for line, op, error in batch if op is None}
+        predictions = [
+            (line, args) for line, op, args in batch if op == "add"]
+        outcomes = [
+            (line, args) for line, op, args in batch if op == "set_outcome"]
+        if predictions:
+            await storage.add_many(user_id, [args for _, args in predictions])
+        if outcomes:
+            owned = await storage.set_outcomes(
+                user_id, [args for _, args in outcomes])
+            for line, (pred_id, _) in outcomes:
+                if int(pred_id) not in owned:
+                    errors[line] = (
+                        f"предсказание с номером {pred_id} не найдено")
+        report.extend((line, errors.get(line)) for line, _, _ in batch)
+    return report
@@ -0,0 +1,330 @@
+"""Write-behind mode for prediction mutations.
+
+Mutations are appended to a local journal file and acknowledged as soon as
+the file is synced to disk. A background task applies them to the
+database in grouped transactions and records the last applied entry in
+journal_checkpoint within the same transaction, so replaying the journal
+after a crash applies every entry exactly once.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from datetime import date as date_type
+from itertools import islice
+from typing import Awaitable, Callable, Optional
+
+from db import PoolTimeoutError
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Seconds between attempts to reach an unavailable database
+MAX_RETRY_DELAY: float = 30.0
+
+
+class WriteBehind:
+    """Journaled, asynchronously applied prediction mutations.
+
+    Offers the mutating methods of Storage, so handlers can use either of
+    them. Ownership is still enforced by the statements
+    themselves; as the answer is only known after the entry is applied,
+    mutations which affected no rows, or failed and were dropped, are
+    reported through ``on_rejected``.
+
+    Args:
+        storage (Storage): opened storage the entries are applied to
+        path (str): journal file
+        name (str): journal's key in journal_checkpoint, unique per instance
+        batch_size (int): maximum number of entries per transaction
+        sync_interval (float): seconds to gather entries before an fsync
+        on_rejected (Callable): coroutine function called with the user id,
+        the operation, the prediction id of a rejected mutation and
+        whether it failed with an error rather than affected no rows
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        path: str,
+        name: str = "default",
+        batch_size: int = 200,
+        sync_interval: float = 0.005,
+        on_rejected: Optional[Callable[..., Awaitable]] = None,
+    ):
+        self.storage = storage
+        self.path = path
+        self.name = name
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.on_rejected = on_rejected
+        self._seq: int = 0
+        self._file = None
+        self._unsynced: list[tuple[dict, asyncio.Future]] = []
+        self._unapplied: deque = deque()
+        self._synced = asyncio.Event()
+        self._written = asyncio.Event()
+        self._file_lock = asyncio.Lock()
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def backlog(self) -> int:
+        """Number of acknowledged entries not yet in the database."""
+        return len(self._unapplied)
+
+    async def start(self):
+        """Replay unapplied entries and start the background tasks."""
+        checkpoint = await self.storage.journal_checkpoint(self.name)
+        self._seq = checkpoint
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The tail of an entry which was never synced
+                        logger.warning("Skipping a torn journal entry")
+                        continue
+                    self._seq = max(self._seq, record["seq"])
+                    if record["seq"] > checkpoint:
+                        self._unapplied.append(record)
+        if self._unapplied:
+            logger.info(
+                f"Replaying {len(self._unapplied)} journal entries")
+        self._file = open(self.path, "ab")
+        self._tasks = [
+            asyncio.create_task(self._sync_loop()),
+            asyncio.create_task(self._apply_loop()),
+        ]
+        self._synced.set()
+
+    async def stop(self, timeout: float = 30.0):
+        """Wait for the backlog to be applied and stop."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self._unsynced or self._unapplied) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._file.close()
+        if self._unapplied:
+            logger.warning(
+                f"{len(self._unapplied)} journal entries left for replay")
+
+    async def _submit(self, op: str, user_id: int, pred_id, args) -> bool:
+        await self._submit_many(op, user_id, [(pred_id, args)])
+        return True
+
+    async def _submit_many(self, op: str, user_id: int, entries: list):
+        # Entries of one call are (prediction id, args) pairs, they are
+        # journaled one after another and synced together
+        loop = asyncio.get_running_loop()
+        futures = []
+        for pred_id, args in entries:
+            self._seq += 1
+            record = {
+                "seq": self._seq,
+                "op": op,
+                "user_id": user_id,
+                "pred_id": pred_id,
+                "args": [
+                    a.isoformat() if isinstance(a, date_type) else a
+                    for a in args
+                ],
+            }
+            future = loop.create_future()
+            self._unsynced.append((record, future))
+            futures.append(future)
+        self._written.set()
+        await asyncio.gather(*futures)
+
+    async def _sync_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._written.wait()
+            # Let concurrent handlers join the same fsync
+            await asyncio.sleep(self.sync_interval)
+            self._written.clear()
+            batch, self._unsynced = self._unsynced, []
+            data = b"".join(
+                json.dumps(record, ensure_ascii=False).encode() + b"\n"
+                for record, _ in batch
+            )
+            try:
+                async with self._file_lock:
+                    await loop.run_in_executor(None, self._write, data)
+                    self._unapplied.extend(record for record, _ in batch)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self._synced.set()
+            for _, future in batch:
+                future.set_result(None)
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _apply_loop(self):
+        delay = 0.5
+        isolate = False
+        while True:
+            if not self._unapplied:
+                self._synced.clear()
+                await self._compact()
+                await self._synced.wait()
+                continue
+            size = 1 if isolate else self.batch_size
+            batch = list(islice(self._unapplied, size))
+            try:
+                try:
+                    rejected = await self.storage.apply_journal(
+                        self.name, batch)
+                except Exception as e:
+                    if self._is_transient(e):
+                        raise
+                    if len(batch) > 1:
+                        # Apply one entry at a time to find the broken one
+                        isolate = True
+                        continue
+                    rejected = await self._drop(batch[0], e)
+            except Exception as e:
+                if not self._is_transient(e):
+                    raise
+                logger.warning(
+                    f"Journal can't reach the database, retrying in"
+                    f" {delay:.1f}s: {e}"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            delay = 0.5
+            isolate = False
+            for _ in batch:
+                self._unapplied.popleft()
+            for record in rejected:
+                await self._reject(record)
+
+    def _is_transient(self, error: Exception) -> bool:
+        # Errors after which a batch is retried rather than dropped
+        return (isinstance(error, (OSError, PoolTimeoutError))
+                or self.storage.is_transient(error))
+
+    async def _drop(self, record: dict, error: Exception) -> list[dict]:
+        logger.error(
+            f"Dropping journal entry {record['seq']} ({record['op']})"
+            f" with an error: {error}"
+        )
+        await self.storage.save_journal_checkpoint(self.name, record["seq"])
+        return [dict(record, failed=True)]
+
+    async def _reject(self, record: dict):
+        if self.on_rejected is None:
+            return
+        try:
+            await self.on_rejected(
+                record["user_id"], record["op"], record["pred_id"],
+                record.get("failed", False))
+        except Exception as e:
+            logger.error(f"Failed to report a rejected mutation: {e}")
+
+    async def _compact(self):
+        """Empty the journal once everything in it is applied."""
+        async with self._file_lock:
+            if self._unsynced or self._unapplied:
+                return
+            if self._file.tell() == 0:
+                return
+            self._file.truncate(0)
+            self._file.seek(0)
+
+    async def add(
+        self,
+        user_id: int,
+        date,
+        description: str,
+        category: str,
+        unit: str,
+        low_50,
+        hi_50,
+        low_90,
+        hi_90,
+        outcome=None,
+        resolve_by=None,
+    ) -> None:
+        """Journal a new prediction, its id isn't known yet."""
+        await self._submit(
+            "add",
+            user_id,
+            None,
+            (user_id, date, description, category, unit,
+             low_50, hi_50, low_90, hi_90, outcome, resolve_by),
+        )
+
+    async def update_bounds(
+        self, user_id: int, pred_id, low_50, hi_50, low_90, hi_90
+    ) -> bool:
+        """Journal new intervals of a prediction."""
+        return await self._submit(
+            "update_bounds",
+            user_id,
+            pred_id,
+            (user_id, pred_id, low_50, hi_50, low_90, hi_90),
+        )
+
+    async def set_outcome(self, user_id: int, pred_id, outcome) -> bool:
+        """Journal a prediction's outcome."""
+        return await self._submit(
+            "set_outcome", user_id, pred_id, (user_id, pred_id, outcome))
+
+    async def delete(self, user_id: int, pred_id) -> bool:
+        """Journal a prediction's deletion."""
+        return await self._submit(
+            "delete", user_id, pred_id, (user_id, pred_id))
+
+    async def add_many(self, user_id: int, predictions: list) -> int:
+        """Journal many new predictions, see Storage.add_many."""
+        await self._submit_many(
+            "add", user_id,
+            [(None, (user_id, *prediction)) for prediction in predictions])
+        return len(predictions)
+
+    async def set_outcomes(self, user_id: int, outcomes: list) -> set:
+        """Journal outcomes of many predictions, see Storage.set_outcomes.
+
+        Returns:
+            set: all the given ids, strangers' ones are rejected later
+        """
+        await self._submit_many(
+            "set_outcome", user_id,
+            [(pred_id, (user_id, pred_id, outcome))
+             for pred_id, outcome in outcomes])
+        return {int(pred_id) for pred_id, _ in outcomes}
+
+    async def update_many(self, user_id: int, updates: list) -> set:
+        """Journal new bounds of many predictions, see Storage.update_many.
+
+        Returns:
+            set: all the given ids, strangers' ones are rejected later
+        """
+        await self._submit_many(
+            "update_bounds", user_id,
+            [(update[0], (user_id, *update)) for update in updates])
+        return {int(update[0]) for update in updates}
+
+    async def delete_many(self, user_id: int, ids: list) -> set:
+        """Journal deletion of many predictions, see Storage.delete_many.
+
+        Returns:
+            set: all the given ids, strangers' ones are rejected later
+        """
+        await self._submit_many(
+            "delete", user_id,
+            [(pred_id, (user_id, pred_id)) for pred_id in ids])
+        return {int(pred_id) for pred_id in ids}
@@ -0,0 +1,172 @@
+"""Logging off the event loop, as JSON lines with the update's context.
+
+Records are put on a queue as they are made; a listener thread formats
+them and writes the file, so a handler never waits for the disk. Records
+made while an update is handled carry the user's id, their conversation
+state and the handler's name, and every handled update ends with a record
+of its duration. Debug records may be sampled to keep chatty lines from
+flooding the log under load.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import queue
+import random
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Awaitable, Callable, Optional
+
+# Attributes of records written as fields of their own
+CONTEXT_FIELDS: tuple[str, ...] = (
+    "user_id", "state", "handler", "duration_ms")
+MAX_BYTES: int = 50000000
+BACKUP_COUNT: int = 5
+TEXT_FORMAT: str = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Context of the update being handled by the current task
+_update: ContextVar[Optional[dict]] = ContextVar("update", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Give records the context of the update being handled."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _update.get()
+        if context is not None:
+            for field, value in context.items():
+                if not hasattr(record, field):
+                    setattr(record, field, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Let through a share of the debug records and all the others.
+
+    Args:
+        rate (float): share of debug records to keep, from 0 to 1
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class _QueueHandler(QueueHandler):
+    # The listener runs in this process, so records are passed as they
+    # are, only with the message merged with its arguments while they
+    # still hold what they held when logged; formatting is the listener's
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def traced(
+    state_of: Callable[[int], Any]
+) -> Callable[[Callable[..., Awaitable]], Callable[..., Awaitable]]:
+    """Decorator giving an event handler's records the update's context.
+
+    Records made while the handler runs carry the sender's id, their
+    conversation state when the update came and the handler's name; a
+    record of the handler's duration is made when it returns.
+
+    Args:
+        state_of (Callable): returns a user's conversation state or None
+    """
+    def decorate(handler: Callable[..., Awaitable]):
+        logger = logging.getLogger(handler.__module__)
+
+        @functools.wraps(handler)
+        async def wrapper(event):
+            user_id = event.sender_id
+            state = state_of(user_id)
+            token = _update.set({
+                "user_id": user_id,
+                "state": getattr(state, "name", state),
+                "handler": handler.__name__,
+            })
+            start = time.perf_counter()
+            try:
+                return await handler(event)
+            finally:
+                logger.info(
+                    "Update handled",
+                    extra={"duration_ms": round(
+                        (time.perf_counter() - start) * 1000, 3)},
+                )
+                _update.reset(token)
+        return wrapper
+    return decorate
+
+
+def setup_logging(
+    path: str, debug_sample: float = 1.0, debug_loggers: tuple = ()
+) -> QueueListener:
+    """Send all records through a queue to a JSON file and the console.
+
+    The console gets warnings and errors only, as text.
+
+    Args:
+        path (str): log file, rotated by size
+        debug_sample (float): share of debug records to keep
+        debug_loggers (tuple): names of loggers to log debug records of,
+        the others log from INFO
+
+    Returns:
+        QueueListener: started listener, stop it to flush the records
+    """
+    file_handler = RotatingFileHandler(
+        path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+    # The file has everything, the console only what needs attention
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(
+        records, file_handler, console, respect_handler_level=True)
+    handler = _QueueHandler(records)
+    # Filters run where the record is made, the context is there
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(debug_sample))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    # Without any debug records kept, debug calls return straight away
+    for name in debug_loggers:
+        logging.getLogger(name).setLevel(
+            logging.DEBUG if debug_sample > 0 else logging.INFO)
+    listener.start()
+    return listener
@@ -0,0 +1,293 @@
+"""Metrics in Prometheus' text format and a health check, served by tornado.
+
+Histograms are filled in as things happen; everything else is read from
+the bot's objects (caches, pools, queues) when the metrics are scraped.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional, Union
+
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS: tuple[float, ...] = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds a readiness check may take
+CHECK_TIMEOUT: float = 2.0
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace(
+        "\n", r"\n")
+
+
+class Histogram:
+    """Distribution of durations, one series per value of a label.
+
+    Series may carry extra labels, e.g. the state a handler ran in; their
+    values must come from a bounded set, every combination is a series.
+
+    Args:
+        name (str): metric's name
+        help (str): metric's description
+        label (str): name of the label telling the series apart
+        buckets (tuple): upper bounds of the buckets
+    """
+
+    def __init__(self, name: str, help: str, label: str,
+                 buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # (label value, extra labels) -> counts per bucket (the last one
+        # is +Inf), sum
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: str, seconds: float, **labels: str):
+        """Record a duration in the series of a label value.
+
+        Args:
+            value (str): value of the label
+            seconds (float): duration
+            **labels (str): values of extra labels by their names
+        """
+        key = (value, tuple(sorted(labels.items())))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    @contextmanager
+    def time(self, value: str, **labels: str):
+        """Record the duration of the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(value, time.perf_counter() - start, **labels)
+
+    def timed(
+        self,
+        handler: Optional[Callable[..., Awaitable]] = None,
+        **labels: Callable[..., str],
+    ):
+        """Decorate a coroutine function to record its duration by name.
+
+        Used bare, or called with functions computing extra labels from
+        the decorated function's arguments, e.g. ``timed(state=of_event)``.
+        """
+        if handler is None:
+            return functools.partial(self.timed, **labels)
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            extra = {
+                name: read(*args, **kwargs) for name, read in labels.items()}
+            with self.time(handler.__name__, **extra):
+                return await handler(*args, **kwargs)
+        return wrapper
+
+    def collect(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for (value, extra), (counts, total) in list(self._series.items()):
+            label = ",".join(
+                f'{name}="{_escape(v)}"'
+                for name, v in ((self.label, value), *extra))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Values read from the bot's objects when scraped.
+
+    Args:
+        name (str): metric's name
+        help (str): metric's description
+        read (Callable): returns a number, or numbers by label value
+        label (str): name of the label, if read returns a dict
+        kind (str): "gauge", or "counter" for values which only grow
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], Union[float, dict]],
+        label: Optional[str] = None,
+        kind: str = "gauge",
+    ):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+        self.kind = kind
+
+    def collect(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        values = self.read()
+        if isinstance(values, dict):
+            for value, number in values.items():
+                lines.append(
+                    f'{self.name}{{{self.label}="{_escape(value)}"}} {number}')
+        else:
+            lines.append(f"{self.name} {values}")
+        return lines
+
+
+class Registry:
+    """Metrics exposed together, one per name."""
+
+    def __init__(self):
+        # Name -> metric, in the order of first registration
+        self.metrics: dict = {}
+
+    def add(self, metric):
+        """Expose a metric, return it.
+
+        A metric replaces the one registered under its name before, so
+        building the bot again, e.g. in tests, doesn't duplicate series.
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Return all the metrics in Prometheus' text format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                logger.error(
+                    f"Something went wrong when collecting {metric.name}"
+                    f" with an error: {e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+HANDLER_SECONDS = REGISTRY.add(Histogram(
+    "bot_handler_seconds", "Time spent handling an update.", "handler"))
+QUERY_SECONDS = REGISTRY.add(Histogram(
+    "bot_query_seconds", "Time spent executing a statement.", "statement"))
+SEND_SECONDS = REGISTRY.add(Histogram(
+    "bot_send_seconds", "Time spent sending to Telegram.", "method"))
+
+# Statement's text -> name, and text before a field -> name of statements
+# which are formatted before execution
+_statements: dict[str, str] = {}
+_prefixes: list[tuple[str, str]] = []
+
+
+def name_statement(query: str, name: str):
+    """Name a statement in QUERY_SECONDS.
+
+    Args:
+        query (str): statement's text; with a ``{field}`` in it, every
+        statement starting with the text before the field gets the name
+        name (str): label of the statement's series
+    """
+    if "{" in query:
+        _prefixes.append((query.split("{", 1)[0], name))
+    else:
+        _statements[query] = name
+
+
+def statement_name(query: str) -> str:
+    """Return the name of a statement, "other" for unnamed ones."""
+    name = _statements.get(query)
+    if name is None:
+        name = next(
+            (n for prefix, n in _prefixes if query.startswith(prefix)),
+            "other")
+        _statements[query] = name
+    return name
+
+
+class _MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, registry: Registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header(
+            "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registry.render())
+
+
+class _HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, checks: dict[str, Callable[[], Awaitable[bool]]]):
+        self.checks = checks
+
+    async def _check(self, check) -> bool:
+        try:
+            return bool(await asyncio.wait_for(check(), CHECK_TIMEOUT))
+        except Exception as e:
+            logger.warning(f"Health check failed: {e}")
+            return False
+
+    async def get(self):
+        names = list(self.checks)
+        results = await asyncio.gather(
+            *(self._check(self.checks[name]) for name in names))
+        status = dict(zip(names, results))
+        self.set_status(200 if all(results) else 503)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(status))
+
+
+class MetricsServer:
+    """HTTP server of /metrics and /healthz on the running event loop.
+
+    Args:
+        port (int): port to listen on
+        address (str): address to listen on, all interfaces if empty
+        checks (dict): coroutine functions telling whether a dependency,
+        by its name, is ready
+        registry (Registry): metrics to expose
+    """
+
+    def __init__(
+        self,
+        port: int,
+        address: str = "",
+        checks: Optional[dict[str, Callable[[], Awaitable[bool]]]] = None,
+        registry: Registry = REGISTRY,
+    ):
+        self.port = port
+        self.address = address
+        self.app = tornado.web.Application([
+            (r"/metrics", _MetricsHandler, dict(registry=registry)),
+            (r"/healthz", _HealthHandler, dict(checks=checks or {})),
+        ])
+        self._server = None
+
+    async def start(self):
+        """Start listening, must be awaited on the bot's event loop."""
+        self._server = self.app.listen(self.port, self.address)
+        logger.info(f"Serving metrics on port {self.port}")
+
+    def stop(self):
+        """Stop listening."""
+        if self._server is not None:
+            self._server.stop()
@@ -0,0 +1,368 @@
+"""Versioned schema migrations applied on the bot's start."""
+from __future__ import annotations
+
+import logging
+from typing import Awaitable, Callable
+
+from db import Connection, Pool
+
+logger = logging.getLogger(__name__)
+
+# Rows copied per statement while backfilling a new column
+BACKFILL_BATCH: int = 10000
+# Seconds to wait for another instance which is migrating right now
+LOCK_TIMEOUT: int = 600
+LOCK_NAME: str = "calibration_bot_migrations"
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], Awaitable]]] = []
+
+
+def migration(version: int, description: str):
+    """Register a coroutine function as a schema migration.
+
+    Migrations run in the order of their versions, each of them at most
+    once per database. MySQL commits DDL implicitly, so every step has to
+    be safe to re-run after a crash in the middle of a migration.
+
+    Args:
+        version (int): unique increasing number of the migration
+        description (str): what the migration does
+    """
+    def decorator(func):
+        if any(v == version for v, _, _ in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+async def column_type(conn: Connection, table: str, column: str):
+    """Return a column's data type or None if there is no such column."""
+    row = await conn.fetchone(
+        "SELECT DATA_TYPE FROM information_schema.COLUMNS"
+        " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"
+        " AND COLUMN_NAME = %s",
+        (table, column),
+    )
+    return row[0].lower() if row else None
+
+
+async def index_exists(conn: Connection, table: str, index: str) -> bool:
+    """Check whether a table has an index with the given name."""
+    row = await conn.fetchone(
+        "SELECT 1 FROM information_schema.STATISTICS"
+        " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"
+        " AND INDEX_NAME = %s LIMIT 1",
+        (table, index),
+    )
+    return row is not None
+
+
+async def backfill(conn: Connection, statement: str):
+    """Run an UPDATE over raw_predictions in id ranges of BACKFILL_BATCH.
+
+    Short statements keep row locks brief so the table stays writable
+    while it is being converted.
+
+    Args:
+        conn (Connection): connection to run the statement with
+        statement (str): UPDATE with two placeholders for the id range
+    """
+    row = await conn.fetchone("SELECT MAX(id) FROM raw_predictions")
+    max_id = row[0] or 0
+    for start in range(0, max_id + 1, BACKFILL_BATCH):
+        await conn.execute(statement, (start, start + BACKFILL_BATCH))
+
+
+def _shadow_triggers(column: str) -> list[str]:
+    return [f"raw_predictions_{column}_bi", f"raw_predictions_{column}_bu"]
+
+
+async def fill_on_write(conn: Connection, column: str, expression: str):
+    """Set a new column of raw_predictions on every insert and update.
+
+    Created before the column is backfilled, the triggers keep rows which
+    running instances write in the meantime in step, so the backfill
+    needs no catch-up.
+
+    Args:
+        conn (Connection): connection to run the statements with
+        column (str): column being filled
+        expression (str): its value computed from the ``NEW`` row
+    """
+    for name, event in zip(_shadow_triggers(column), ("INSERT", "UPDATE")):
+        await conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await conn.execute(
+            f"CREATE TRIGGER {name} BEFORE {event} ON raw_predictions"
+            f" FOR EACH ROW SET NEW.{column} = {expression}"
+        )
+
+
+async def swap_column(conn: Connection, column: str, alter: str):
+    """Drop a filled column's triggers and swap it in.
+
+    Both happen under a write lock of the table, so no row is written
+    between them; writers wait for the swap only.
+
+    Args:
+        conn (Connection): connection to run the statements with
+        column (str): column filled by fill_on_write
+        alter (str): ALTER TABLE replacing the old column with it
+    """
+    await conn.execute("LOCK TABLES raw_predictions WRITE")
+    try:
+        for name in _shadow_triggers(column):
+            await conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await conn.execute(alter)
+    finally:
+        await conn.execute("UNLOCK TABLES")
+
+
+@migration(1, "create raw_predictions")
+async def create_raw_predictions(conn: Connection):
+    """Create the table in its original form."""
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS raw_predictions (
+            id INTEGER PRIMARY KEY AUTO_INCREMENT,
+            user_id VARCHAR(20),
+            date VARCHAR(100),
+            task_description VARCHAR(200),
+            task_category VARCHAR(50),
+            unit_of_measure VARCHAR(30),
+            pred_low_50_conf FLOAT(10),
+            pred_high_50_conf FLOAT(10),
+            pred_low_90_conf FLOAT(10),
+            pred_high_90_conf FLOAT(10),
+            actual_outcome FLOAT(10));"""
+    )
+
+
+@migration(2, "store user_id as BIGINT")
+async def user_id_bigint(conn: Connection):
+    """Copy user ids into a BIGINT column and swap it in."""
+    if await column_type(conn, "raw_predictions", "user_id") == "bigint":
+        return
+    if await column_type(conn, "raw_predictions", "user_id_new") is None:
+        await conn.execute(
+            "ALTER TABLE raw_predictions ADD COLUMN user_id_new BIGINT,"
+            " ALGORITHM=INPLACE, LOCK=NONE"
+        )
+    await fill_on_write(conn, "user_id_new", "CAST(NEW.user_id AS SIGNED)")
+    await backfill(
+        conn,
+        "UPDATE raw_predictions SET user_id_new = CAST(user_id AS SIGNED)"
+        " WHERE id >= %s AND id < %s AND user_id_new IS NULL",
+    )
+    await swap_column(
+        conn,
+        "user_id_new",
+        "ALTER TABLE raw_predictions DROP COLUMN user_id,"
+        " CHANGE COLUMN user_id_new user_id BIGINT NOT NULL AFTER id,"
+        " ALGORITHM=INPLACE",
+    )
+
+
+@migration(3, "store date as DATE")
+async def date_as_date(conn: Connection):
+    """Parse %d/%m/%Y strings into a DATE column and swap it in."""
+    if await column_type(conn, "raw_predictions", "date") == "date":
+        return
+    if await column_type(conn, "raw_predictions", "date_new") is None:
+        await conn.execute(
+            "ALTER TABLE raw_predictions ADD COLUMN date_new DATE,"
+            " ALGORITHM=INPLACE, LOCK=NONE"
+        )
+    await fill_on_write(
+        conn, "date_new", "STR_TO_DATE(NEW.date, '%d/%m/%Y')")
+    await backfill(
+        conn,
+        "UPDATE raw_predictions SET date_new = STR_TO_DATE(date, '%d/%m/%Y')"
+        " WHERE id >= %s AND id < %s AND date_new IS NULL",
+    )
+    await swap_column(
+        conn,
+        "date_new",
+        "ALTER TABLE raw_predictions DROP COLUMN date,"
+        " CHANGE COLUMN date_new date DATE AFTER user_id,"
+        " ALGORITHM=INPLACE",
+    )
+
+
+@migration(4, "index raw_predictions by user")
+async def user_indexes(conn: Connection):
+    """Add composite indexes used by per-user queries."""
+    indexes = {
+        "ix_user_id": "user_id, id",
+        "ix_user_category": "user_id, task_category",
+        "ix_user_outcome": "user_id, actual_outcome",
+    }
+    for name, columns in indexes.items():
+        if not await index_exists(conn, "raw_predictions", name):
+            await conn.execute(
+                f"ALTER TABLE raw_predictions ADD INDEX {name} ({columns}),"
+                " ALGORITHM=INPLACE, LOCK=NONE"
+            )
+
+
+def _hit(row: str, level: int) -> str:
+    """SQL expression telling whether a row's outcome is in an interval."""
+    return (
+        f"({row}.pred_low_{level}_conf <= {row}.actual_outcome"
+        f" AND {row}.pred_high_{level}_conf >= {row}.actual_outcome)"
+    )
+
+
+def _stats_change(row: str, sign: str) -> str:
+    """Trigger statement moving calibration_stats by a row's contribution."""
+    return (
+        f"IF {row}.actual_outcome IS NOT NULL THEN"
+        " INSERT INTO calibration_stats"
+        " (user_id, task_category, resolved, hits_50, hits_90)"
+        f" VALUES ({row}.user_id, {row}.task_category, {sign}1,"
+        f" {sign}{_hit(row, 50)}, {sign}{_hit(row, 90)})"
+        f" ON DUPLICATE KEY UPDATE resolved = resolved {sign} 1,"
+        f" hits_50 = hits_50 {sign} {_hit(row, 50)},"
+        f" hits_90 = hits_90 {sign} {_hit(row, 90)};"
+        " END IF;"
+    )
+
+
+async def maintain_calibration_stats(conn: Connection):
+    """Create the triggers of calibration_stats and fill it from scratch.
+
+    Both happen under write locks of the two tables, so every change is
+    either counted by the fill or by the triggers, exactly once. Running
+    it again gives the same result.
+    """
+    triggers = {
+        "raw_predictions_ai": ("INSERT", _stats_change("NEW", "+")),
+        "raw_predictions_au": (
+            "UPDATE",
+            _stats_change("OLD", "-") + " " + _stats_change("NEW", "+"),
+        ),
+        "raw_predictions_ad": ("DELETE", _stats_change("OLD", "-")),
+    }
+    await conn.execute(
+        "LOCK TABLES raw_predictions WRITE, calibration_stats WRITE")
+    try:
+        for name, (event, body) in triggers.items():
+            await conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            await conn.execute(
+                f"CREATE TRIGGER {name} AFTER {event} ON raw_predictions"
+                f" FOR EACH ROW BEGIN {body} END"
+            )
+        await conn.execute("DELETE FROM calibration_stats")
+        await conn.execute(
+            "INSERT INTO calibration_stats"
+            " (user_id, task_category, resolved, hits_50, hits_90)"
+            " SELECT user_id, task_category, COUNT(*),"
+            " SUM(pred_low_50_conf <= actual_outcome"
+            " AND pred_high_50_conf >= actual_outcome),"
+            " SUM(pred_low_90_conf <= actual_outcome"
+            " AND pred_high_90_conf >= actual_outcome)"
+            " FROM raw_predictions WHERE actual_outcome IS NOT NULL"
+            " GROUP BY user_id, task_category"
+        )
+    finally:
+        await conn.execute("UNLOCK TABLES")
+
+
+@migration(5, "create calibration_stats")
+async def create_calibration_stats(conn: Connection):
+    """Create per-(user, category) aggregates, fill and maintain them."""
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS calibration_stats (
+            user_id BIGINT NOT NULL,
+            task_category VARCHAR(50) NOT NULL,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            hits_50 INTEGER NOT NULL DEFAULT 0,
+            hits_90 INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, task_category));"""
+    )
+    await maintain_calibration_stats(conn)
+
+
+@migration(6, "maintain calibration_stats with triggers")
+async def calibration_stats_triggers(conn: Connection):
+    """Keep calibration_stats in step with every raw_predictions change.
+
+    Databases which got version 5 before it created the triggers missed
+    the changes made in between, so the aggregates are filled again.
+    """
+    await maintain_calibration_stats(conn)
+
+
+@migration(7, "create journal_checkpoint")
+async def create_journal_checkpoint(conn: Connection):
+    """Remember the last write-behind journal entry applied per journal."""
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS journal_checkpoint (
+            name VARCHAR(100) PRIMARY KEY,
+            seq BIGINT NOT NULL);"""
+    )
+
+
+@migration(8, "add resolution dates")
+async def resolution_dates(conn: Connection):
+    """Add optional resolution dates and the moments reminders were sent."""
+    for column, definition in (
+        ("resolve_by", "DATE NULL"),
+        ("reminded_at", "DATETIME NULL"),
+    ):
+        if await column_type(conn, "raw_predictions", column) is None:
+            await conn.execute(
+                f"ALTER TABLE raw_predictions ADD COLUMN {column}"
+                f" {definition}, ALGORITHM=INPLACE, LOCK=NONE"
+            )
+    # MySQL has no partial indexes; predictions waiting for a reminder are
+    # the range where both leading columns are NULL
+    if not await index_exists(conn, "raw_predictions", "ix_due"):
+        await conn.execute(
+            "ALTER TABLE raw_predictions ADD INDEX ix_due"
+            " (reminded_at, actual_outcome, resolve_by),"
+            " ALGORITHM=INPLACE, LOCK=NONE"
+        )
+
+
+async def migrate(pool: Pool) -> list[int]:
+    """Apply all pending migrations.
+
+    A named lock makes concurrently starting instances wait for each other
+    instead of running the same migration twice.
+
+    Args:
+        pool (Pool): database connection pool
+
+    Returns:
+        list[int]: versions applied during this call
+    """
+    applied_now = []
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description VARCHAR(200),
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP);"""
+        )
+        row = await conn.fetchone(
+            "SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+        if not row or row[0] != 1:
+            raise RuntimeError("Could not obtain the migrations lock")
+        try:
+            rows = await conn.fetchall("SELECT version FROM schema_migrations")
+            done = {r[0] for r in rows}
+            for version, description, func in MIGRATIONS:
+                if version in done:
+                    continue
+                logger.info(f"Applying migration {version}: {description}")
+                await func(conn)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, description)"
+                    " VALUES (%s, %s)",
+                    (version, description),
+                )
+                applied_now.append(version)
+        finally:
+            await conn.fetchall("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+    return applied_now
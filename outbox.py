@@ -0,0 +1,266 @@
+"""Outgoing messages sent in the background at Telegram's pace.
+
+Handlers queue their replies and return at once. A background task sends
+them no faster than once per ``chat_interval`` seconds to the same chat
+and ``rate`` messages per second overall, merges consecutive text
+messages to the same chat into one, waits out FloodWait errors and
+retries transient failures.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import deque
+from typing import Optional
+
+from cachetools import TTLCache
+from telethon.errors import FloodWaitError, ServerError, TimedOutError
+
+from metrics import SEND_SECONDS
+from render import MESSAGE_LIMIT, text_length
+
+logger = logging.getLogger(__name__)
+
+# Seconds between attempts to send a message which failed transiently
+MAX_RETRY_DELAY: float = 30.0
+# Options under which consecutive messages may be merged
+MERGEABLE_OPTIONS: frozenset[str] = frozenset({"parse_mode", "buttons"})
+
+
+class Outgoing:
+    """A queued call of TelegramClient's sending method."""
+
+    __slots__ = ("method", "args", "kwargs", "future", "attempts")
+
+    def __init__(self, method: str, args: tuple, kwargs: dict,
+                 future: asyncio.Future):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts: int = 0
+
+    @property
+    def mergeable(self) -> bool:
+        """Whether the message is plain text which may be merged."""
+        return (
+            self.method == "send_message"
+            and bool(self.args)
+            and isinstance(self.args[0], str)
+            and self.kwargs.keys() <= MERGEABLE_OPTIONS
+        )
+
+    @property
+    def parse_mode(self):
+        return self.kwargs.get("parse_mode", "md")
+
+    @property
+    def length(self) -> int:
+        """Length of the text, not less than Telegram counts it."""
+        text = self.args[0]
+        if self.parse_mode == "html":
+            return text_length(text)
+        return len(text.encode("utf-16-le")) // 2
+
+
+class Outbox:
+    """Queue of outgoing messages with per-chat and global pacing.
+
+    Offers send_message and send_file of TelegramClient, so handlers and
+    helpers can use either of them. The methods return as soon as the
+    message is queued, with a future of the sent message.
+
+    Args:
+        client (TelegramClient): client to send with
+        chat_interval (float): minimum seconds between messages to a chat
+        rate (float): maximum messages per second to all chats
+        max_retries (int): attempts after a transient failure
+        concurrency (int): maximum messages being sent at once
+        limit (int): maximum length of a merged message
+    """
+
+    def __init__(
+        self,
+        client,
+        chat_interval: float = 1.0,
+        rate: float = 30.0,
+        max_retries: int = 3,
+        concurrency: int = 8,
+        limit: int = MESSAGE_LIMIT,
+    ):
+        self.client = client
+        self.chat_interval = chat_interval
+        self.rate = rate
+        self.max_retries = max_retries
+        self.limit = limit
+        self.transient_errors = (
+            OSError, asyncio.TimeoutError, ServerError, TimedOutError)
+        # A chat has a queue while it is scheduled or being sent to
+        self._queues: dict = {}
+        # (due time, order, chat) of the chats waiting for their turn
+        self._schedule: list = []
+        self._order = itertools.count()
+        self._last_sent = TTLCache(maxsize=100000, ttl=chat_interval)
+        self._next_send: float = 0
+        self._paused_until: float = 0
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._sending: set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.sent: int = 0
+        self.merged: int = 0
+        self.failed: int = 0
+        self.flood_waits: int = 0
+
+    @property
+    def backlog(self) -> int:
+        """Number of messages waiting to be sent."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def start(self):
+        """Start sending queued messages."""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Wait for the queued messages to be sent and stop."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._queues and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        await asyncio.gather(
+            self._task, *self._sending, return_exceptions=True)
+        if self._queues:
+            logger.warning(f"{self.backlog} outgoing messages weren't sent")
+
+    async def send_message(self, entity, *args, **kwargs) -> asyncio.Future:
+        """Queue a message, see TelegramClient.send_message."""
+        return self._enqueue("send_message", entity, args, kwargs)
+
+    async def send_file(self, entity, *args, **kwargs) -> asyncio.Future:
+        """Queue a file, see TelegramClient.send_file."""
+        return self._enqueue("send_file", entity, args, kwargs)
+
+    def _enqueue(self, method: str, entity, args: tuple,
+                 kwargs: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._queues.get(entity)
+        if queue is None:
+            queue = self._queues[entity] = deque()
+            last = self._last_sent.get(entity)
+            now = loop.time()
+            due = now if last is None else max(now, last + self.chat_interval)
+            self._schedule_chat(entity, due)
+        queue.append(Outgoing(method, args, kwargs, future))
+        return future
+
+    def _schedule_chat(self, chat, due: float):
+        heapq.heappush(self._schedule, (due, next(self._order), chat))
+        self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            delay = None
+            if self._schedule:
+                due = max(
+                    self._schedule[0][0], self._next_send, self._paused_until)
+                delay = due - loop.time()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._slots.acquire()
+            _, _, chat = heapq.heappop(self._schedule)
+            self._next_send = loop.time() + 1 / self.rate
+            task = asyncio.create_task(self._send(chat))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _take(self, queue: deque) -> list[Outgoing]:
+        # The first message and the text messages which can follow it in
+        # the same one
+        items = [queue.popleft()]
+        if not items[0].mergeable:
+            return items
+        length = items[0].length
+        while (
+            queue
+            and queue[0].mergeable
+            and queue[0].parse_mode == items[0].parse_mode
+            # Buttons stay under the last part of a merged message
+            and "buttons" not in items[-1].kwargs
+            and length + 2 + queue[0].length <= self.limit
+        ):
+            length += 2 + queue[0].length
+            items.append(queue.popleft())
+        return items
+
+    async def _send(self, chat):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[chat]
+        items = self._take(queue)
+        first = items[0]
+        due = None
+        try:
+            with SEND_SECONDS.time(first.method):
+                if len(items) > 1:
+                    text = "\n\n".join(item.args[0] for item in items)
+                    message = await self.client.send_message(
+                        chat, text, **items[-1].kwargs)
+                    self.merged += len(items) - 1
+                else:
+                    message = await getattr(self.client, first.method)(
+                        chat, *first.args, **first.kwargs)
+
+        except FloodWaitError as e:
+            # The limit is the account's, so every chat waits
+            self.flood_waits += 1
+            self._paused_until = due = loop.time() + e.seconds
+            queue.extendleft(reversed(items))
+            logger.warning(f"Sending paused for {e.seconds} s by FloodWait")
+
+        except self.transient_errors as e:
+            first.attempts += 1
+            if first.attempts > self.max_retries:
+                self._fail(items, e)
+            else:
+                due = loop.time() + min(2 ** first.attempts, MAX_RETRY_DELAY)
+                queue.extendleft(reversed(items))
+                logger.warning(
+                    f"Retrying a message, attempt {first.attempts}: {e}")
+
+        except Exception as e:
+            self._fail(items, e)
+
+        else:
+            self.sent += 1
+            for item in items:
+                if not item.future.done():
+                    item.future.set_result(message)
+
+        finally:
+            self._slots.release()
+            self._last_sent[chat] = loop.time()
+            if queue:
+                self._schedule_chat(
+                    chat, due or loop.time() + self.chat_interval)
+            else:
+                del self._queues[chat]
+
+    def _fail(self, items: list[Outgoing], error: Exception):
+        self.failed += len(items)
+        logger.error(
+            f"Something went wrong when sending a message with an error:"
+            f" {error}")
+        for item in items:
+            if not item.future.done():
+                item.future.set_exception(error)
+                # The failure is logged, callers needn't retrieve it
+                item.future.exception()
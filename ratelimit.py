@@ -0,0 +1,124 @@
+"""Per-user token buckets in front of the bot's handlers."""
+from __future__ import annotations
+
+import functools
+import logging
+import time
+from collections import Counter
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Command classes, from the lightest on the database to the heaviest
+KINDS: tuple[str, ...] = ("cheap", "expensive", "write")
+# Seconds between sweeps of idle buckets
+SWEEP_INTERVAL: float = 60
+
+
+class Rate(NamedTuple):
+    """A bucket of ``capacity`` tokens refilled over ``period`` seconds."""
+
+    capacity: float
+    period: float
+
+    @classmethod
+    def parse(cls, value: str) -> Rate:
+        """Parse a rate written as "requests/seconds", e.g. "10/60"."""
+        capacity, period = value.split("/")
+        return cls(float(capacity), float(period))
+
+
+class RateLimiter:
+    """Token buckets of users, one per user and command class.
+
+    A bucket is a (tokens, last update, warned) tuple in a dict per class.
+    Touching a bucket moves it to the end of its dict, so the idle ones
+    gather at the front and a sweep stops at the first active bucket. A
+    bucket idle for its whole period is full and is dropped, which is
+    exactly what recreating it later gives.
+
+    Args:
+        rates (dict[str, Rate]): rate of every command class, may be set
+        later with configure, before the first request
+        on_throttled (Callable): coroutine function called with the event
+        of the first rejected request in a row, to tell the user
+        clock (Callable): source of time in seconds
+    """
+
+    def __init__(
+        self,
+        rates: Optional[dict[str, Rate]] = None,
+        on_throttled: Optional[Callable[..., Awaitable]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.on_throttled = on_throttled
+        self._clock = clock
+        self._swept = clock()
+        self.allowed: Counter = Counter()
+        self.rejected: Counter = Counter()
+        self.configure(rates or {})
+
+    def configure(self, rates: dict[str, Rate]):
+        """Set the rates of the command classes and empty the buckets."""
+        self.rates = rates
+        self._buckets: dict[str, dict[int, tuple]] = {k: {} for k in rates}
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets in self._buckets.values())
+
+    def _take(self, user_id: int, kind: str) -> tuple[bool, bool]:
+        # Returns whether the request is allowed and, if it isn't, whether
+        # it is the first rejected one since the last allowed
+        now = self._clock()
+        if now - self._swept >= SWEEP_INTERVAL:
+            self.sweep(now)
+        capacity, period = self.rates[kind]
+        buckets = self._buckets[kind]
+        tokens, stamp, warned = buckets.pop(user_id, (capacity, now, False))
+        tokens = min(capacity, tokens + (now - stamp) * capacity / period)
+        if tokens >= 1:
+            buckets[user_id] = (tokens - 1, now, False)
+            self.allowed[kind] += 1
+            return True, False
+        buckets[user_id] = (tokens, now, True)
+        self.rejected[kind] += 1
+        return False, not warned
+
+    def allow(self, user_id: int, kind: str) -> bool:
+        """Spend a user's token of a command class if there is one."""
+        return self._take(user_id, kind)[0]
+
+    def sweep(self, now: Optional[float] = None):
+        """Drop buckets which have been idle long enough to be full."""
+        now = self._clock() if now is None else now
+        self._swept = now
+        for kind, buckets in self._buckets.items():
+            period = self.rates[kind].period
+            idle = []
+            for user_id, (_, stamp, _) in buckets.items():
+                if now - stamp < period:
+                    break
+                idle.append(user_id)
+            for user_id in idle:
+                del buckets[user_id]
+
+    def limit(self, kind: str) -> Callable:
+        """Decorate an event handler to run within a command class's rate.
+
+        Args:
+            kind (str): one of KINDS
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown command class {kind}")
+
+        def decorate(handler: Callable[..., Awaitable]):
+            @functools.wraps(handler)
+            async def limited(event):
+                allowed, first = self._take(event.sender_id, kind)
+                if allowed:
+                    return await handler(event)
+                logger.info(f"Throttled {handler.__name__} of a user")
+                if first and self.on_throttled is not None:
+                    await self.on_throttled(event)
+            return limited
+        return decorate
@@ -0,0 +1,219 @@
+"""Reminders to enter outcomes of predictions whose resolution date came.
+
+There is no scheduled job per prediction: a single periodic job reads the
+index of resolution dates of predictions waiting for a reminder and puts
+the ones falling due before its next run on an in-memory heap, and one
+timer sleeps until the earliest of them. Reminders falling due together
+are sent as one message per user.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import time
+from datetime import date, datetime
+from html import escape
+from typing import Awaitable, Callable, Optional
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from pytz import utc
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Rows read per query while scanning the resolution dates
+SCAN_BATCH: int = 5000
+# Reminders claimed in one transaction
+SEND_BATCH: int = 1000
+# Predictions listed in one message, the rest are counted
+REMINDERS_SHOWN: int = 10
+
+
+def reminder_text(predictions: list[tuple[int, str, date]]) -> str:
+    """Create a reminder of a user's predictions.
+
+    Args:
+        predictions (list): (id, description, resolve_by) of the predictions
+
+    Returns:
+        str: message listing the predictions
+    """
+    lines = [
+        f"#{pred_id} {escape(description or '')} ({resolve_by:%d.%m.%Y})"
+        for pred_id, description, resolve_by in predictions[:REMINDERS_SHOWN]
+    ]
+    if len(predictions) > REMINDERS_SHOWN:
+        lines.append(f"...и ещё {len(predictions) - REMINDERS_SHOWN}")
+    return (
+        "Пора внести результаты предсказаний:\n\n"
+        + "\n".join(lines)
+        + "\n\nНажмите на кнопку <i>Результат предсказания</i> и отправьте"
+        " номер предсказания и его итог."
+    )
+
+
+class Reminders:
+    """Remind users of predictions whose resolution date came.
+
+    A prediction is marked as reminded of before its reminder is sent,
+    see Storage.claim_reminders, so restarts never repeat reminders.
+
+    Args:
+        storage (Storage): storage of the predictions
+        send (Callable): coroutine function sending a user a text
+        hour (int): local hour of the resolution date to remind at
+        scan_interval (float): seconds between scans of resolution dates
+        max_pending (int): most reminders kept in memory, the earliest
+        ones; the others are read by a later scan
+        workers (int): number of worker processes
+        worker (int): index of this process among them, it reminds only
+        the users it serves, see workers.shard
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        send: Callable[[int, str], Awaitable],
+        hour: int = 10,
+        scan_interval: float = 900,
+        max_pending: int = 100000,
+        workers: int = 1,
+        worker: int = 0,
+    ):
+        self.storage = storage
+        self.send = send
+        self.hour = hour
+        self.scan_interval = scan_interval
+        self.max_pending = max_pending
+        self.workers = workers
+        self.worker = worker
+        # (moment, id, user_id, description, resolve_by) ordered by moment
+        self._heap: list[tuple] = []
+        self._queued: set[int] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._timer: Optional[asyncio.Task] = None
+        self._scheduler: Optional[AsyncIOScheduler] = None
+        self.sent: int = 0
+
+    @property
+    def pending(self) -> int:
+        """Reminders waiting for their moment in memory."""
+        return len(self._heap)
+
+    def moment(self, resolve_by: date) -> float:
+        """Return the timestamp to remind of a resolution date at."""
+        return datetime(
+            resolve_by.year, resolve_by.month, resolve_by.day, self.hour
+        ).timestamp()
+
+    async def scan(self):
+        """Queue reminders falling due before the next scan.
+
+        Resolution dates of this worker's users are read in pages of the
+        index, earliest first, until the heap holds max_pending reminders.
+        """
+        until = date.fromtimestamp(time.time() + self.scan_interval)
+        after = (date.min, 0)
+        added = 0
+        try:
+            while len(self._heap) < self.max_pending:
+                rows = await self.storage.due_predictions(
+                    until, self.workers, self.worker, after, SCAN_BATCH)
+                for pred_id, user_id, description, resolve_by in rows:
+                    if len(self._heap) >= self.max_pending:
+                        break
+                    if pred_id in self._queued:
+                        continue
+                    heapq.heappush(self._heap, (
+                        self.moment(resolve_by), pred_id, user_id,
+                        description, resolve_by,
+                    ))
+                    self._queued.add(pred_id)
+                    added += 1
+                if len(rows) < SCAN_BATCH:
+                    break
+                after = (rows[-1][3], rows[-1][0])
+        except Exception as e:
+            logger.error(
+                f"Something went wrong when scanning resolution dates"
+                f" with an error: {e}"
+            )
+        if added:
+            logger.info(f"Queued {added} reminders, {self.pending} pending")
+            self._wake.set()
+
+    async def _send_due(self):
+        # Takes the reminders whose moment came, claims them and sends
+        # every user one message
+        now = time.time()
+        due = []
+        while (self._heap and self._heap[0][0] <= now
+               and len(due) < SEND_BATCH):
+            due.append(heapq.heappop(self._heap))
+        # Unclaimed ones are read again by the next scan
+        self._queued.difference_update(d[1] for d in due)
+        try:
+            claimed = await self.storage.claim_reminders([d[1] for d in due])
+        except Exception as e:
+            logger.error(
+                f"Something went wrong when claiming {len(due)} reminders"
+                f" with an error: {e}"
+            )
+            return
+        by_user: dict[int, list] = {}
+        for _, pred_id, user_id, description, resolve_by in due:
+            if pred_id in claimed:
+                by_user.setdefault(user_id, []).append(
+                    (pred_id, description, resolve_by))
+        for user_id, predictions in by_user.items():
+            try:
+                await self.send(user_id, reminder_text(predictions))
+                self.sent += len(predictions)
+            except Exception as e:
+                logger.error(
+                    f"Something went wrong when reminding user {user_id}"
+                    f" with an error: {e}"
+                )
+
+    async def _run(self):
+        # The single timer: sleeps until the earliest reminder or until
+        # a scan queues an earlier one
+        while True:
+            self._wake.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is not None and delay <= 0:
+                await self._send_due()
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        """Scan right away and then every scan_interval seconds."""
+        self._wake = asyncio.Event()
+        # The job runs at intervals, so the zone doesn't matter
+        self._scheduler = AsyncIOScheduler(timezone=utc)
+        self._scheduler.add_job(
+            self.scan,
+            "interval",
+            seconds=self.scan_interval,
+            next_run_time=datetime.now(utc),
+            coalesce=True,
+            max_instances=1,
+        )
+        self._scheduler.start()
+        self._timer = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop scanning and sending, queued reminders are read again."""
+        if self._scheduler is not None:
+            self._scheduler.shutdown(wait=False)
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
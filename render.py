@@ -0,0 +1,86 @@
+"""Listings of predictions packed up to Telegram's message size."""
+from __future__ import annotations
+
+import re
+from html import unescape
+
+from cachetools import LRUCache
+
+from helpers import SELECT_QUERY_HEADER, create_prediction_block
+
+# Telegram limit on a message's text after entities are parsed out
+MESSAGE_LIMIT: int = 4096
+TAG = re.compile(r"<[^>]+>")
+
+
+def text_length(html: str) -> int:
+    """Length of an HTML message as Telegram counts it.
+
+    Tags don't count, entities count as the characters they stand for
+    and every character counts as its number of UTF-16 code units.
+
+    Args:
+        html (str): message text in Telegram's HTML
+
+    Returns:
+        int: length comparable with MESSAGE_LIMIT
+    """
+    return len(unescape(TAG.sub("", html)).encode("utf-16-le")) // 2
+
+
+class Renderer:
+    """Renders predictions into listings as long as a message allows.
+
+    A prediction's block and its length are computed once per version of
+    the prediction: blocks are cached by the whole row, so any change of
+    the prediction renders it anew.
+
+    Args:
+        cache_size (int): maximum number of cached blocks
+        limit (int): maximum length of a message
+    """
+
+    def __init__(self, cache_size: int = 10000, limit: int = MESSAGE_LIMIT):
+        self._cache = LRUCache(maxsize=cache_size)
+        self.limit = limit
+        self.header_length = text_length(SELECT_QUERY_HEADER)
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def block(self, row) -> tuple[str, int]:
+        """Return a prediction's block and its length."""
+        key = tuple(row)
+        block = self._cache.get(key)
+        if block is None:
+            self.misses += 1
+            html = create_prediction_block(key)
+            block = self._cache[key] = (html, text_length(html))
+        else:
+            self.hits += 1
+        return block
+
+    def fit(self, rows: list, from_end: bool = False) -> int:
+        """Count how many rows fit in one message.
+
+        Args:
+            rows (list): predictions ordered by id
+            from_end (bool): pack the last rows rather than the first ones,
+            for pages read backwards
+
+        Returns:
+            int: number of rows starting from the first (or ending with the
+            last) one which fit, at least one
+        """
+        length = self.header_length
+        count = 0
+        for row in reversed(rows) if from_end else rows:
+            length += self.block(row)[1]
+            if length > self.limit and count:
+                break
+            count += 1
+        return count
+
+    def message(self, rows: list) -> str:
+        """Render a listing of rows which fit in a message."""
+        return SELECT_QUERY_HEADER + "".join(
+            self.block(row)[0] for row in rows)
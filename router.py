@@ -0,0 +1,122 @@
+"""Routing of incoming messages to their handlers."""
+from __future__ import annotations
+
+import re
+from typing import Awaitable, Callable, Optional, Union
+
+from telethon import events
+
+from sessions import SessionStore, State
+
+Handler = Callable[..., Awaitable]
+
+# A command, an optional @bot_name suffix and the command's arguments
+COMMAND = re.compile(r"/(\w+)(?:@\w+)?(.*)", re.S)
+
+
+class Router:
+    """Table-driven router of text messages.
+
+    Every message is classified once, in this order: an uploaded
+    document, a keyboard button by its exact text, a command by its name,
+    and otherwise the sender's conversation state. Each step is a single
+    dict lookup, so adding buttons, commands or states doesn't slow down
+    routing of any message.
+
+    Handlers of callback queries are kept here too, so that all of them
+    can be registered before there is a client, see :meth:`attach`.
+
+    Args:
+        states (SessionStore): users' conversation states, may be set
+        later but before the first message
+    """
+
+    def __init__(self, states: Optional[SessionStore] = None):
+        self.states = states
+        self._buttons: dict[str, Handler] = {}
+        self._commands: dict[str, tuple[re.Pattern, Handler]] = {}
+        self._state_handlers: dict[State, Handler] = {}
+        self._document: Optional[Handler] = None
+        self.callbacks: list[tuple[events.CallbackQuery, Handler]] = []
+
+    def button(self, *texts: str) -> Callable[[Handler], Handler]:
+        """Register a handler of keyboard buttons."""
+        def register(handler: Handler) -> Handler:
+            for text in texts:
+                self._buttons[text] = handler
+            return handler
+        return register
+
+    def command(
+        self, name: str, args: str = r"\s*$"
+    ) -> Callable[[Handler], Handler]:
+        """Register a handler of a command.
+
+        Args:
+            name (str): command with the leading slash
+            args (str): pattern the rest of the message must match, the
+            match is available to the handler as ``event.pattern_match``
+        """
+        def register(handler: Handler) -> Handler:
+            self._commands[name.lower()] = (
+                re.compile(args, re.I | re.S), handler)
+            return handler
+        return register
+
+    def state(self, *states: State) -> Callable[[Handler], Handler]:
+        """Register a handler of messages sent in the given states."""
+        def register(handler: Handler) -> Handler:
+            for state in states:
+                self._state_handlers[state] = handler
+            return handler
+        return register
+
+    def document(self, handler: Handler) -> Handler:
+        """Register the handler of uploaded files."""
+        self._document = handler
+        return handler
+
+    def callback(
+        self, data: Union[bytes, str, re.Pattern]
+    ) -> Callable[[Handler], Handler]:
+        """Register a handler of inline buttons' callback queries.
+
+        Args:
+            data: callback data or a pattern of it, the match is
+            available to the handler as ``event.data_match``
+        """
+        def register(handler: Handler) -> Handler:
+            self.callbacks.append((events.CallbackQuery(data=data), handler))
+            return handler
+        return register
+
+    def attach(self, client):
+        """Register the router and the callback handlers with a client."""
+        client.add_event_handler(self.dispatch, events.NewMessage)
+        for builder, handler in self.callbacks:
+            client.add_event_handler(handler, builder)
+
+    def resolve(self, event) -> Optional[Handler]:
+        """Find the handler of a NewMessage event or None to ignore it."""
+        message = event.message
+        if message.document is not None:
+            return self._document
+        text = message.raw_text or ""
+        handler = self._buttons.get(text)
+        if handler is not None:
+            return handler
+        match = COMMAND.match(text)
+        if match:
+            command = self._commands.get("/" + match.group(1).lower())
+            if command is not None:
+                args, handler = command
+                event.pattern_match = args.match(match.group(2))
+                return handler if event.pattern_match else None
+        # Anything else is an answer to the bot's last question
+        return self._state_handlers.get(self.states.get(event.sender_id))
+
+    async def dispatch(self, event):
+        """Pass a NewMessage event to its handler."""
+        handler = self.resolve(event)
+        if handler is not None:
+            await handler(event)
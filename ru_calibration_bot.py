@@ -1,83 +1,622 @@
-"""Telegram bot which keeps track of your predictions."""
+"""Telegram bot which keeps track of your predictions.
+
+Importing the module neither reads the configuration nor connects
+anywhere: :func:`create_app` builds the bot's parts from a
+:class:`Config` and :meth:`App.start` connects them.
+"""
 
 from __future__ import annotations
 
+import asyncio
+import csv
+import io
 import logging
 import os
 import re
 import sys
+import time
 from datetime import datetime
-from enum import Enum, auto
-from itertools import chain
-from logging.handlers import RotatingFileHandler
+from tempfile import SpooledTemporaryFile
+from typing import NamedTuple, Optional, Union
 
-import mysql.connector
 from dotenv import load_dotenv
 
 # pip install telethon
 from telethon import Button, TelegramClient, events
 
+from analytics import breakdown
+from cache import CategoryCache
+from charts import ChartRenderer
+from export import SPOOL_SIZE, export_predictions, file_name
 from helpers import (
     one_message,
-    create_message_select_query,
     create_message_categories,
-    check_click,
+    create_message_breakdown,
     err_message
 )
+from importer import MAX_FILE_SIZE, file_format, import_file
+from journal import WriteBehind
+from logs import setup_logging, traced
+from metrics import HANDLER_SECONDS, REGISTRY, Gauge, MetricsServer
+from outbox import Outbox
+from ratelimit import Rate, RateLimiter
+from reminders import Reminders
+from render import Renderer
+from router import Router
+from sessions import SessionStore, State
+from storage import Storage, create_storage
 from validators import (
-    validate_checking,
+    DATE_FORMAT,
     validate_outcome,
     validate_updating,
     validate_deletion,
+    validate_lines,
+    validate_resolution_date,
 )
+from workers import consume
+
+# Most predictions read for a page, as many of them as fit are shown
+CHUNK_SIZE: int = 30
+# Import errors listed in the reply, the rest come as a report file
+IMPORT_ERRORS_SHOWN: int = 10
+
+
+class Config(NamedTuple):
+    """Settings of the bot, see README for their environment variables."""
+
+    telegram_token: str
+    api_id: int
+    api_hash: str
+    user: str = ""
+    password: str = ""
+    host: str = ""
+    port: str = ""
+    database: str = ""
+    storage: str = "mysql"
+    sqlite_path: str = "sessions/predictions.db"
+    db_pool_min_size: int = 2
+    db_pool_max_size: int = 10
+    db_acquire_timeout: float = 10
+    write_behind: bool = False
+    journal_path: str = "sessions/journal.log"
+    category_cache_size: int = 10000
+    category_cache_ttl: float = 600
+    session_store_size: int = 10000
+    session_ttl: float = 3600
+    sessions_path: str = "sessions/drafts.json"
+    render_cache_size: int = 10000
+    chart_cache_dir: str = "sessions/charts"
+    chart_workers: int = 2
+    # Requests a user may make per number of seconds, by command class
+    rate_limit_cheap: str = "30/60"
+    rate_limit_expensive: str = "10/60"
+    rate_limit_write: str = "20/60"
+    outbox_chat_interval: float = 1
+    outbox_rate: float = 30
+    outbox_retries: int = 3
+    # Set for the processes workers.py starts
+    worker_index: Optional[int] = None
+    workers: int = 1
+    sessions_db: str = "sessions/sessions.db"
+    # Port of /metrics and /healthz, 0 turns them off
+    metrics_port: int = 8000
+    metrics_address: str = ""
+    session_name: str = "sessions/Bot"
+    log_path: str = "main.log"
+    # Share of debug records written to the log
+    log_debug_sample: float = 0.1
+    # Reminders of predictions whose resolution date came
+    reminders: bool = True
+    reminder_hour: int = 10
+    reminder_scan_interval: float = 900
+    reminder_max_pending: int = 100000
+
+    @classmethod
+    def from_env(
+        cls, worker_index: Optional[int] = None,
+        workers: Optional[int] = None,
+    ) -> Config:
+        """Read the settings from the environment and the .env file.
+
+        Args:
+            worker_index (int): index of the worker process to configure,
+            None for the bot receiving its own updates
+            workers (int): number of worker processes, WORKERS by default
+        """
+        load_dotenv()
+        config = cls(
+            telegram_token=os.getenv("TELEGRAM_TOKEN", ""),
+            api_id=int(os.getenv("API_ID", 0)),
+            api_hash=os.getenv("API_HASH", ""),
+            user=str(os.getenv("USER")),
+            password=str(os.getenv("PASSWORD")),
+            host=str(os.getenv("HOST")),
+            port=str(os.getenv("PORT")),
+            database=str(os.getenv("DATABASE")),
+            storage=str(os.getenv("STORAGE", "mysql")),
+            sqlite_path=str(
+                os.getenv("SQLITE_PATH", "sessions/predictions.db")),
+            db_pool_min_size=int(os.getenv("DB_POOL_MIN_SIZE", 2)),
+            db_pool_max_size=int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+            db_acquire_timeout=float(os.getenv("DB_ACQUIRE_TIMEOUT", 10)),
+            write_behind=os.getenv("WRITE_BEHIND", "0") == "1",
+            journal_path=str(
+                os.getenv("JOURNAL_PATH", "sessions/journal.log")),
+            category_cache_size=int(os.getenv("CATEGORY_CACHE_SIZE", 10000)),
+            category_cache_ttl=float(os.getenv("CATEGORY_CACHE_TTL", 600)),
+            session_store_size=int(os.getenv("SESSION_STORE_SIZE", 10000)),
+            session_ttl=float(os.getenv("SESSION_TTL", 3600)),
+            sessions_path=str(
+                os.getenv("SESSIONS_PATH", "sessions/drafts.json")),
+            render_cache_size=int(os.getenv("RENDER_CACHE_SIZE", 10000)),
+            chart_cache_dir=str(
+                os.getenv("CHART_CACHE_DIR", "sessions/charts")),
+            chart_workers=int(os.getenv("CHART_WORKERS", 2)),
+            rate_limit_cheap=str(os.getenv("RATE_LIMIT_CHEAP", "30/60")),
+            rate_limit_expensive=str(
+                os.getenv("RATE_LIMIT_EXPENSIVE", "10/60")),
+            rate_limit_write=str(os.getenv("RATE_LIMIT_WRITE", "20/60")),
+            outbox_chat_interval=float(
+                os.getenv("OUTBOX_CHAT_INTERVAL", 1)),
+            outbox_rate=float(os.getenv("OUTBOX_RATE", 30)),
+            outbox_retries=int(os.getenv("OUTBOX_RETRIES", 3)),
+            workers=(
+                int(os.getenv("WORKERS", 1)) if workers is None else workers),
+            sessions_db=str(
+                os.getenv("SESSIONS_DB", "sessions/sessions.db")),
+            metrics_port=int(os.getenv("METRICS_PORT", 8000)),
+            metrics_address=str(os.getenv("METRICS_ADDRESS", "")),
+            log_debug_sample=float(os.getenv("LOG_DEBUG_SAMPLE", 0.1)),
+            reminders=os.getenv("REMINDERS", "1") == "1",
+            reminder_hour=int(os.getenv("REMINDER_HOUR", 10)),
+            reminder_scan_interval=float(
+                os.getenv("REMINDER_SCAN_INTERVAL", 900)),
+            reminder_max_pending=int(
+                os.getenv("REMINDER_MAX_PENDING", 100000)),
+        )
+        if worker_index is None:
+            return config
+        # Every worker logs in with its own session and writes its own files
+        return config._replace(
+            worker_index=worker_index,
+            session_name=f"sessions/Bot_{worker_index}",
+            log_path=f"main_{worker_index}.log",
+            journal_path=f"{config.journal_path}.{worker_index}",
+            # The bot's overall limit is shared by the workers
+            outbox_rate=config.outbox_rate / config.workers,
+            metrics_port=(
+                config.metrics_port + worker_index
+                if config.metrics_port else 0),
+        )
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Parts of the bot the handlers use, built by create_app
+client: Optional[TelegramClient] = None
+# Replies are queued and sent in the background
+outbox: Optional[Outbox] = None
+category_cache: Optional[CategoryCache] = None
+# Connections are opened on start, each handler borrows one per query
+storage: Optional[Storage] = None
+# Mutations go either straight to the database or through the journal
+writer: Union[Storage, WriteBehind, None] = None
+renderer: Optional[Renderer] = None
+charts: Optional[ChartRenderer] = None
+# The state in which different users are, {user_id: state}, along with
+# their drafts of new predictions
+conversation_state: Optional[SessionStore] = None
+reminders: Optional[Reminders] = None
+
+
+async def report_rejected(who: int, op: str, pred_id, failed: bool = False):
+    """Tell a user a journaled change wasn't made.
+
+    Args:
+        who (int): user's id
+        op (str): journaled operation
+        pred_id: prediction's id the user gave, None for a new one
+        failed (bool): the change failed with an error rather than didn't
+        match the user's predictions
+    """
+    if failed:
+        await outbox.send_message(
+            who,
+            "Предсказание не было сохранено из-за ошибки. Пожалуйста,"
+            " внесите его повторно."
+            if op == "add" else
+            f"Изменение предсказания с номером {pred_id} не было внесено"
+            " из-за ошибки. Пожалуйста, попробуйте ещё раз.",
+        )
+        logger.info(f"Journaled {op} of prediction {pred_id} failed")
+        return
+    await outbox.send_message(
+        who,
+        (
+            f"Изменение предсказания с номером {pred_id} не было внесено:"
+            " номер не совпадает ни с одним из сделанных Вами предсказаний."
+        ),
+    )
+    logger.info(f"Journaled {op} of prediction {pred_id} was rejected")
+
+
+async def slow_down(event):
+    """Tell a user their requests come too fast.
+
+    Args:
+        event (EventCommon): NewMessage or CallbackQuery event
+    """
+    text = (
+        "Вы отправляете запросы слишком часто. Пожалуйста, подождите"
+        " немного и попробуйте еще раз."
+    )
+    if isinstance(event, events.CallbackQuery.Event):
+        await event.answer(text, alert=True)
+    else:
+        await outbox.send_message(event.chat_id, text)
+
+
+# Reads which hit the database hard, such as listings, and writes are
+# limited separately from cheap prompts; create_app sets the rates
+limiter = RateLimiter(on_throttled=slow_down)
+
+# Every text message goes through the router, callback queries too are
+# registered with it and passed to the client by create_app
+router = Router()
+
+# Records made while handling an update carry its user, state and handler
+handled = traced(lambda user_id: conversation_state.peek(user_id))
+
+
+async def telegram_ready() -> bool:
+    """Check that the client is connected to Telegram."""
+    return client.is_connected()
+
+
+def register_metrics(write_behind: bool, reminding: bool):
+    """Expose the state of the bot's parts, read on every scrape."""
+    for metric in (
+        Gauge(
+            "bot_conversations",
+            "Users in a conversation by their state.",
+            lambda: conversation_state.count_states(),
+            label="state",
+        ),
+        Gauge(
+            "bot_cache_hits_total",
+            "Lookups answered from a cache.",
+            lambda: {
+                "categories": category_cache.hits,
+                "render": renderer.hits,
+                "charts": charts.hits,
+            },
+            label="cache",
+            kind="counter",
+        ),
+        Gauge(
+            "bot_cache_misses_total",
+            "Lookups a cache couldn't answer.",
+            lambda: {
+                "categories": category_cache.misses,
+                "render": renderer.misses,
+                "charts": charts.misses,
+            },
+            label="cache",
+            kind="counter",
+        ),
+        Gauge(
+            "bot_db_connections",
+            "Database connections in use, opened and allowed.",
+            lambda: dict(
+                zip(("in_use", "open", "max"), storage.pool_usage())),
+            label="state",
+        ),
+        Gauge(
+            "bot_requests_allowed_total",
+            "Requests let through by the rate limiter.",
+            lambda: dict(limiter.allowed),
+            label="kind",
+            kind="counter",
+        ),
+        Gauge(
+            "bot_requests_throttled_total",
+            "Requests rejected by the rate limiter.",
+            lambda: dict(limiter.rejected),
+            label="kind",
+            kind="counter",
+        ),
+        Gauge(
+            "bot_outbox_backlog",
+            "Messages waiting to be sent.",
+            lambda: outbox.backlog,
+        ),
+        Gauge(
+            "bot_outbox_messages_total",
+            "Outgoing messages by their fate.",
+            lambda: {
+                "sent": outbox.sent,
+                "merged": outbox.merged,
+                "failed": outbox.failed,
+            },
+            label="result",
+            kind="counter",
+        ),
+        Gauge(
+            "bot_flood_waits_total",
+            "FloodWait errors from Telegram.",
+            lambda: outbox.flood_waits,
+            kind="counter",
+        ),
+    ):
+        REGISTRY.add(metric)
+    if write_behind:
+        REGISTRY.add(Gauge(
+            "bot_journal_backlog",
+            "Journaled changes not yet in the database.",
+            lambda: writer.backlog,
+        ))
+    if reminding:
+        REGISTRY.add(Gauge(
+            "bot_reminders_pending",
+            "Reminders waiting for their moment in memory.",
+            lambda: reminders.pending,
+        ))
+        REGISTRY.add(Gauge(
+            "bot_reminders_sent_total",
+            "Predictions users were reminded of.",
+            lambda: reminders.sent,
+            kind="counter",
+        ))
+
+
+def create_storage_from(
+    config: Config, cache: Optional[CategoryCache] = None
+) -> Storage:
+    """Create the configured storage backend, not opened yet."""
+    if config.storage == "sqlite":
+        return create_storage(
+            config.storage,
+            cache,
+            path=config.sqlite_path,
+            maxsize=config.db_pool_max_size,
+            acquire_timeout=config.db_acquire_timeout,
+        )
+    options = dict(
+        host=config.host,
+        user=config.user,
+        password=config.password,
+        database=config.database,
+        minsize=config.db_pool_min_size,
+        maxsize=config.db_pool_max_size,
+        acquire_timeout=config.db_acquire_timeout,
+    )
+    if config.storage == "postgres":
+        options["port"] = int(config.port) if config.port.isdigit() else None
+    return create_storage(config.storage, cache, **options)
+
 
-load_dotenv()
+class App:
+    """The bot's parts built by create_app.
 
-TELEGRAM_TOKEN: str = str(os.getenv("TELEGRAM_TOKEN"))
-API_HASH: str = str(os.getenv("API_HASH"))
-API_ID: int = int(os.getenv("API_ID"))
-USER: str = str(os.getenv("USER"))
-PASSWORD: str = str(os.getenv("PASSWORD"))
-HOST: str = str(os.getenv("HOST"))
-PORT: str = str(os.getenv("PORT"))
-DATABASE: str = str(os.getenv("DATABASE"))
+    Args:
+        config (Config): settings the parts were built with
+        client (TelegramClient): client with the handlers registered
+        storage (Storage): storage, not opened yet
+        writer (Storage | WriteBehind): where mutations go
+        outbox (Outbox): queue of replies
+        sessions (SessionStore): users' conversations
+        charts (ChartRenderer): renderer of calibration charts
+        metrics_server (MetricsServer): server of /metrics and /healthz
+        reminders (Reminders): reminders of due predictions, None if they
+        are turned off
+    """
 
-SESSION_NAME: str = "sessions/Bot"
-CHUNK_SIZE: int = 10
-COUNTER: int = None
-TEXT: dict = {}
+    def __init__(
+        self,
+        config: Config,
+        client: TelegramClient,
+        storage: Storage,
+        writer: Union[Storage, WriteBehind],
+        outbox: Outbox,
+        sessions: SessionStore,
+        charts: ChartRenderer,
+        metrics_server: MetricsServer,
+        reminders: Optional[Reminders] = None,
+    ):
+        self.config = config
+        self.client = client
+        self.storage = storage
+        self.writer = writer
+        self.outbox = outbox
+        self.sessions = sessions
+        self.charts = charts
+        self.metrics_server = metrics_server
+        self.reminders = reminders
+        self.router = router
+
+    async def _warm_up(self) -> list[int]:
+        # Opens the pool's first connections and brings the schema up to
+        # date, return the applied migrations
+        await self.storage.open()
+        return await self.storage.migrate()
+
+    async def start(self) -> dict[str, float]:
+        """Connect to Telegram and the database and start serving.
+
+        Logging in to Telegram and warming the database up don't depend
+        on each other, so they run concurrently.
+
+        Returns:
+            dict[str, float]: seconds every step of the startup took
+        """
+        timings: dict[str, float] = {}
+
+        async def step(name: str, coro):
+            begin = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                timings[name] = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        _, applied = await asyncio.gather(
+            step("telegram", self.client.start(
+                bot_token=self.config.telegram_token)),
+            step("database", self._warm_up()),
+        )
+        if applied:
+            logger.info(f"Applied migrations: {applied}")
+        logger.info("All tables are ready")
+        sessions_begin = time.perf_counter()
+        self.sessions.load()
+        timings["sessions"] = time.perf_counter() - sessions_begin
+        if self.config.write_behind:
+            await step("journal", self.writer.start())
+        await step("outbox", self.outbox.start())
+        if self.reminders is not None:
+            await step("reminders", self.reminders.start())
+        if self.config.metrics_port:
+            await step("metrics", self.metrics_server.start())
+        timings["total"] = time.perf_counter() - begin
+        logger.info(
+            f"Started in {timings['total']:.2f} s: "
+            + ", ".join(
+                f"{name} {seconds:.2f} s"
+                for name, seconds in timings.items() if name != "total")
+        )
+        return timings
+
+    async def stop(self, timeout: float = 10.0):
+        """Send what's left in time and disconnect from everything.
+
+        Args:
+            timeout (float): seconds to wait for the queued replies
+        """
+        if self.reminders is not None:
+            await self.reminders.stop()
+        await self.outbox.stop(timeout)
+        await self.client.disconnect()
+        if self.config.write_behind:
+            await self.writer.stop()
+        self.metrics_server.stop()
+        await self.storage.close()
+        self.sessions.save()
+        self.charts.close()
+
+    def run(self, updates=None):
+        """Start, serve until disconnected and stop.
+
+        Args:
+            updates (multiprocessing.Queue): updates handed over by the
+            front process, see workers.py; the bot receives its own
+            updates without it
+        """
+        loop = self.client.loop
+        loop.run_until_complete(self.start())
+        if updates is None:
+            logger.info("Bot Started...")
+            self.client.run_until_disconnected()
+            # The client is disconnected by now, what's left can't be sent
+            loop.run_until_complete(self.stop(timeout=0))
+        else:
+            logger.info(f"Worker {self.config.worker_index} Started...")
+            loop.run_until_complete(consume(self.client, updates))
+            loop.run_until_complete(self.stop())
 
-# Start the Client (telethon)
-client = TelegramClient(SESSION_NAME, API_ID, API_HASH).start(
-    bot_token=TELEGRAM_TOKEN)
 
+def create_app(
+    config: Config, telegram_client: Optional[TelegramClient] = None
+) -> App:
+    """Build the bot's parts and register the handlers.
 
-class State(Enum):
-    """User' states."""
+    Nothing is connected until App.start. The module's parts the
+    handlers use are set, so there is one bot per process.
 
-    WAIT_CHECK = auto()
-    WAIT_UPDATE = auto()
-    WAIT_ENTER = auto()
-    WAIT_DELETE = auto()
-    WAIT_ADD_PREDICTION = auto()
-    WAIT_ADD_CATEGORY = auto()
-    WAIT_ADD_UNIT = auto()
-    WAIT_ADD_LOW_50 = auto()
-    WAIT_ADD_HI_50 = auto()
-    WAIT_ADD_LOW_90 = auto()
-    WAIT_ADD_HI_90 = auto()
+    Args:
+        config (Config): settings
+        telegram_client (TelegramClient): client to use instead of a new
+        one, e.g. a stand-in which doesn't connect anywhere
 
+    Returns:
+        App: the bot, not started yet
+    """
+    global client, outbox, category_cache, storage, writer, renderer
+    global charts, conversation_state, reminders
+
+    # Workers get updates from the front process
+    client = telegram_client or TelegramClient(
+        config.session_name,
+        config.api_id,
+        config.api_hash,
+        receive_updates=config.worker_index is None,
+    )
+    outbox = Outbox(
+        client,
+        config.outbox_chat_interval,
+        config.outbox_rate,
+        config.outbox_retries,
+    )
+    category_cache = CategoryCache(
+        config.category_cache_size, config.category_cache_ttl)
+    storage = create_storage_from(config, category_cache)
+    writer = WriteBehind(
+        storage,
+        config.journal_path,
+        name=(
+            "default" if config.worker_index is None
+            else f"worker{config.worker_index}"),
+        on_rejected=report_rejected,
+    ) if config.write_behind else storage
+    renderer = Renderer(config.render_cache_size)
+    charts = ChartRenderer(config.chart_cache_dir, config.chart_workers)
+    conversation_state = SessionStore(
+        config.session_store_size,
+        config.session_ttl,
+        config.sessions_path or None,
+        # Workers share conversations, so that users survive a restart
+        shared_path=(
+            config.sessions_db if config.worker_index is not None else None),
+    )
 
-# The state in which different users are, {user_id: state}
-conversation_state = {}
+    reminders = Reminders(
+        storage,
+        lambda user_id, text: outbox.send_message(
+            user_id, text, parse_mode="html"),
+        config.reminder_hour,
+        config.reminder_scan_interval,
+        config.reminder_max_pending,
+        # Every worker reminds the users it serves
+        workers=1 if config.worker_index is None else config.workers,
+        worker=config.worker_index or 0,
+    ) if config.reminders else None
+
+    limiter.configure({
+        "cheap": Rate.parse(config.rate_limit_cheap),
+        "expensive": Rate.parse(config.rate_limit_expensive),
+        "write": Rate.parse(config.rate_limit_write),
+    })
+    router.states = conversation_state
+    router.attach(client)
+    register_metrics(config.write_behind, config.reminders)
+    metrics_server = MetricsServer(
+        config.metrics_port,
+        config.metrics_address,
+        checks={"database": storage.ping, "telegram": telegram_ready},
+    )
+    return App(
+        config, client, storage, writer, outbox, conversation_state, charts,
+        metrics_server, reminders)
 
 
-def check_tokens() -> bool:
-    """Check availability of global variables."""
-    return all((TELEGRAM_TOKEN, API_HASH, API_ID))
+def check_tokens(config: Config) -> bool:
+    """Check availability of the credentials."""
+    return all((config.telegram_token, config.api_hash, config.api_id))
 
 
-@client.on(events.NewMessage(pattern="(?i)/start"))
+@router.command("/start", args=r".*")
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("cheap")
 async def start(event):
     """Initialize the bot and show keyboard to a user.
 
@@ -111,11 +650,14 @@ async def start(event):
         " пользоваться</i>. За ней Вы найдете краткую инструкцию к данному"
         " боту."
     )
-    await client.send_message(SENDER, text, buttons=markup, parse_mode="html")
+    await outbox.send_message(SENDER, text, buttons=markup, parse_mode="html")
     logger.info("Looks like we have a new user!", exc_info=1)
 
 
-@client.on(events.NewMessage(pattern="Как"))
+@router.button("Как пользоваться")
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("cheap")
 async def guide(event):
     """Show to a user 'help page'.
 
@@ -147,18 +689,28 @@ async def guide(event):
             " предсказание</i> и затем внесите Ваше предсказание заново;\n\n"
             f"{SMILE_MAIN} <b>После того как Вы узнали, чем в реальности"
             " обернулись предсказанные Вами события</b> - нажмите на кнопку"
-            " <i>Результат предсказания</i>;\n\n"
+            " <i>Результат предсказания</i>. Если при добавлении"
+            " предсказания указать дату, когда станет известен результат,"
+            " бот в этот день напомнит его внести;\n\n"
             f"{SMILE_MAIN} <b>Наконец, для того, чтобы уточнить свою"
             " калибровку на основе внесенных ранее предсказаний с"
             " известным исходом</b> - нажмите на кнопку <i>Проверить"
             " калибровку</i> и следуйте дальнейшим инструкциям;\n\n"
+            f"{SMILE_MAIN} <b>Чтобы выгрузить все свои предсказания"
+            " файлом</b> - отправьте команду /export (CSV) или /export"
+            " jsonl, добавьте gz, чтобы получить сжатый файл. Такой же"
+            " файл можно загрузить обратно, чтобы добавить много"
+            " предсказаний сразу; файл со столбцами id и actual_outcome"
+            " вносит результаты предсказаний;\n\n"
+            f"{SMILE_MAIN} <b>Чтобы увидеть график своей калибровки</b> -"
+            " отправьте команду /chart;\n\n"
             f"{SMILE_INFO} Если же, по какой-то причине, Вы начали"
             " пользоваться данным ботом и ощутили желание поучаствовать в"
             " улучшении его фунциональности или высказать автору что за полный"
             " отстой он создал (даже в змейку не поиграешь) - отправьте мне"
             " письмо по адресу kubanez74@gmail.com."
         )
-        await event.respond(text, parse_mode="html")
+        await outbox.send_message(event.chat_id, text, parse_mode="html")
 
     except Exception as e:
         logger.error(
@@ -168,7 +720,10 @@ async def guide(event):
         return
 
 
-@client.on(events.NewMessage(pattern="Мои"))
+@router.button("Мои категории")
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("cheap")
 async def display_categories(event):
     """Show to a user their unique categories.
 
@@ -180,20 +735,16 @@ async def display_categories(event):
     try:
         sender = await event.get_sender()
         SENDER = sender.id
-        query = (
-            "SELECT DISTINCT task_category FROM"
-            " predictions.raw_predictions WHERE user_id = %s"
-        )
-        crsr.execute(query, [SENDER])
-        res = crsr.fetchall()  # fetch all the results
+        res = await storage.categories(SENDER)
         # If there is at least 1 row selected, print a message with the list
         # of all predictions
         if res:
-            text = create_message_categories(res)
-            await client.send_message(SENDER, text, parse_mode="html")
+            text = create_message_categories(sorted(res))
+            await outbox.send_message(SENDER, text, parse_mode="html")
         # Otherwhise, print a default text
         else:
-            err_message(client, parse_mode='html', del_state=False)
+            await err_message(
+                outbox, SENDER, parse_mode='html', del_state=False)
             logger.debug(
                 "Someone tried to have a look at their categories"
                 " without any made predictions."
@@ -207,540 +758,647 @@ async def display_categories(event):
         return
 
 
-# Detail view block: update, delete, list, enter outcome methods
-@client.on(events.NewMessage(pattern=validate_checking))
-async def CUEDhandler(event):
-    """Handle update, delete, list, create and enter outcome methods.
+@router.command("/export", args=r"(?:\s+(csv|jsonl))?(?:\s+(gz))?\s*$")
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("expensive")
+async def export(event):
+    """Send a user all their predictions as a CSV or JSON Lines file.
 
-    We check what message we've got and change a user's state.
-    If the message isn't trigger state's change and a user alreade
-    has a state we process given message in a subsequent method
-    below.
+    Usage: /export [csv|jsonl] [gz]
 
     Args:
         event (EventCommon): NewMessage event
     """
-    sender = await event.get_sender()
-    who = sender.id
-    mes = event.message.raw_text
-    global TEXT
+    try:
+        sender = await event.get_sender()
+        SENDER = sender.id
+        fmt = (event.pattern_match.group(1) or "csv").lower()
+        compress = event.pattern_match.group(2) is not None
+        file, count = await export_predictions(
+            storage, SENDER, fmt, compress)
+        with file:
+            if not count:
+                await err_message(outbox, SENDER, del_state=False)
+                return
+            uploaded = await client.upload_file(
+                file, file_name=file_name(fmt, compress))
+            await outbox.send_file(
+                SENDER,
+                uploaded,
+                force_document=True,
+                caption=f"Выгружено предсказаний: {count}",
+            )
+        logger.info(f"Exported {count} predictions as {fmt}")
+
+    except Exception as e:
+        logger.error(
+            "Something went wrong when exporting user's predictions "
+            f"with an error: {e}"
+        )
+        return
 
-    # CHECK CALIBRATION
-    if re.match(r"Проверить", mes):
-        conversation_state[who] = State.WAIT_CHECK
+
+@router.document
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("write")
+async def import_predictions(event):
+    """Import predictions or outcomes from an uploaded file.
+
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    try:
+        sender = await event.get_sender()
+        SENDER = sender.id
+        name = event.file.name
+        if file_format(name) is None:
+            await outbox.send_message(
+                SENDER,
+                (
+                    "Загрузить можно файл .csv или .jsonl (можно сжатый,"
+                    " .csv.gz или .jsonl.gz) в формате команды /export."
+                ),
+            )
+            return
+        if event.file.size > MAX_FILE_SIZE:
+            await outbox.send_message(
+                SENDER,
+                (
+                    "Файл слишком большой, разделите его на части не более"
+                    f" {MAX_FILE_SIZE // (1024 * 1024)} МБ."
+                ),
+            )
+            return
+        with SpooledTemporaryFile(max_size=SPOOL_SIZE) as file:
+            await client.download_media(event.message, file=file)
+            file.seek(0)
+            report = await import_file(writer, SENDER, file, name)
+
+        errors = [(line, error) for line, error in report if error]
         text = (
+            f"Обработано строк: {len(report)}, успешно:"
+            f" {len(report) - len(errors)}, с ошибками: {len(errors)}."
+        )
+        if errors:
+            text += "\n\n" + "\n".join(
+                f"Строка {line}: {error}" if line else error
+                for line, error in errors[:IMPORT_ERRORS_SHOWN]
+            )
+        await outbox.send_message(SENDER, text)
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            rows = io.StringIO()
+            report_csv = csv.writer(rows)
+            report_csv.writerow(("line", "status"))
+            report_csv.writerows(
+                (line or "", error or "ok") for line, error in report)
+            uploaded = await client.upload_file(
+                rows.getvalue().encode(), file_name="import_report.csv")
+            await outbox.send_file(
+                SENDER,
+                uploaded,
+                force_document=True,
+                caption="Отчет по каждой строке файла",
+            )
+        logger.info(
+            f"Imported {len(report) - len(errors)} rows, {len(errors)} failed")
+
+    except Exception as e:
+        logger.error(
+            "Something went wrong when importing user's predictions "
+            f"with an error: {e}"
+        )
+        return
+
+
+@router.command("/chart")
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("expensive")
+async def chart(event):
+    """Send a user the chart of their calibration.
+
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    try:
+        sender = await event.get_sender()
+        SENDER = sender.id
+        path = await charts.chart(storage, SENDER)
+        if path is None:
+            await err_message(
+                outbox,
+                SENDER,
+                mess=(
+                    "У Вас нет ни одного предсказания с известным"
+                    " исходом. Построить график пока не из чего."
+                ),
+                del_state=False,
+            )
+            return
+        await outbox.send_file(
+            SENDER,
+            path,
+            caption=(
+                "Доля исходов, попавших в 50% и 90% интервалы, по категориям"
+                " и по месяцам."
+            ),
+        )
+
+    except Exception as e:
+        logger.error(
+            "Something went wrong when drawing user's chart "
+            f"with an error: {e}"
+        )
+        return
+
+
+async def not_owned(who: int):
+    """Tell a user the prediction they referred to isn't theirs.
+
+    Mutations affect no rows both for a stranger's prediction and when
+    a user has no predictions at all, the latter is told apart here.
+
+    Args:
+        who (int): user's id
+    """
+    if not await storage.has_predictions(who):
+        await err_message(outbox, who, state_dict=conversation_state)
+        return
+    await err_message(
+        outbox,
+        who,
+        mess=(
+            "Номер предсказания не совпадает ни с одним из"
+            " сделанных Вами предсказаний. Пожалуйста"
+            " внесите корректный номер."
+        ),
+        state_dict=conversation_state)
+
+
+# Prompts of the buttons starting a conversation and the states they set
+BUTTON_STATES: dict[str, tuple[State, str]] = {
+    "Проверить калибровку": (
+        State.WAIT_CHECK,
+        (
             "Если Вы хотели бы проверить общую калибровку по всем сделанным"
-            " предсказаниям - отправьте слово общая.\n\n Если Вас интересует"
+            " предсказаниям вместе с калибровкой по каждой категории -"
+            " отправьте слово общая.\n\n Если Вас интересует"
             " калибровка по какой-то отдельной категории - отправьте"
             " название данной категории. Например, можно отправить <общая>"
             " или <работа> или <политика> без кавычек и/или знаков препинания."
-        )
-        await event.respond(text)
-        return
-
-    if re.match(r"Обновить", mes):
-        conversation_state[who] = State.WAIT_UPDATE
-        text = (
+        ),
+    ),
+    "Обновить предсказание": (
+        State.WAIT_UPDATE,
+        (
             "Для того, чтобы обновить ранее внесенное предсказание ("
             "изменить нижнюю и верхнюю границу предсказанного значения),"
             " обычно в свете нового знания, внесите номер предсказания,"
             " которое Вы желаете обновить и затем 4 цифры, разделенные"
             " точкой с запятой и пробелом - новую нижнюю и верхнюю границы"
             " для 50% и 90% уровней уверенности.\n\nНапример: 1; 3; 5; 1; 8"
-        )
-        await event.respond(text)
-        return
-
-    if re.match(r"Результат", mes):
-        conversation_state[who] = State.WAIT_ENTER
-        text = (
+            "\n\nЧтобы обновить несколько предсказаний сразу, отправьте"
+            " по одному на каждой строке."
+        ),
+    ),
+    "Результат предсказания": (
+        State.WAIT_ENTER,
+        (
             "Для того чтобы внести результат предсказания, отправьте две"
             " цифры - номер предсказания и итог, например - <17; 0.00008>"
-            " без кавычек."
+            " без кавычек. Результаты нескольких предсказаний можно"
+            " отправить одним сообщением, по одному на каждой строке."
+        ),
+    ),
+    "Удалить предсказание": (
+        State.WAIT_DELETE,
+        (
+            "Для того, чтобы удалить ранее сделанное предсказание,"
+            " отправьте его номер в ответном сообщении. Чтобы удалить"
+            " несколько предсказаний, отправьте их номера по одному на"
+            " каждой строке."
+        ),
+    ),
+    "Добавить предсказание": (
+        State.WAIT_ADD_PREDICTION,
+        (
+            "Отправьте текст предсказания - что должно произойти, по"
+            " Вашему мнению.\n\nДалее следуйте подсказкам"
+        ),
+    ),
+}
+
+BLACK_HEART: str = "\U0001F5A4"
+SMILE_INFO: str = "\U00002139"
+# Steps of the add wizard: the draft's field the answer goes to, the next
+# state and its prompt; the last step asks to confirm the prediction
+ADD_STEPS: dict[State, tuple[str, Optional[State], Optional[str]]] = {
+    State.WAIT_ADD_PREDICTION: (
+        "prediction",
+        State.WAIT_ADD_CATEGORY,
+        (
+            "Отправьте категорию предсказания для того, чтобы у Вас"
+            " была возможность уточнить свою калибровку не только по"
+            " всем сохраненным предсказаниям, но и по отдельной"
+            f" категории.\n\n{SMILE_INFO}Это может быть полезно,"
+            " т.к. мы можем быть одновременно великолепно калиброваны"
+            " во всех, например, рабочих вопросах, но быть ужасно"
+            " калиброваны в вопросах касающихся взаимоотношений"
+            f" с людьми{BLACK_HEART}\n\nДля того, чтобы иметь"
+            " возможность совершенствоваться, нужно понимать, в"
+            " какой сфере мы не совершенны. Отправьте одно слово,"
+            " характеризующее категорию."
+        ),
+    ),
+    State.WAIT_ADD_CATEGORY: (
+        "category",
+        State.WAIT_ADD_UNIT,
+        (
+            "В будущем может так случиться, что Вы захотите узнать"
+            " в каких единицах Вы вносили данное предсказание. Чтобы"
+            " такая возможность у Вас была - отправьте одно слово,"
+            " обозначающее единицу измерения. Например: час, день,"
+            " ребёнки."
+        ),
+    ),
+    State.WAIT_ADD_UNIT: (
+        "unit",
+        State.WAIT_ADD_LOW_50,
+        (
+            "Отправьте число, соответствующее нижней границе, которую"
+            " может принять предсказанная величина с уверенностью"
+            " в 50%. Одно число и ничего более."
+        ),
+    ),
+    State.WAIT_ADD_LOW_50: (
+        "low_50",
+        State.WAIT_ADD_HI_50,
+        (
+            "Отправьте число, соответствующее верхней границе, которую"
+            " может принять предсказанная величина с уверенностью"
+            " в 50%. Одно число и ничего более."
+        ),
+    ),
+    State.WAIT_ADD_HI_50: (
+        "hi_50",
+        State.WAIT_ADD_LOW_90,
+        (
+            "Отправьте число, соответствующую нижней границе, которую"
+            " может принять предсказанная величина с уверенностью"
+            " в 90%. Одно число и ничего более."
+        ),
+    ),
+    State.WAIT_ADD_LOW_90: (
+        "low_90",
+        State.WAIT_ADD_HI_90,
+        (
+            "Отправьте цифру, соответствующую верхней границе, которую"
+            " может принять предсказанная величина с уверенностью"
+            " в 90%. Одна цифра и ничего более."
+        ),
+    ),
+    State.WAIT_ADD_HI_90: (
+        "hi_90",
+        State.WAIT_ADD_RESOLVE_BY,
+        (
+            "Отправьте дату, когда станет известен результат, в формате"
+            " ДД.ММ.ГГГГ - в этот день бот напомнит Вам его внести."
+            " Отправьте -, если напоминание не нужно."
+        ),
+    ),
+    State.WAIT_ADD_RESOLVE_BY: ("resolve_by", None, None),
+}
+
+
+@router.button(*BUTTON_STATES)
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("cheap")
+async def enter_state(event):
+    """Start a conversation by a button and prompt a user for the input.
+
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    state, text = BUTTON_STATES[event.message.raw_text]
+    conversation_state[event.sender_id] = state
+    await outbox.send_message(event.chat_id, text)
+
+
+# CHECK CALIBRATION
+@router.state(State.WAIT_CHECK)
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("expensive")
+async def check_calibration(event):
+    """Show a user their calibration overall or in a category.
+
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    who = event.sender_id
+    mes = event.message.raw_text.lower()
+    categories = await storage.categories(who)
+    # If there is no categories yet, print a warning
+    if not categories:
+        await err_message(outbox, who, parse_mode="html",
+                          state_dict=conversation_state)
+        return
+    if mes != "общая" and mes not in categories:
+        await err_message(
+            outbox, who, state_dict=conversation_state,
+            mess=(
+                "Вы не создали ни одного предсказания в данной"
+                " категории."
+            ))
+        logger.info(
+            "Someone tried to get a list of categories"
+            " but have not made any themselves."
         )
-        await event.respond(text)
         return
 
-    if re.match(r"Удалить", mes):
-        conversation_state[who] = State.WAIT_DELETE
-        text = (
-            "Для того, чтобы удалить ранее сделанное предсказание,"
-            " отправьте его номер в ответном сообщении."
+    if mes == "общая":
+        # Every category at once from a single read
+        overall, by_category = breakdown(await storage.resolved(who))
+        if overall is None:
+            text = (
+                "У Вас нет ни одного предсказания с известным"
+                " исходом. Расчет калибровки пока не возможен.")
+        else:
+            text = create_message_breakdown(overall, by_category)
+    else:
+        # Or get results for a specific category
+        resolved, hits_50, hits_90 = await storage.calibration(who, mes)
+        if not resolved:
+            text = (
+                "В данной категории у Вас нет ни одного"
+                " предсказания с известным исходом."
+                " Расчет калибровки пока не возможен.")
+        else:
+            text = (
+                "Ваша калибровка для выбранной категории"
+                " на текущий момент составляет:\n\n"
+                "для 50% уровня уверенности -"
+                f" {hits_50 / resolved:.2f}\n"
+                "для 90% уровня уверенности -"
+                f" {hits_90 / resolved:.2f}"
+            )
+    await outbox.send_message(who, text, parse_mode="html")
+    del conversation_state[who]
+    logger.debug(f" Check function returned following: {text}")
+
+
+def invalid_lines(invalid: list, count: int) -> str:
+    """Point at the invalid lines of a multi-line message, if it is one."""
+    if count + len(invalid) < 2:
+        return ""
+    return "\n\nСтроки с ошибками: " + ", ".join(map(str, invalid))
+
+
+async def bulk_summary(who: int, done: str, ids: list, owned: set):
+    """Reply to a multi-line message with one summary.
+
+    Args:
+        who (int): user's id
+        done (str): what happened to the owned predictions
+        ids (list): predictions' ids the user gave
+        owned (set): ids of those which belong to the user
+    """
+    if not owned:
+        await not_owned(who)
+        return
+    ids = [int(pred_id) for pred_id in ids]
+    text = f"{done}: {sum(pred_id in owned for pred_id in ids)}."
+    strangers = [str(pred_id) for pred_id in ids if pred_id not in owned]
+    if strangers:
+        text += (
+            "\n\nНомера, не совпадающие ни с одним из сделанных Вами"
+            f" предсказаний: {', '.join(strangers)}."
         )
-        await event.respond(text)
+    await outbox.send_message(who, text)
+    del conversation_state[who]
+
+
+# UPDATE METHOD
+@router.state(State.WAIT_UPDATE)
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("write")
+async def update_prediction(event):
+    """Update the bounds of a user's predictions, one per line.
+
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    who = event.sender_id
+    records, invalid = validate_lines(
+        event.message.raw_text, validate_updating)
+    if invalid or not records:
+        await err_message(
+            outbox,
+            who,
+            parse_mode="html",
+            mess=(
+                "К сожалению, отправленное вами сообщение не похоже на"
+                " 5 цифр, разделенных точкой с запятой и пробелом.\n\n"
+                "Проверьте ваше сообщение, нажмите еще раз на кнопку"
+                " <i>Обновить предсказание</i> и отправьте сообщение с"
+                " обновленными цифрами еще раз."
+                f"{invalid_lines(invalid, len(records))}"
+            ),
+            state_dict=conversation_state)
+        logger.info("Update message isn't valid")
+        return
+
+    updates = [record.split("; ") for record in records]
+    if len(updates) > 1:
+        owned = await writer.update_many(who, updates)
+        await bulk_summary(
+            who, "Обновлено предсказаний", [u[0] for u in updates], owned)
+        logger.info(f"{len(owned)} predictions updated at once")
         return
 
-    if re.match("Добавить", mes):
-        conversation_state[who] = State.WAIT_ADD_PREDICTION
-        await client.send_message(
+    index, low_50, hi_50, low_90, hi_90 = updates[0]
+    if not await writer.update_bounds(
+            who, index, low_50, hi_50, low_90, hi_90):
+        await not_owned(who)
+        logger.info("Someone tried to update a someone else's prediction.")
+        return
+    await outbox.send_message(
+        who, f"Предсказание с номером {index} успешно обновлено.")
+    logger.info(f"Prediction with id {index} successfully updated")
+    del conversation_state[who]
+
+
+# ENTER OUTCOME
+@router.state(State.WAIT_ENTER)
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("write")
+async def enter_outcome(event):
+    """Enter the outcomes of a user's predictions, one per line.
+
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    who = event.sender_id
+    records, invalid = validate_lines(
+        event.message.raw_text, validate_outcome)
+    if invalid or not records:
+        await err_message(
+            outbox,
             who,
-            (
-                "Отправьте текст предсказания - что должно произойти, по"
-                " Вашему мнению.\n\nДалее следуйте подсказкам"
+            mess=(
+                "К сожалению Ваше сообщение не похоже на две цифры,"
+                " разделенные точкой с запятой и пробелом. Пожалуйста"
+                " повторно нажмите на кнопку <i>Результат предсказания"
+                "</i>, исправьте текст сообщения и отправьте его"
+                " еще раз."
+                f"{invalid_lines(invalid, len(records))}"
             ),
-        )
+            state_dict=conversation_state,
+            parse_mode="html")
+        logger.info("Outcome message isn't valid")
         return
 
-    # CHECK CALIBRATION
-    if conversation_state.get(who) == State.WAIT_CHECK:
-        query = (
-            "SELECT DISTINCT task_category FROM"
-            " predictions.raw_predictions WHERE user_id = %s"
+    outcomes = [record.split("; ") for record in records]
+    if len(outcomes) > 1:
+        owned = await writer.set_outcomes(who, outcomes)
+        await bulk_summary(
+            who,
+            "Внесено результатов предсказаний",
+            [pred_id for pred_id, _ in outcomes],
+            owned,
         )
-        crsr.execute(query, [who])
-        res = crsr.fetchall()  # fetch all the results
-        # If there is no categories yet, print a warning
-        if not res:
-            err_message(client, who, parse_mode="html",
-                        state_dict=conversation_state)
-            return
-        else:
-            cat_list = [
-                a for a in chain.from_iterable(res)
-            ] + ["общая", "Общая"]
-            if mes.lower() not in cat_list:
-                err_message(client, who, state_dict=conversation_state,
-                            mess=(
-                                "Вы не создали ни одного предсказания в данной"
-                                " категории."
-                            ))
-                logger.info(
-                    "Someone tried to get a list of categories"
-                    " but have not made any themselves."
-                )
-                return
+        logger.info(f"Outcomes of {len(owned)} predictions entered at once")
+        return
 
-            else:
-                if mes.lower() == "общая":
-                    query = """SELECT tot_acc_50 / tot_num_pred AS
-                            calibration_50,
-                        tot_acc_90 / tot_num_pred AS calibration_90
-                    FROM (
-                        SELECT COUNT(id) AS tot_num_pred,
-                        SUM(acc_50) AS tot_acc_50,
-                        SUM(acc_90) AS tot_acc_90
-                    FROM (
-                        SELECT
-                        id, user_id,
-                        pred_low_50_conf <= actual_outcome AND
-                        pred_high_50_conf >= actual_outcome AS acc_50,
-                        pred_low_90_conf <= actual_outcome AND
-                        pred_high_90_conf >= actual_outcome AS acc_90
-                        FROM predictions.raw_predictions
-                        WHERE user_id = %s AND
-                        actual_outcome IS NOT NULL)
-                        AS base_table
-                    GROUP BY user_id
-                    ) AS outer_table;"""
-                    crsr.execute(query, [who])
-                    res = crsr.fetchall()  # fetch all the results
-
-                    text = (
-                        "Ваша общая калибровка на текущий момент:"
-                        f"для 50% уровня уверенности - {res[0][0]:.2f}"
-                        "\n"
-                        f"для 90% уровня уверенности - {res[0][1]:.2f}"
-                    )
-                else:
-                    # Or get results for a specific category
-                    query = (
-                        "SELECT tot_acc_50 / tot_num_pred AS"
-                        " calibration_50,"
-                        " tot_acc_90 / tot_num_pred AS calibration_90"
-                        " FROM ("
-                        "SELECT COUNT(id) AS tot_num_pred,"
-                        " SUM(acc_50) AS tot_acc_50,"
-                        " SUM(acc_90) AS tot_acc_90"
-                        " FROM ("
-                        "SELECT"
-                        " id, user_id,"
-                        " pred_low_50_conf <= actual_outcome AND"
-                        " pred_high_50_conf >= actual_outcome AS acc_50,"
-                        " pred_low_90_conf <= actual_outcome AND"
-                        " pred_high_90_conf >= actual_outcome AS acc_90"
-                        " FROM predictions.raw_predictions"
-                        " WHERE user_id = %s AND"
-                        " task_category = %s AND"
-                        " actual_outcome IS NOT NULL)"
-                        " AS base_table"
-                        " GROUP BY user_id"
-                        ") AS outer_table;"
-                    )
-                    crsr.execute(query, (who, mes.lower()))
-                    res = crsr.fetchall()  # fetch all the results
-                    if not res:
-                        text = (
-                            "В данной категории у Вас нет ни одного"
-                            " предсказания с известным исходом."
-                            " Расчет калибровки пока не возможен.")
-                    else:
-                        text = (
-                            "Ваша калибровка для выбранной категории"
-                            " на текущий момент составляет:\n\n"
-                            f"для 50% уровня уверенности - {res[0][0]:.2f}"
-                            "\n"
-                            f"для 90% уровня уверенности - {res[0][1]:.2f}"
-                        )
-                await client.send_message(who, text, parse_mode="html")
-                del conversation_state[who]
-                logger.debug(f" Check function returned following: {text}")
-                return
+    pred_id, actual_outcome = outcomes[0]
+    if not await writer.set_outcome(who, pred_id, actual_outcome):
+        await not_owned(who)
+        logger.info(
+            "Someone tried to enter outcome for a someone else's prediction.")
+        return
+    await outbox.send_message(
+        who, f"Результат предсказание с номером {pred_id} успешно внесен.")
+    logger.info(
+        f"Outcome of the prediction with id {pred_id} successfully entered")
+    del conversation_state[who]
 
-    # UPDATE METHOD
-    if conversation_state.get(who) == State.WAIT_UPDATE:
-        query = (
-            "SELECT id FROM"
-            " predictions.raw_predictions WHERE user_id = %s"
-        )
-        crsr.execute(query, [who])
-        user_predictions = crsr.fetchall()  # fetch all the results
-        # If there is no categories yet, print a warning
-        if not user_predictions:
-            err_message(client, who, state_dict=conversation_state)
-            logger.info(
-                "Someone tried to update a prediction without"
-                "making at least one themselve"
-            )
-            return
-        if not validate_updating(mes):
-            err_message(
-                client,
-                who,
-                parse_mode="html",
-                mess=(
-                    "К сожалению, отправленное вами сообщение не похоже на"
-                    " 5 цифр, разделенных точкой с запятой и пробелом.\n\n"
-                    "Проверьте ваше сообщение, нажмите еще раз на кнопку"
-                    " <i>Обновить предсказание</i> и отправьте сообщение с"
-                    " обновленными цифрами еще раз."
-                ),
-                state_dict=conversation_state)
-            logger.info("Update message isn't valid")
-            return
-        else:
-            mes_list = [
-                str(x) for x in chain.from_iterable(user_predictions)]
-            message = mes.split("; ")
-            index = message[0]
-            low_50 = message[1]
-            hi_50 = message[2]
-            low_90 = message[3]
-            hi_90 = message[4]
-            if index not in mes_list:
-                err_message(
-                    client,
-                    who,
-                    mess=(
-                        "Номер предсказания не совпадает ни с одним из"
-                        " сделанных Вами предсказаний. Пожалуйста"
-                        " внесите корректный номер."
-                    ),
-                    state_dict=conversation_state)
-                logger.info(
-                    "Someone tried to update a someone else's prediction."
-                )
-                return
-            else:
-                params = (low_50, hi_50, low_90, hi_90, index)
-                sql_command = """UPDATE predictions.raw_predictions SET
-                pred_low_50_conf=%s, pred_high_50_conf=%s,
-                pred_low_90_conf=%s, pred_high_50_conf=%s
-                WHERE id=%s;"""
-
-                crsr.execute(sql_command, params)  # Execute the query
-                conn.commit()  # Commit the changes
-                await client.send_message(
-                    who,
-                    f"Предсказание с номером {index} успешно обновлено."
-                )
-                logger.info(
-                    f"Prediction with id {index} successfully updated")
-                del conversation_state[who]
-                return
 
-    # ENTER OUTCOME
-    if conversation_state.get(who) == State.WAIT_ENTER:
-        query = (
-            "SELECT id FROM"
-            " predictions.raw_predictions WHERE user_id = %s"
-        )
-        crsr.execute(query, [who])
-        user_predictions = crsr.fetchall()  # fetch all the results
-        # If there is no categories yet, print a warning
-        if not user_predictions:
-            err_message(client, who, state_dict=conversation_state)
-            logger.info(
-                "Someone tried to enter an outcome of a prediction"
-                " without making at least one themselve"
-            )
-            return
+# DELETE METHOD
+@router.state(State.WAIT_DELETE)
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("write")
+async def delete_prediction(event):
+    """Delete a user's predictions, one id per line.
 
-        if not validate_outcome(mes):
-            err_message(
-                client,
-                who,
-                mess=(
-                    "К сожалению Ваше сообщение не похоже на две цифры,"
-                    " разделенные точкой с запятой и пробелом. Пожалуйста"
-                    " повторно нажмите на кнопку <i>Результат предсказания"
-                    "</i>, исправьте текст сообщения и отправьте его"
-                    " еще раз."
-                ),
-                state_dict=conversation_state,
-                parse_mode="html")
-            logger.info("Outcome message isn't valid")
-            return
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    who = event.sender_id
+    ids, invalid = validate_lines(event.message.raw_text, validate_deletion)
+    if invalid or not ids:
+        await err_message(
+            outbox,
+            who,
+            mess=(
+                "К сожалению, Ваше сообщение не похоже на цифру."
+                " Что именно Вы пытаетесь отправить? Попробуйте"
+                " отправить номер предсказания, которое вы"
+                " пытаетесь удалить еще раз, пожалуйста."
+                f"{invalid_lines(invalid, len(ids))}"
+            ),
+            state_dict=conversation_state)
+        logger.info("Outcome message isn't valid")
+        return
 
-        else:
-            mes_list = [
-                str(x) for x in chain.from_iterable(user_predictions)]
-            list_of_words = mes.split("; ")
-            pred_id = list_of_words[0]
-            actual_outcome = list_of_words[1]
-
-            if pred_id not in mes_list:
-                err_message(
-                    client,
-                    who,
-                    mess=(
-                        "Номер предсказания не совпадает ни с одним из"
-                        " сделанных Вами предсказаний. Пожалуйста"
-                        " внесите корректный номер."
-                    ),
-                    state_dict=conversation_state)
-                logger.info(
-                    ("Someone tried to enter outcome for a someone else's"
-                        " prediction.")
-                )
-                return
-            # Create the tuple "params" with all the parameters inserted
-            # by the user
-            else:
-                params = (actual_outcome, pred_id)
-                sql_command = """UPDATE predictions.raw_predictions SET
-                actual_outcome=%s WHERE id=%s;"""
-
-                crsr.execute(sql_command, params)  # Execute the query
-                conn.commit()  # Commit the changes
-                await client.send_message(
-                    who,
-                    (f"Результат предсказание с номером {pred_id}"
-                        " успешно внесен."),
-                )
-                logger.info(
-                    f"Outcome of the prediction with id {pred_id}"
-                    "successfully entered"
-                )
-                del conversation_state[who]
-                return
+    if len(ids) > 1:
+        owned = await writer.delete_many(who, ids)
+        await bulk_summary(who, "Удалено предсказаний", ids, owned)
+        logger.info(f"{len(owned)} predictions deleted at once")
+        return
 
-    # DELETE METHOD
-    elif conversation_state.get(who) == State.WAIT_DELETE:
-        query = (
-            "SELECT id FROM"
-            " predictions.raw_predictions WHERE user_id = %s"
-        )
-        crsr.execute(query, [who])
-        user_predictions = crsr.fetchall()  # fetch all the results
-        # If there is no categories yet, print a warning
-        if not user_predictions:
-            err_message(client, who)
-            await client.send_message(who, text, parse_mode="html")
-            logger.info(
-                "Someone tried to delete a prediction"
-                " without making at least one themselves"
-            )
-            return
+    pred_id = ids[0]
+    if not await writer.delete(who, pred_id):
+        await not_owned(who)
+        logger.info("Someone tried to deleto a someone else's prediction.")
+        return
+    await outbox.send_message(
+        who, f"Предсказание с номером {pred_id} успешно удалено.")
+    logger.info(f"Prediction with id {pred_id} successfully deleted")
+    del conversation_state[who]
 
-        if not validate_deletion(mes):
-            err_message(
-                client,
-                who,
-                mess=(
-                    "К сожалению, Ваше сообщение не похоже на цифру."
-                    " Что именно Вы пытаетесь отправить? Попробуйте"
-                    " отправить номер предсказания, которое вы"
-                    " пытаетесь удалить еще раз, пожалуйста."
-                ),
-                state_dict=conversation_state)
-            logger.info("Outcome message isn't valid")
-            return
 
-        else:
-            mes_list = [
-                str(x) for x in chain.from_iterable(user_predictions)]
-            pred_id = mes_list[0]
-            if pred_id not in mes_list:
-                err_message(
-                    client,
-                    who,
-                    mess=(
-                        "Номер предсказания не совпадает ни с одним из"
-                        " сделанных Вами предсказаний. Пожалуйста"
-                        " внесите корректный номер."
-                    ),
-                    state_dict=conversation_state)
-                logger.info(
-                    "Someone tried to deleto a someone else's prediction."
-                )
-                return
-            else:
-                # Create the DELETE query passing the id as a parameter
-                sql_command = """DELETE FROM predictions.raw_predictions
-                WHERE id = (%s);"""
-
-                crsr.execute(sql_command, [pred_id])
-                conn.commit()
-                await client.send_message(
-                    who, (f"Предсказание с номером {pred_id} успешно удалено.")
-                )
-                logger.info(
-                    f"Prediction with id {pred_id} successfully deleted")
-                del conversation_state[who]
-                return
+# ADD PREDICTION METHOD
+def wizard_step(event) -> str:
+    """Return the name of the add wizard's step a user answers."""
+    state = conversation_state.get(event.sender_id)
+    return state.name if state in ADD_STEPS else "none"
 
-    # ADD PREDICTION METHOD
-    if conversation_state.get(who) == State.WAIT_ADD_PREDICTION:
-        if check_click(mes):
-            global TEXT
-            TEXT = {}
-            TEXT["prediction"] = mes
-            BLACK_HEART = "\U0001F5A4"
-            SMILE_INFO: str = "\U00002139"
-            DEFAULT_ERROR_MESSAGE: str = (
-                "Прошу простить мне мое занудство, но нажимать"
-                " на случайные кнопки в середине разговора не лучший"
-                " метод улучшить собственную калибровку."
-                "Нажмите на любую кнопку сейчас и продолжите."
-            )
-            conversation_state[who] = State.WAIT_ADD_CATEGORY
-            await client.send_message(
-                who,
-                (
-                    "Отправьте категорию предсказания для того, чтобы у Вас"
-                    " была возможность уточнить свою калибровку не только по"
-                    " всем сохраненным предсказаниям, но и по отдельной"
-                    f" категории.\n\n{SMILE_INFO}Это может быть полезно,"
-                    " т.к. мы можем быть одновременно великолепно калиброваны"
-                    " во всех, например, рабочих вопросах, но быть ужасно"
-                    " калиброваны в вопросах касающихся взаимоотношений"
-                    f" с людьми{BLACK_HEART}\n\nДля того, чтобы иметь"
-                    " возможность совершенствоваться, нужно понимать, в"
-                    " какой сфере мы не совершенны. Отправьте одно слово,"
-                    " характеризующее категорию."
-                ),
-            )
-            return
-        else:
-            err_message(client, who, mess=DEFAULT_ERROR_MESSAGE)
-            return
-    elif conversation_state.get(who) == State.WAIT_ADD_CATEGORY:
-        if check_click(mes):
-            TEXT["category"] = mes
-            conversation_state[who] = State.WAIT_ADD_UNIT
-            await client.send_message(
-                who,
-                (
-                    "В будущем может так случиться, что Вы захотите узнать"
-                    " в каких единицах Вы вносили данное предсказание. Чтобы"
-                    " такая возможность у Вас была - отправьте одно слово,"
-                    " обозначающее единицу измерения. Например: час, день,"
-                    " ребёнки."
-                ),
-            )
-            return
-        else:
-            err_message(client, who, mess=DEFAULT_ERROR_MESSAGE)
-            return
-    elif conversation_state.get(who) == State.WAIT_ADD_UNIT:
-        if check_click(mes):
-            TEXT["unit"] = mes
-            conversation_state[who] = State.WAIT_ADD_LOW_50
-            await client.send_message(
-                who,
-                (
-                    "Отправьте число, соответствующее нижней границе, которую"
-                    " может принять предсказанная величина с уверенностью"
-                    " в 50%. Одно число и ничего более."
-                ),
-            )
-            return
-        else:
-            err_message(client, who, mess=DEFAULT_ERROR_MESSAGE)
-            return
-    elif conversation_state.get(who) == State.WAIT_ADD_LOW_50:
-        if check_click(mes):
-            TEXT["low_50"] = mes
-            conversation_state[who] = State.WAIT_ADD_HI_50
-            await client.send_message(
-                who,
-                (
-                    "Отправьте число, соответствующее верхней границе, которую"
-                    " может принять предсказанная величина с уверенностью"
-                    " в 50%. Одно число и ничего более."
-                ),
-            )
-            return
-        else:
-            err_message(client, who, mess=DEFAULT_ERROR_MESSAGE)
-            return
-    elif conversation_state.get(who) == State.WAIT_ADD_HI_50:
-        if check_click(mes):
-            TEXT["hi_50"] = mes
-            conversation_state[who] = State.WAIT_ADD_LOW_90
-            await client.send_message(
-                who,
-                (
-                    "Отправьте число, соответствующую нижней границе, которую"
-                    " может принять предсказанная величина с уверенностью"
-                    " в 90%. Одно число и ничего более."
-                ),
-            )
-            return
-        else:
-            err_message(client, who, mess=DEFAULT_ERROR_MESSAGE)
-            return
-    elif conversation_state.get(who) == State.WAIT_ADD_LOW_90:
-        if check_click(mes):
-            TEXT["low_90"] = mes
-            conversation_state[who] = State.WAIT_ADD_HI_90
-            await client.send_message(
-                who,
-                (
-                    "Отправьте цифру, соответствующую верхней границе, которую"
-                    " может принять предсказанная величина с уверенностью"
-                    " в 90%. Одна цифра и ничего более."
-                ),
-            )
-            return
-        else:
-            err_message(client, who, mess=DEFAULT_ERROR_MESSAGE)
-            return
-    elif conversation_state.get(who) == State.WAIT_ADD_HI_90:
-        if check_click(mes):
-            TEXT["hi_90"] = mes
-            mess = one_message(TEXT)
-            await client.send_message(
+
+@router.state(*ADD_STEPS)
+@handled
+@HANDLER_SECONDS.timed(state=wizard_step)
+@limiter.limit("cheap")
+async def add_step(event):
+    """Take a user's answer to a step of the add wizard.
+
+    Buttons pressed in the middle of the wizard never get here, they are
+    routed to their own handlers.
+
+    Args:
+        event (EventCommon): NewMessage event
+    """
+    who = event.sender_id
+    state = conversation_state.get(who)
+    field, next_state, text = ADD_STEPS[state]
+    answer = event.message.raw_text
+    if state == State.WAIT_ADD_RESOLVE_BY:
+        if not validate_resolution_date(answer):
+            await outbox.send_message(
                 who,
-                (
-                    "Проверьте, пожалуйста, получившееся предсказание."
-                    " Если все верно - нажмите <i>Сохранить</i>, если нет - "
-                    " нажмите на кнопку </i>Внести повторно</i>\n\n"
-                    f"{mess}"
-                ),
-                buttons=[
-                    Button.inline("Сохранить", data="Добавить сохранить"),
-                    Button.inline("Внести повторно", data="Добавить повторно"),
-                ],
-                parse_mode="html"
+                "Не получилось прочитать дату. Отправьте дату не раньше"
+                " сегодняшней в формате ДД.ММ.ГГГГ, например 31.12.2030,"
+                " или -, если напоминание не нужно.",
             )
             return
-        else:
-            err_message(client, who, mess=DEFAULT_ERROR_MESSAGE)
-            return
+        # Drafts keep the date as ISO text, None for no reminder
+        answer = None if answer.strip() == "-" else datetime.strptime(
+            answer.strip(), DATE_FORMAT).date().isoformat()
+    if state == State.WAIT_ADD_PREDICTION:
+        conversation_state.new_draft(who)
+    draft = conversation_state.update_draft(who, **{field: answer})
+
+    if next_state is not None:
+        conversation_state[who] = next_state
+        await outbox.send_message(who, text)
+        return
+
+    mess = one_message(draft.as_dict())
+    await outbox.send_message(
+        who,
+        (
+            "Проверьте, пожалуйста, получившееся предсказание."
+            " Если все верно - нажмите <i>Сохранить</i>, если нет - "
+            " нажмите на кнопку </i>Внести повторно</i>\n\n"
+            f"{mess}"
+        ),
+        buttons=[
+            Button.inline("Сохранить", data="Добавить сохранить"),
+            Button.inline("Внести повторно", data="Добавить повторно"),
+        ],
+        parse_mode="html"
+    )
 
 
-@client.on(events.CallbackQuery(data=re.compile(r"Добавить сохранить")))
+@router.callback(re.compile(r"Добавить сохранить"))
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("write")
 async def add(event):
     """Save user's prediction.
 
@@ -748,23 +1406,23 @@ async def add(event):
         event (EventCommon): NewMessage event
     """
     try:
-        global TEXT
         sender = await event.get_sender()
         SENDER = sender.id
         user_id = SENDER
-        date = datetime.now().strftime("%d/%m/%Y")
-        task_description = TEXT["prediction"]
-        task_category = TEXT["category"].lower()
-        unit_of_measure = TEXT["unit"]
-        pred_low_50_conf = TEXT["low_50"]
-        pred_high_50_conf = TEXT["hi_50"]
-        pred_low_90_conf = TEXT["low_90"]
-        pred_high_90_conf = TEXT["hi_90"]
-        actual_outcome = None
-
-        # Create the tuple "params" with all the parameters inserted
-        # by the user
-        params = (
+        draft = conversation_state.draft(SENDER)
+        if draft is None or draft.hi_90 is None:
+            # Pressed twice or the session has expired
+            return
+        date = datetime.now().date()
+        task_description = draft.prediction
+        task_category = draft.category.lower()
+        unit_of_measure = draft.unit
+        pred_low_50_conf = draft.low_50
+        pred_high_50_conf = draft.hi_50
+        pred_low_90_conf = draft.low_90
+        pred_high_90_conf = draft.hi_90
+
+        await writer.add(
             user_id,
             date,
             task_description,
@@ -774,17 +1432,10 @@ async def add(event):
             pred_high_50_conf,
             pred_low_90_conf,
             pred_high_90_conf,
-            actual_outcome,
+            resolve_by=draft.resolve_by,
         )
-        # the initial NULL is for the AUTOINCREMENT id inside the table
-        sql_command = """
-            INSERT INTO predictions.raw_predictions
-            VALUES (NULL, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"""
-        crsr.execute(sql_command, params)  # Execute the query
-        conn.commit()  # commit the changes
-        await client.send_message(SENDER, "Предсказание успешно сохранено")
+        await outbox.send_message(SENDER, "Предсказание успешно сохранено")
         del conversation_state[SENDER]
-        del TEXT
 
     except Exception as e:
         logging.error(
@@ -793,7 +1444,10 @@ async def add(event):
         )
 
 
-@client.on(events.CallbackQuery(data=re.compile(r"Добавить повторно")))
+@router.callback(re.compile(r"Добавить повторно"))
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("cheap")
 async def show_again(event):
     """Add new prediction again.
 
@@ -803,21 +1457,23 @@ async def show_again(event):
     sender = await event.get_sender()
     SENDER = sender.id
     state = conversation_state.get(SENDER)
-    if state is None or state == State.WAIT_ADD_HI_90:
+    if state is None or state == State.WAIT_ADD_RESOLVE_BY:
         conversation_state[SENDER] = State.WAIT_ADD_PREDICTION
-        await client.send_message(
+        await outbox.send_message(
             SENDER,
             (
                 "Отправьте текст предсказания - что должно произойти, по"
                 " Вашему мнению.\n\nДалее следуйте подсказкам"
             ),
         )
-        global TEXT
-        del TEXT
+        conversation_state.new_draft(SENDER)
 
 
 # LIST METHOD
-@client.on(events.NewMessage(pattern="Показать"))
+@router.button("Показать предсказания")
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("cheap")
 async def display(event):
     """Give a choice to a user about what they's like to see.
 
@@ -835,7 +1491,7 @@ async def display(event):
     )
     sender = await event.get_sender()
     SENDER = sender.id
-    await client.send_message(
+    await outbox.send_message(
         SENDER,
         text,
         buttons=[
@@ -845,10 +1501,55 @@ async def display(event):
     )
 
 
+async def send_page(
+    event, user_id: int, kind: str, direction: str = "next", pivot: int = 0
+):
+    """Send a page of predictions with navigation buttons.
+
+    A page holds as many predictions as fit in one message, so its end is
+    known only after rendering; the next page continues from there.
+
+    Args:
+        event (EventCommon): CallbackQuery event
+        user_id (int): whom to send the page
+        kind (str): key of storage.LIST_FILTERS
+        direction (str): "next" or "prev", see Storage.page
+        pivot (int): id of the prediction the page is adjacent to
+    """
+    res, has_prev, has_next = await storage.page(
+        user_id, kind, CHUNK_SIZE, direction, pivot)
+    if not res:
+        await err_message(outbox, user_id, del_state=False)
+        return
+    count = renderer.fit(res, from_end=direction == "prev")
+    if count < len(res):
+        if direction == "prev":
+            res, has_prev = res[-count:], True
+        else:
+            res, has_next = res[:count], True
+    buttons = []
+    if has_prev:
+        buttons.append(Button.inline(
+            "Предыдущий", data=f"page_{kind}_prev_{res[0][0]}"))
+    if has_next:
+        buttons.append(Button.inline(
+            "Следующий", data=f"page_{kind}_next_{res[-1][0]}"))
+    text = renderer.message(res)
+    await outbox.send_message(
+        user_id,
+        text,
+        parse_mode="html",
+        buttons=event.client.build_reply_markup(buttons) if buttons else None,
+    )
+
+
 # LIST METHOD FOR A WHOLE LIST OF PREDICTIONS
-@client.on(events.CallbackQuery(data=re.compile(b'list_whole')))
+@router.callback(re.compile(b'list_whole'))
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("expensive")
 async def display_whole(event):
-    """Show all predictions to a user.
+    """Show the first page of all predictions to a user.
 
     Args:
         event (EventCommon): NewMessage event
@@ -856,31 +1557,7 @@ async def display_whole(event):
     try:
         sender = await event.get_sender()
         SENDER = sender.id
-        query = "SELECT * FROM predictions.raw_predictions WHERE user_id = %s"
-        crsr.execute(query, [SENDER])
-        res = crsr.fetchall()
-        # If there is at least 1 row selected, print a message with the list
-        # of all predictions
-        global COUNTER
-        COUNTER = len(res)
-        if res:
-            message = res[0:CHUNK_SIZE]
-            if len(res) <= CHUNK_SIZE:
-                text = create_message_select_query(message)
-                await client.send_message(SENDER, text, parse_mode="html")
-            else:
-                callback_data = f"page_whole_{1}"
-                button = event.client.build_reply_markup(
-                    [Button.inline("Next", data=callback_data)]
-                )
-                text = create_message_select_query(message)
-                await client.send_message(
-                    SENDER, text, buttons=button, parse_mode="html"
-                )
-
-        # Otherwhise, print a default text
-        else:
-            err_message(client, SENDER, del_state=False)
+        await send_page(event, SENDER, "whole")
 
     except Exception as e:
         logger.error(
@@ -890,12 +1567,15 @@ async def display_whole(event):
         return
 
 
-@client.on(events.CallbackQuery(data=re.compile(b"page_whole")))
+@router.callback(re.compile(rb"page_whole_(next|prev)_(\d+)"))
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("expensive")
 async def show(event):
     """Show to a user their predictions.
 
-    Activated only if user has more then 10 predictions, using
-    ad-hoc pagination.
+    Activated only if user's predictions don't fit in one message, the
+    callback data carries the direction and the id to continue from.
 
     Args:
         event (EventCommon): CallbackQuery event
@@ -903,51 +1583,25 @@ async def show(event):
     try:
         sender = await event.get_sender()
         SENDER = sender.id
-        page = int(event.data.split(b"page_whole_")[1])
-        query = (
-            "SELECT * FROM predictions.raw_predictions WHERE user_id = %s"
-            " LIMIT %s, %s;"
-        )
-        crsr.execute(query, [SENDER, page * CHUNK_SIZE, CHUNK_SIZE])
-        res = crsr.fetchall()  # fetch all the results
-        text = create_message_select_query(res)
-
-        if page >= 1 and (COUNTER - page * CHUNK_SIZE) > CHUNK_SIZE:
-            forward = f"page_whole_{page + 1}"
-            backward = f"page_whole_{page - 1}"
-            button = event.client.build_reply_markup(
-                [
-                    Button.inline("Предыдущий", data=backward),
-                    Button.inline("Следующий", data=forward),
-                ]
-            )
-
-        elif page >= 1 and (COUNTER - page * CHUNK_SIZE) <= CHUNK_SIZE:
-            backward = f"page_whole{page - 1}"
-            button = event.client.build_reply_markup(
-                [
-                    Button.inline("Предыдущий", data=backward),
-                ]
-            )
-
-        await client.send_message(
-            SENDER,
-            text,
-            parse_mode='html',
-            buttons=button)
+        direction = event.data_match.group(1).decode()
+        pivot = int(event.data_match.group(2))
+        await send_page(event, SENDER, "whole", direction, pivot)
 
     except Exception as e:
         logger.error(
-            f"Something went wrong when showing page {page} user's predictions"
+            "Something went wrong when showing a page of user's predictions"
             f" with an error: {e}"
         )
         return
 
 
 # LIST METHOD FOR A LIST OF PREDICTIONS W/O OUTCOMES
-@client.on(events.CallbackQuery(data=re.compile(b'list_empty')))
+@router.callback(re.compile(b'list_empty'))
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("expensive")
 async def display_empty(event):
-    """Show predictions whithout outcomes to a user.
+    """Show the first page of predictions whithout outcomes to a user.
 
     Args:
         event (EventCommon): NewMessage event
@@ -955,33 +1609,7 @@ async def display_empty(event):
     try:
         sender = await event.get_sender()
         SENDER = sender.id
-        query = (
-            "SELECT * FROM predictions.raw_predictions WHERE user_id = %s"
-            " AND actual_outcome IS NULL"
-        )
-        crsr.execute(query, [SENDER])
-        res = crsr.fetchall()
-        # If there is at least 1 row selected, print a message with the list
-        # of all predictions
-        global COUNTER
-        COUNTER = len(res)
-        if res:
-            message = res[0:CHUNK_SIZE]
-            if len(res) <= CHUNK_SIZE:
-                text = create_message_select_query(message)
-                await client.send_message(SENDER, text, parse_mode='html')
-            else:
-                callback_data = f"page_empty_{1}"
-                button = event.client.build_reply_markup(
-                    [Button.inline("Next", data=callback_data)]
-                )
-                text = create_message_select_query(message)
-                await client.send_message(
-                    SENDER, text, buttons=button, parse_mode='html')
-
-        # Otherwhise, print a default text
-        else:
-            err_message(client, SENDER, del_state=False)
+        await send_page(event, SENDER, "empty")
 
     except Exception as e:
         logger.error(
@@ -991,12 +1619,15 @@ async def display_empty(event):
         return
 
 
-@client.on(events.CallbackQuery(data=re.compile(b"page_empty")))
+@router.callback(re.compile(rb"page_empty_(next|prev)_(\d+)"))
+@handled
+@HANDLER_SECONDS.timed
+@limiter.limit("expensive")
 async def show_empty(event):
     """Show to a user their predictions w/o outcomes.
 
-    Activated only if user has more then 10 predictions, using
-    ad-hoc pagination.
+    Activated only if such predictions don't fit in one message, the
+    callback data carries the direction and the id to continue from.
 
     Args:
         event (EventCommon): CallbackQuery event
@@ -1004,97 +1635,47 @@ async def show_empty(event):
     try:
         sender = await event.get_sender()
         SENDER = sender.id
-        page = int(event.data.split(b"page_empty_")[1])
-        query = (
-            "SELECT * FROM predictions.raw_predictions WHERE user_id = %s"
-            " AND actual_outcome IS NULL LIMIT %s, %s;"
-        )
-        crsr.execute(query, [SENDER, page * CHUNK_SIZE, CHUNK_SIZE])
-        res = crsr.fetchall()  # fetch all the results
-        text = create_message_select_query(res)
-
-        if page >= 1 and (COUNTER - page * CHUNK_SIZE) > CHUNK_SIZE:
-            forward = f"page_empty_{page + 1}"
-            backward = f"page_empty_{page - 1}"
-            button = event.client.build_reply_markup(
-                [
-                    Button.inline("Предыдущий", data=backward),
-                    Button.inline("Следующий", data=forward),
-                ]
-            )
-
-        elif page >= 1 and (COUNTER - page * CHUNK_SIZE) <= CHUNK_SIZE:
-            backward = f"page_empty{page - 1}"
-            button = event.client.build_reply_markup(
-                [
-                    Button.inline("Предыдущий", data=backward),
-                ]
-            )
-
-        await client.send_message(
-            SENDER,
-            text,
-            parse_mode='html',
-            buttons=button)
+        direction = event.data_match.group(1).decode()
+        pivot = int(event.data_match.group(2))
+        await send_page(event, SENDER, "empty", direction, pivot)
 
     except Exception as e:
         logger.error(
-            f"Something went wrong when showing page {page} user's predictions"
+            "Something went wrong when showing a page of user's predictions"
             f" with an error: {e}"
         )
         return
 
 
-if __name__ == "__main__":
-    try:
-        logging.basicConfig(
-            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            filemode="w"
-        )
-        logger: logging.Logger = logging.getLogger(__name__)
-        logger.setLevel(logging.DEBUG)
-        handler: RotatingFileHandler = RotatingFileHandler(
-            "main.log", maxBytes=50000000, backupCount=5
-        )
-        logger.addHandler(handler)
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-
-        handler.setFormatter(formatter)
+def main(config: Optional[Config] = None, updates=None):
+    """Run the bot.
 
-        if not check_tokens():
-            logger.critical("Bot stopped due missing some token", exc_info=1)
-            sys.exit(2)
+    Args:
+        config (Config): settings, read from the environment by default
+        updates (multiprocessing.Queue): updates handed over by the front
+        process, see workers.py; the bot receives its own updates without it
+    """
+    config = config or Config.from_env()
+    listener = setup_logging(
+        config.log_path, config.log_debug_sample, debug_loggers=(__name__,))
+    if not check_tokens(config):
+        logger.critical("Bot stopped due missing some token", exc_info=1)
+        listener.stop()
+        sys.exit(2)
+
+    app = create_app(config)
+    try:
+        app.run(updates)
 
-        # Connect to the database
-        conn = mysql.connector.connect(
-            host=HOST, user=USER, password=PASSWORD, database=DATABASE
-        )
+    except Exception as error:
+        if app.client.is_connected():
+            app.client.send_message("me", "Bot isn't working!!")
+        logger.fatal("Bot isn't working due to a %s", error, exc_info=1)
 
-        # Create a cursor
-        crsr = conn.cursor()
-
-        # Command that creates the "raw_predictions" table
-        sql_command = """CREATE TABLE IF NOT EXISTS raw_predictions (
-            id INTEGER PRIMARY KEY AUTO_INCREMENT,
-            user_id VARCHAR(20),
-            date VARCHAR(100),
-            task_description VARCHAR(200),
-            task_category VARCHAR(50),
-            unit_of_measure VARCHAR(30),
-            pred_low_50_conf FLOAT(10),
-            pred_high_50_conf FLOAT(10),
-            pred_low_90_conf FLOAT(10),
-            pred_high_90_conf FLOAT(10),
-            actual_outcome FLOAT(10));"""
-
-        crsr.execute(sql_command)
-        logger.info("All tables are ready")
+    finally:
+        # Writes the records still in the queue
+        listener.stop()
 
-        logger.info("Bot Started...")
-        client.run_until_disconnected()
 
-    except Exception as error:
-        client.send_message("me", "Bot isn't working!!")
-        logger.fatal("Bot isn't working due to a %s", error, exc_info=1)
+if __name__ == "__main__":
+    main()
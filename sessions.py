@@ -0,0 +1,338 @@
+"""Per-user conversation state and drafts of the add wizard."""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum, auto
+from typing import Optional
+
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class State(Enum):
+    """User' states."""
+
+    WAIT_CHECK = auto()
+    WAIT_UPDATE = auto()
+    WAIT_ENTER = auto()
+    WAIT_DELETE = auto()
+    WAIT_ADD_PREDICTION = auto()
+    WAIT_ADD_CATEGORY = auto()
+    WAIT_ADD_UNIT = auto()
+    WAIT_ADD_LOW_50 = auto()
+    WAIT_ADD_HI_50 = auto()
+    WAIT_ADD_LOW_90 = auto()
+    WAIT_ADD_HI_90 = auto()
+    WAIT_ADD_RESOLVE_BY = auto()
+
+
+class Draft:
+    """Prediction being entered with the add wizard."""
+
+    __slots__ = (
+        "prediction", "category", "unit", "low_50", "hi_50", "low_90",
+        "hi_90", "resolve_by",
+    )
+
+    def __init__(self, **values: str):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def as_dict(self) -> dict[str, Optional[str]]:
+        """Return the entered values by their names."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Session:
+    """A user's place in a conversation."""
+
+    __slots__ = ("state", "draft", "touched")
+
+    def __init__(self, state: Optional[State] = None,
+                 draft: Optional[Draft] = None):
+        self.state = state
+        self.draft = draft
+        self.touched: float = time.time()
+
+
+class SharedSessions:
+    """Sessions in an SQLite file shared by the bot's processes.
+
+    Each user is served by one process at a time, which keeps the user's
+    session in memory as well; the file lets another process take the
+    user over after a restart.
+
+    Changes are written by one thread with its own long-lived connection,
+    in the order they are made, so waiting for another process' lock never
+    blocks the event loop. Sessions are read only when a user isn't in
+    memory, by a connection giving up after READ_TIMEOUT seconds.
+
+    Args:
+        path (str): database file
+    """
+
+    SCHEMA: str = (
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " user_id INTEGER PRIMARY KEY,"
+        " state TEXT,"
+        " draft TEXT,"
+        " touched REAL NOT NULL)"
+    )
+    # Seconds a read waits for a lock before the session is taken as absent
+    READ_TIMEOUT: float = 0.1
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(self.SCHEMA)
+        # Readers don't wait for writers in WAL mode, only for recovery
+        # and checkpoints
+        self._reader = sqlite3.connect(
+            path, timeout=self.READ_TIMEOUT, isolation_level=None)
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sessions")
+
+    def read(self, user_id: int) -> Optional[Session]:
+        """Return a user's session, None if there is none or it's locked."""
+        try:
+            row = self._reader.execute(
+                "SELECT state, draft, touched FROM sessions"
+                " WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Can't read the session of {user_id}: {e}")
+            return None
+        if row is None:
+            return None
+        state, draft, touched = row
+        session = Session(
+            State[state] if state else None,
+            Draft(**json.loads(draft)) if draft else None,
+        )
+        session.touched = touched
+        return session
+
+    def _execute(self, query: str, params: tuple):
+        # Queues a change for the writer thread, failures are logged
+        future = self._writer.submit(self._conn.execute, query, params)
+        future.add_done_callback(self._written)
+
+    @staticmethod
+    def _written(future: Future):
+        e = future.exception()
+        if e is not None:
+            logger.error(
+                f"Something went wrong when saving a session"
+                f" with an error: {e}"
+            )
+
+    def write(self, user_id: int, session: Session):
+        """Save a user's session in the background."""
+        self._execute(
+            "INSERT OR REPLACE INTO sessions (user_id, state, draft, touched)"
+            " VALUES (?, ?, ?, ?)",
+            (
+                user_id,
+                session.state.name if session.state else None,
+                json.dumps(session.draft.as_dict(), ensure_ascii=False)
+                if session.draft else None,
+                session.touched,
+            ),
+        )
+
+    def delete(self, user_id: int):
+        """Forget a user's session in the background."""
+        self._execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def purge(self, before: float) -> int:
+        """Forget sessions untouched since a moment, return their number.
+
+        Waits for the writer, it's meant to be called at start.
+        """
+        return self._writer.submit(
+            lambda: self._conn.execute(
+                "DELETE FROM sessions WHERE touched < ?", (before,)).rowcount
+        ).result()
+
+    def close(self):
+        """Finish the queued changes and close the file."""
+        self._writer.shutdown(wait=True)
+        self._reader.close()
+        self._conn.close()
+
+
+class SessionStore:
+    """Bounded store of users' sessions.
+
+    Behaves like a dict of user id to State, as conversation_state used to
+    be, and additionally keeps the add wizard's draft of every user. A
+    session expires ``ttl`` seconds after the user's last step and the
+    least recently active sessions are evicted once ``maxsize`` users are
+    in a conversation.
+
+    Args:
+        maxsize (int): maximum number of stored sessions
+        ttl (float): seconds of inactivity after which a session expires
+        path (str): file to keep sessions in between restarts, see
+        :meth:`load` and :meth:`save`
+        shared_path (str): SQLite file every change is written through to,
+        for several processes serving users in turn, see SharedSessions
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 10000,
+        ttl: float = 3600,
+        path: Optional[str] = None,
+        shared_path: Optional[str] = None,
+    ):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.path = path
+        self._shared = SharedSessions(shared_path) if shared_path else None
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._cache
+
+    def count_states(self) -> dict[str, int]:
+        """Return the number of users in every state."""
+        self._cache.expire()
+        counts: dict[str, int] = {}
+        for session in list(self._cache.values()):
+            if session.state is not None:
+                name = session.state.name
+                counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def _touch(self, user_id: int, session: Session) -> Session:
+        # Storing again restarts the entry's time to live
+        session.touched = time.time()
+        self._cache[user_id] = session
+        return session
+
+    def _session(self, user_id: int) -> Optional[Session]:
+        session = self._cache.get(user_id)
+        if session is None and self._shared is not None:
+            # The user may have been served by another process before
+            session = self._shared.read(user_id)
+            if session is not None:
+                if time.time() - session.touched > self.ttl:
+                    return None
+                self._cache[user_id] = session
+        return session
+
+    def _changed(self, user_id: int, session: Session):
+        self._touch(user_id, session)
+        if self._shared is not None:
+            self._shared.write(user_id, session)
+
+    def get(self, user_id: int, default=None) -> Optional[State]:
+        """Return a user's state or default if they aren't in one."""
+        session = self._session(user_id)
+        if session is None or session.state is None:
+            return default
+        return self._touch(user_id, session).state
+
+    def peek(self, user_id: int) -> Optional[State]:
+        """Return a user's state if their session is in memory.
+
+        Neither reads the shared store nor extends the session, so it is
+        cheap enough to call for every update.
+        """
+        session = self._cache.get(user_id)
+        return None if session is None else session.state
+
+    def __setitem__(self, user_id: int, state: State):
+        session = self._session(user_id) or Session()
+        session.state = state
+        self._changed(user_id, session)
+
+    def __delitem__(self, user_id: int):
+        # The session may have expired in the meantime
+        self._cache.pop(user_id, None)
+        if self._shared is not None:
+            self._shared.delete(user_id)
+
+    def new_draft(self, user_id: int) -> Draft:
+        """Start a user's draft over."""
+        session = self._session(user_id) or Session()
+        session.draft = Draft()
+        self._changed(user_id, session)
+        return session.draft
+
+    def draft(self, user_id: int) -> Optional[Draft]:
+        """Return a user's draft or None if there is none."""
+        session = self._session(user_id)
+        return session.draft if session else None
+
+    def update_draft(self, user_id: int, **values: str) -> Optional[Draft]:
+        """Set fields of a user's draft, return None if there is none."""
+        session = self._session(user_id)
+        if session is None or session.draft is None:
+            return None
+        for name, value in values.items():
+            setattr(session.draft, name, value)
+        self._changed(user_id, session)
+        return session.draft
+
+    def load(self):
+        """Restore sessions saved by :meth:`save` which haven't expired."""
+        if self._shared is not None:
+            # Shared sessions are read on demand, expired ones are dropped
+            self._shared.purge(time.time() - self.ttl)
+            return
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Can't restore sessions: {e}")
+            return
+        now = time.time()
+        for user_id, (state, draft, touched) in saved.items():
+            if now - touched > self.ttl:
+                continue
+            session = Session(
+                State[state] if state else None,
+                Draft(**draft) if draft is not None else None,
+            )
+            self._cache[int(user_id)] = session
+            session.touched = touched
+        logger.info(f"Restored {len(self._cache)} sessions")
+
+    def save(self):
+        """Write sessions to the file atomically."""
+        if self._shared is not None:
+            # Every change has been written through already
+            self._shared.close()
+            return
+        if not self.path:
+            return
+        saved = {
+            user_id: (
+                session.state.name if session.state else None,
+                session.draft.as_dict() if session.draft else None,
+                session.touched,
+            )
+            for user_id, session in list(self._cache.items())
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(saved, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
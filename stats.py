@@ -0,0 +1,116 @@
+"""Per-(user, category) calibration aggregates.
+
+The calibration_stats table holds how many predictions of a user in a
+category have a known outcome and how many of those outcomes fell into the
+50% and 90% intervals. Triggers on raw_predictions update it in the same
+transaction as every write, so checking calibration is a primary key
+lookup.
+
+Run ``python stats.py verify`` to compare the table with raw_predictions or
+``python stats.py rebuild`` to also fix the differences.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sys
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+async def find_drift(storage: Storage, conn) -> dict:
+    """Recompute aggregates from raw_predictions and compare.
+
+    Args:
+        storage (Storage): storage whose statements to use
+        conn (Connection): connection to run the queries with
+
+    Returns:
+        dict: (user_id, category) -> (stored, expected) for every
+        mismatching key
+    """
+    expected = {
+        (r[0], r[1]): tuple(int(x) for x in r[2:])
+        for r in await conn.fetchall(storage.EXPECTED_STATS)
+    }
+    stored = {
+        (r[0], r[1]): tuple(r[2:])
+        for r in await conn.fetchall(storage.STORED_STATS)
+    }
+    drift = {}
+    for key in expected.keys() | stored.keys():
+        have = stored.get(key, (0, 0, 0))
+        want = expected.get(key, (0, 0, 0))
+        if have != want:
+            drift[key] = (have, want)
+    return drift
+
+
+async def rebuild(storage: Storage, fix: bool = True) -> dict:
+    """Verify calibration_stats and optionally overwrite drifted rows.
+
+    Args:
+        storage (Storage): opened storage
+        fix (bool): whether to write the recomputed values
+
+    Returns:
+        dict: drift found, see find_drift
+    """
+    async with storage.transaction() as conn:
+        if storage.LOCK_PREDICTIONS:
+            # Block writers for the duration of the comparison
+            await conn.fetchall(storage.LOCK_PREDICTIONS)
+        drift = await find_drift(storage, conn)
+        if fix:
+            for (user_id, category), (_, want) in drift.items():
+                await conn.execute(
+                    storage.REPLACE_STATS, (user_id, category, *want))
+    for (user_id, category), (have, want) in drift.items():
+        logger.warning(
+            f"Calibration stats drift for user {user_id}, category"
+            f" {category}: stored {have}, expected {want}"
+        )
+    return drift
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from storage import create_storage
+
+    if len(sys.argv) != 2 or sys.argv[1] not in ("verify", "rebuild"):
+        print("Usage: python stats.py verify|rebuild")
+        sys.exit(2)
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    backend = os.getenv("STORAGE", "mysql")
+    if backend == "sqlite":
+        options = dict(
+            path=os.getenv("SQLITE_PATH", "sessions/predictions.db"))
+    else:
+        options = dict(
+            host=os.getenv("HOST"),
+            user=os.getenv("USER"),
+            password=os.getenv("PASSWORD"),
+            database=os.getenv("DATABASE"),
+            minsize=1,
+            maxsize=1,
+        )
+        if backend == "postgres" and os.getenv("PORT"):
+            options["port"] = int(os.getenv("PORT"))
+    storage = create_storage(backend, **options)
+
+    async def main():
+        await storage.open()
+        try:
+            return await rebuild(storage, fix=sys.argv[1] == "rebuild")
+        finally:
+            await storage.close()
+
+    drift = asyncio.run(main())
+    print(f"{len(drift)} drifted (user, category) aggregates")
+    sys.exit(1 if drift and sys.argv[1] == "verify" else 0)
@@ -0,0 +1,705 @@
+"""Storage backends keeping users' predictions.
+
+Storage holds everything the backends share: the category cache, keyset
+pagination, ownership-scoped mutations and applying journaled writes.
+Subclasses provide a connection pool and their dialect's statements.
+Backends are chosen with :func:`create_storage`.
+"""
+from __future__ import annotations
+
+import re
+from abc import ABC, abstractmethod
+from datetime import date as date_type
+from typing import AsyncIterator, Optional, Sequence
+
+from cache import CategoryCache, DataVersions
+from metrics import name_statement
+
+# Columns of raw_predictions in the order helpers expect them
+COLUMNS: str = (
+    "id, user_id, date, task_description, task_category, unit_of_measure,"
+    " pred_low_50_conf, pred_high_50_conf, pred_low_90_conf,"
+    " pred_high_90_conf, actual_outcome, resolve_by"
+)
+LIST_FILTERS: dict[str, str] = {
+    "whole": "",
+    "empty": " AND actual_outcome IS NULL",
+}
+BACKENDS: tuple[str, ...] = ("mysql", "sqlite", "postgres")
+
+
+def _as_float(value) -> Optional[float]:
+    return None if value is None else float(value)
+
+
+def _as_date(value) -> date_type:
+    if isinstance(value, str):
+        return date_type.fromisoformat(value)
+    return value
+
+
+class Storage(ABC):
+    """Reads and writes users' predictions.
+
+    Every mutation is a single statement restricted by both the prediction
+    id and its owner, so the affected rows count tells whether the user
+    owns the prediction. calibration_stats is kept in step by triggers on
+    raw_predictions.
+
+    Statements are class attributes written in the backend's dialect.
+    PAGE_NEXT and PAGE_PREV contain a ``{filter}`` field for one of
+    LIST_FILTERS. Parameters of every statement come in the order of the
+    corresponding method's arguments, see :meth:`_params`.
+
+    Every mutation also bumps the user's token in ``versions``.
+
+    Args:
+        category_cache (CategoryCache): cache of users' categories, kept up
+        to date by add and delete
+    """
+
+    HAS_PREDICTIONS: str
+    CATEGORIES: str
+    PAGE_NEXT: str
+    PAGE_PREV: str
+    CALIBRATION_ALL: str
+    CALIBRATION_CATEGORY: str
+    # (category, resolved, hits_50, hits_90) of a user
+    CALIBRATION_BY_CATEGORY: str
+    # (year, month, resolved, hits_50, hits_90) of a user by prediction date
+    CALIBRATION_BY_MONTH: str
+    # (category, low_50, hi_50, low_90, hi_90, outcome) of a user's
+    # resolved predictions
+    RESOLVED: str
+    INSERT_PREDICTION: str
+    UPDATE_BOUNDS: str
+    SET_OUTCOME: str
+    DELETE_PREDICTION: str
+    # Contains an {ids} field for a list of ids, see _with_ids
+    OWNED_IDS: str
+    # (id, user_id, description, resolve_by) of unresolved predictions not
+    # reminded of yet, due by a date, of one worker's users, after a
+    # (resolve_by, id) pivot
+    DUE_PREDICTIONS: str
+    # Contain an {ids} field as OWNED_IDS does
+    PENDING_REMINDERS: str
+    MARK_REMINDED: str
+    SELECT_CHECKPOINT: str
+    SAVE_CHECKPOINT: str
+    # calibration_stats maintenance, see stats.py
+    LOCK_PREDICTIONS: Optional[str] = None
+    EXPECTED_STATS: str
+    STORED_STATS: str
+    REPLACE_STATS: str
+
+    # Schema versions, used by backends migrating with _apply_schema
+    SAVE_MIGRATION: str = ""
+    SCHEMA_LOCK: Optional[str] = None
+
+    # Parameter marker of the driver
+    PLACEHOLDER: str = "%s"
+
+    # Prefix showing a statement's plan instead of running it, a pattern
+    # of plan lines which read a whole table or index and a statement
+    # refreshing the planner's statistics, see explain
+    EXPLAIN: str = "EXPLAIN "
+    FULL_SCAN: str
+    ANALYZE: str
+
+    # Driver exceptions meaning the database is unreachable for a while,
+    # see is_transient
+    transient_errors: tuple = ()
+
+    def __init__(self, category_cache: Optional[CategoryCache] = None):
+        self.category_cache = category_cache or CategoryCache()
+        self.versions = DataVersions()
+        # Series of the statements in metrics.QUERY_SECONDS
+        for name in dir(type(self)):
+            query = getattr(type(self), name)
+            if not name.isupper() or not isinstance(query, str):
+                continue
+            if "{filter}" in query:
+                for kind, condition in LIST_FILTERS.items():
+                    name_statement(
+                        query.format(filter=condition), f"{name}_{kind}")
+            else:
+                name_statement(query, name)
+
+    @abstractmethod
+    async def open(self):
+        """Open the connection pool."""
+
+    @abstractmethod
+    async def close(self):
+        """Close the connection pool."""
+
+    @abstractmethod
+    async def migrate(self) -> list[int]:
+        """Bring the schema up to date, return applied versions."""
+
+    @abstractmethod
+    def acquire(self):
+        """Borrow a connection, see db.Pool.acquire."""
+
+    @abstractmethod
+    def transaction(self):
+        """Borrow a connection within a transaction."""
+
+    def is_transient(self, error: BaseException) -> bool:
+        """Tell whether retrying after an error may succeed."""
+        return isinstance(error, self.transient_errors)
+
+    def pool_usage(self) -> tuple[int, int, int]:
+        """Return connections in use, opened and allowed."""
+        return self.pool.in_use, self.pool.size, self.pool.maxsize
+
+    async def ping(self) -> bool:
+        """Check that the database answers."""
+        async with self.acquire() as conn:
+            return await conn.fetchone("SELECT 1") is not None
+
+    async def explain(
+        self, query: str, params: Sequence = None
+    ) -> tuple[list[str], bool]:
+        """Show how the database executes a statement.
+
+        Args:
+            query (str): statement in the backend's dialect
+            params (Sequence): its parameters
+
+        Returns:
+            tuple[list[str], bool]: lines of the plan and whether any of
+            them reads a whole table or index
+        """
+        async with self.acquire() as conn:
+            rows = await conn.fetchall(self.EXPLAIN + query, params)
+        # Plans come as a row per line or as one row, in the last column
+        lines = [line for row in rows for line in str(row[-1]).splitlines()]
+        return lines, any(re.search(self.FULL_SCAN, line) for line in lines)
+
+    async def _apply_schema(
+        self, schema: list[tuple[int, str, list[str]]]
+    ) -> list[int]:
+        """Apply pending schema versions in one transaction.
+
+        For backends with transactional DDL, a version is either applied
+        completely or not at all.
+
+        Args:
+            schema (list): (version, description, statements) in order
+
+        Returns:
+            list[int]: versions applied during this call
+        """
+        applied = []
+        async with self.transaction() as conn:
+            if self.SCHEMA_LOCK:
+                await conn.execute(self.SCHEMA_LOCK)
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                " version INTEGER PRIMARY KEY,"
+                " description VARCHAR(200),"
+                " applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+            )
+            rows = await conn.fetchall("SELECT version FROM schema_migrations")
+            done = {r[0] for r in rows}
+            for version, description, statements in schema:
+                if version in done:
+                    continue
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute(
+                    self.SAVE_MIGRATION, (version, description))
+                applied.append(version)
+        return applied
+
+    def _with_ids(
+        self, query: str, ids: Sequence, start: int = 1
+    ) -> tuple[str, tuple]:
+        """Fill a statement's ``{ids}`` field for a list of ids.
+
+        Args:
+            query (str): statement with an ``{ids}`` field
+            ids (Sequence): predictions' ids
+            start (int): position of the ids among the statement's
+            parameters, matters for numbered markers only
+
+        Returns:
+            tuple[str, tuple]: the statement and the parameters standing
+            for the ids
+        """
+        markers = ", ".join([self.PLACEHOLDER] * len(ids))
+        return query.format(ids=markers), tuple(ids)
+
+    async def _insert(self, conn, params: Sequence) -> int:
+        """Run INSERT_PREDICTION and return the new id."""
+        await conn.execute(self.INSERT_PREDICTION, params)
+        return conn.lastrowid
+
+    @staticmethod
+    def _params(op: str, args: Sequence) -> tuple:
+        """Convert a mutation's arguments into its statement's parameters.
+
+        Args:
+            op (str): add, update_bounds, set_outcome or delete
+            args (Sequence): arguments of the method of the same name
+
+        Returns:
+            tuple: parameters with numbers and dates in their column types
+        """
+        if op == "add":
+            (user_id, date, description, category, unit,
+             low_50, hi_50, low_90, hi_90, outcome, *rest) = args
+            # Entries journaled before resolution dates existed lack one
+            resolve_by = rest[0] if rest else None
+            return (
+                int(user_id), _as_date(date), description, category, unit,
+                float(low_50), float(hi_50), float(low_90), float(hi_90),
+                _as_float(outcome), _as_date(resolve_by),
+            )
+        if op == "update_bounds":
+            user_id, pred_id, low_50, hi_50, low_90, hi_90 = args
+            return (
+                float(low_50), float(hi_50), float(low_90), float(hi_90),
+                int(pred_id), int(user_id),
+            )
+        if op == "set_outcome":
+            user_id, pred_id, outcome = args
+            return float(outcome), int(pred_id), int(user_id)
+        if op == "delete":
+            user_id, pred_id = args
+            return int(pred_id), int(user_id)
+        raise ValueError(f"Unknown operation {op}")
+
+    def _statement(self, op: str) -> str:
+        return {
+            "add": self.INSERT_PREDICTION,
+            "update_bounds": self.UPDATE_BOUNDS,
+            "set_outcome": self.SET_OUTCOME,
+            "delete": self.DELETE_PREDICTION,
+        }[op]
+
+    async def _mutate(self, op: str, args: Sequence) -> bool:
+        async with self.acquire() as conn:
+            affected = await conn.execute(
+                self._statement(op), self._params(op, args))
+        if affected > 0:
+            # The owner is the first argument of every mutation
+            self.versions.bump(args[0])
+        return affected > 0
+
+    async def has_predictions(self, user_id: int) -> bool:
+        """Check whether a user has saved at least one prediction."""
+        async with self.acquire() as conn:
+            row = await conn.fetchone(self.HAS_PREDICTIONS, (user_id,))
+        return row is not None
+
+    async def categories(self, user_id: int) -> frozenset[str]:
+        """Return a user's distinct categories."""
+        categories = self.category_cache.get(user_id)
+        if categories is None:
+            async with self.acquire() as conn:
+                rows = await conn.fetchall(self.CATEGORIES, (user_id,))
+            categories = frozenset(r[0] for r in rows)
+            self.category_cache.put(user_id, categories)
+        return categories
+
+    async def page(
+        self,
+        user_id: int,
+        kind: str,
+        size: int,
+        direction: str = "next",
+        pivot: int = 0,
+    ) -> tuple[list, bool, bool]:
+        """Fetch one page of a user's predictions.
+
+        Pages are addressed by the id of the prediction they start after
+        (next) or end before (prev), so every page costs an index range
+        scan of size + 1 rows no matter how deep in the history it is.
+
+        Args:
+            user_id (int): owner of the predictions
+            kind (str): key of LIST_FILTERS
+            size (int): predictions per page
+            direction (str): "next" for rows after pivot, "prev" for rows
+            before it
+            pivot (int): id of the prediction the page is adjacent to
+
+        Returns:
+            tuple[list, bool, bool]: rows ordered by id, whether there is
+            a previous page and whether there is a next page
+        """
+        query = self.PAGE_NEXT if direction == "next" else self.PAGE_PREV
+        async with self.acquire() as conn:
+            rows = await conn.fetchall(
+                query.format(filter=LIST_FILTERS[kind]),
+                (user_id, pivot, size + 1),
+            )
+        more = len(rows) > size
+        rows = rows[:size]
+        if direction == "next":
+            return rows, pivot > 0, more
+        return rows[::-1], more, True
+
+    async def iter_predictions(
+        self, user_id: int, batch_size: int = 500
+    ) -> AsyncIterator[list]:
+        """Yield all of a user's predictions in batches ordered by id.
+
+        Every batch is a separate keyset query on a freshly borrowed
+        connection, so a long export doesn't hold one between batches.
+
+        Args:
+            user_id (int): owner of the predictions
+            batch_size (int): rows per batch
+
+        Yields:
+            list: rows in the order of COLUMNS
+        """
+        pivot = 0
+        while True:
+            rows, _, more = await self.page(
+                user_id, "whole", batch_size, "next", pivot)
+            if rows:
+                yield rows
+            if not more:
+                return
+            pivot = rows[-1][0]
+
+    async def calibration(
+        self, user_id: int, category: Optional[str] = None
+    ) -> tuple[int, int, int]:
+        """Read a user's calibration aggregates.
+
+        Args:
+            user_id (int): whose calibration to read
+            category (str): category name or None for all of them
+
+        Returns:
+            tuple[int, int, int]: resolved, 50% hit and 90% hit counts
+        """
+        async with self.acquire() as conn:
+            if category is None:
+                row = await conn.fetchone(self.CALIBRATION_ALL, (user_id,))
+            else:
+                row = await conn.fetchone(
+                    self.CALIBRATION_CATEGORY, (user_id, category))
+        if not row or row[0] is None:
+            return 0, 0, 0
+        return tuple(int(x) for x in row)
+
+    async def calibration_breakdown(self, user_id: int) -> tuple[list, list]:
+        """Read a user's calibration by category and by month.
+
+        Args:
+            user_id (int): whose calibration to read
+
+        Returns:
+            tuple[list, list]: (category, resolved, hits_50, hits_90) rows
+            ordered by category and (year, month, resolved, hits_50,
+            hits_90) rows ordered by date, both only with resolved
+            predictions
+        """
+        async with self.acquire() as conn:
+            by_category = await conn.fetchall(
+                self.CALIBRATION_BY_CATEGORY, (user_id,))
+            by_month = await conn.fetchall(
+                self.CALIBRATION_BY_MONTH, (user_id,))
+        by_category = sorted(
+            (r[0], *(int(x) for x in r[1:])) for r in by_category if r[1])
+        by_month = sorted(tuple(int(x) for x in r) for r in by_month)
+        return by_category, by_month
+
+    async def resolved(self, user_id: int) -> list:
+        """Read a user's predictions with known outcomes.
+
+        Args:
+            user_id (int): whose predictions to read
+
+        Returns:
+            list: (category, low_50, hi_50, low_90, hi_90, outcome) rows
+        """
+        async with self.acquire() as conn:
+            return await conn.fetchall(self.RESOLVED, (user_id,))
+
+    async def add(
+        self,
+        user_id: int,
+        date,
+        description: str,
+        category: str,
+        unit: str,
+        low_50,
+        hi_50,
+        low_90,
+        hi_90,
+        outcome=None,
+        resolve_by=None,
+    ) -> int:
+        """Save a new prediction and return its id."""
+        params = self._params("add", (
+            user_id, date, description, category, unit,
+            low_50, hi_50, low_90, hi_90, outcome, resolve_by))
+        async with self.acquire() as conn:
+            pred_id = await self._insert(conn, params)
+        self.category_cache.add(user_id, category)
+        self.versions.bump(user_id)
+        return pred_id
+
+    async def update_bounds(
+        self, user_id: int, pred_id, low_50, hi_50, low_90, hi_90
+    ) -> bool:
+        """Replace a prediction's intervals, return False if not owned."""
+        return await self._mutate(
+            "update_bounds",
+            (user_id, pred_id, low_50, hi_50, low_90, hi_90),
+        )
+
+    async def set_outcome(self, user_id: int, pred_id, outcome) -> bool:
+        """Record a prediction's outcome, return False if not owned."""
+        return await self._mutate(
+            "set_outcome", (user_id, pred_id, outcome))
+
+    async def delete(self, user_id: int, pred_id) -> bool:
+        """Delete a prediction, return False if not owned."""
+        deleted = await self._mutate("delete", (user_id, pred_id))
+        if deleted:
+            # The category may have lost its last prediction
+            self.category_cache.invalidate(user_id)
+        return deleted
+
+    async def owned_ids(self, conn, user_id: int, ids: Sequence) -> set:
+        """Select which of the given predictions belong to a user.
+
+        Args:
+            conn (Connection): connection to run the query with
+            user_id (int): supposed owner
+            ids (Sequence): predictions' ids
+
+        Returns:
+            set: ids owned by the user
+        """
+        ids = [int(i) for i in ids]
+        if not ids:
+            return set()
+        query, params = self._with_ids(self.OWNED_IDS, ids, 2)
+        rows = await conn.fetchall(query, (user_id, *params))
+        return {r[0] for r in rows}
+
+    async def add_many(self, user_id: int, predictions: list) -> int:
+        """Save many predictions of a user in one transaction.
+
+        Args:
+            user_id (int): owner of the predictions
+            predictions (list): add's arguments after user_id, one
+            sequence per prediction
+
+        Returns:
+            int: number of saved predictions
+        """
+        params = [self._params("add", (user_id, *p)) for p in predictions]
+        async with self.transaction() as conn:
+            await conn.executemany(self.INSERT_PREDICTION, params)
+        # Category is the third argument after user_id
+        for category in {p[2] for p in predictions}:
+            self.category_cache.add(user_id, category)
+        self.versions.bump(user_id)
+        return len(params)
+
+    async def _mutate_many(self, op: str, user_id: int, rows: list) -> set:
+        """Apply a mutation to many predictions in one transaction.
+
+        Ownership of all the predictions is checked with one query and
+        rows of strangers' predictions are skipped.
+
+        Args:
+            op (str): update_bounds, set_outcome or delete
+            user_id (int): owner of the predictions
+            rows (list): arguments of the method of the same name after
+            user_id, prediction id first
+
+        Returns:
+            set: ids of the user's predictions among the rows
+        """
+        async with self.transaction() as conn:
+            owned = await self.owned_ids(conn, user_id, [r[0] for r in rows])
+            params = [
+                self._params(op, (user_id, *row))
+                for row in rows
+                if int(row[0]) in owned
+            ]
+            if params:
+                await conn.executemany(self._statement(op), params)
+        if params:
+            self.versions.bump(user_id)
+        return owned
+
+    async def set_outcomes(self, user_id: int, outcomes: list) -> set:
+        """Record outcomes of many predictions in one transaction.
+
+        Args:
+            user_id (int): owner of the predictions
+            outcomes (list): (prediction id, outcome) pairs
+
+        Returns:
+            set: ids of the predictions which got their outcome
+        """
+        return await self._mutate_many("set_outcome", user_id, outcomes)
+
+    async def update_many(self, user_id: int, updates: list) -> set:
+        """Update bounds of many predictions in one transaction.
+
+        Args:
+            user_id (int): owner of the predictions
+            updates (list): (prediction id, low_50, hi_50, low_90, hi_90)
+
+        Returns:
+            set: ids of the updated predictions
+        """
+        return await self._mutate_many("update_bounds", user_id, updates)
+
+    async def delete_many(self, user_id: int, ids: list) -> set:
+        """Delete many predictions in one transaction.
+
+        Args:
+            user_id (int): owner of the predictions
+            ids (list): predictions' ids
+
+        Returns:
+            set: ids of the deleted predictions
+        """
+        owned = await self._mutate_many(
+            "delete", user_id, [(pred_id,) for pred_id in ids])
+        if owned:
+            self.category_cache.invalidate(user_id)
+        return owned
+
+    async def due_predictions(
+        self,
+        until,
+        workers: int = 1,
+        worker: int = 0,
+        after: tuple = (date_type.min, 0),
+        limit: int = 1000,
+    ) -> list:
+        """Read predictions waiting for a reminder, by resolution date.
+
+        Only unresolved predictions not reminded of yet are indexed by
+        their resolution date, so a page costs a range scan of that index
+        however many predictions are kept.
+
+        Args:
+            until (date): latest resolution date to read
+            workers (int): number of worker processes
+            worker (int): index of the worker whose users to read, see
+            workers.shard
+            after (tuple): (resolve_by, id) of the last row of the previous
+            page
+            limit (int): rows per page
+
+        Returns:
+            list: (id, user_id, description, resolve_by) rows ordered by
+            resolution date and id
+        """
+        async with self.acquire() as conn:
+            rows = await conn.fetchall(
+                self.DUE_PREDICTIONS,
+                (until, workers, worker, *after, limit),
+            )
+        return [(r[0], r[1], r[2], _as_date(r[3])) for r in rows]
+
+    async def claim_reminders(self, ids: Sequence) -> set:
+        """Mark predictions as reminded of, unless resolved or reminded.
+
+        The check and the mark are one transaction which commits before
+        any reminder is sent, so a restart never repeats a reminder; one
+        lost in a crash in between isn't sent at all.
+
+        Args:
+            ids (Sequence): predictions' ids
+
+        Returns:
+            set: ids of the predictions to remind of
+        """
+        ids = [int(i) for i in ids]
+        if not ids:
+            return set()
+        async with self.transaction() as conn:
+            rows = await conn.fetchall(
+                *self._with_ids(self.PENDING_REMINDERS, ids))
+            pending = [r[0] for r in rows]
+            if pending:
+                await conn.execute(
+                    *self._with_ids(self.MARK_REMINDED, pending))
+        return set(pending)
+
+    async def journal_checkpoint(self, name: str) -> int:
+        """Return the last applied entry of a write-behind journal."""
+        async with self.acquire() as conn:
+            row = await conn.fetchone(self.SELECT_CHECKPOINT, (name,))
+        return row[0] if row else 0
+
+    async def save_journal_checkpoint(self, name: str, seq: int):
+        """Mark a journal's entries up to seq as applied."""
+        async with self.acquire() as conn:
+            await conn.execute(self.SAVE_CHECKPOINT, (name, seq))
+
+    async def apply_journal(self, name: str, records: list[dict]) -> list:
+        """Apply journal entries and advance the checkpoint atomically.
+
+        Args:
+            name (str): journal's name
+            records (list[dict]): entries with "op", "user_id" and "args"
+
+        Returns:
+            list: entries which affected no rows
+        """
+        rejected = []
+        async with self.transaction() as conn:
+            for record in records:
+                op = record["op"]
+                affected = await conn.execute(
+                    self._statement(op), self._params(op, record["args"]))
+                if affected == 0:
+                    rejected.append(record)
+            await conn.execute(
+                self.SAVE_CHECKPOINT, (name, records[-1]["seq"]))
+        for record in records:
+            if record not in rejected:
+                self.versions.bump(record["user_id"])
+            if record["op"] == "add":
+                # Category is the fourth argument of add
+                self.category_cache.add(
+                    record["user_id"], record["args"][3])
+            elif record["op"] == "delete" and record not in rejected:
+                self.category_cache.invalidate(record["user_id"])
+        return rejected
+
+
+def create_storage(
+    backend: str,
+    category_cache: Optional[CategoryCache] = None,
+    **options,
+) -> Storage:
+    """Create a storage backend, importing its driver on demand.
+
+    Args:
+        backend (str): one of BACKENDS
+        category_cache (CategoryCache): cache of users' categories
+        options: backend's constructor arguments
+
+    Returns:
+        Storage: storage which is not opened yet
+    """
+    if backend == "mysql":
+        from storage_mysql import MySQLStorage
+        return MySQLStorage(category_cache=category_cache, **options)
+    if backend == "sqlite":
+        from storage_sqlite import SQLiteStorage
+        return SQLiteStorage(category_cache=category_cache, **options)
+    if backend == "postgres":
+        from storage_postgres import PostgresStorage
+        return PostgresStorage(category_cache=category_cache, **options)
+    raise ValueError(
+        f"Unknown storage backend {backend}, choose one of {BACKENDS}")
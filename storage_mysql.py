@@ -0,0 +1,209 @@
+"""MySQL storage backend."""
+from __future__ import annotations
+
+from functools import partial
+from typing import Optional
+
+import mysql.connector
+from mysql.connector.constants import ClientFlag
+
+from cache import CategoryCache
+from db import Pool
+from migrations import migrate
+from storage import COLUMNS, Storage
+
+
+class MySQLStorage(Storage):
+    """Predictions kept in MySQL.
+
+    Queries run on pooled mysql.connector connections as server-side
+    prepared statements; schema changes are applied by migrations.py.
+
+    Args:
+        host (str): database host
+        user (str): database user
+        password (str): database user's password
+        database (str): database name
+        minsize (int): connections opened on start
+        maxsize (int): maximum number of simultaneous connections
+        acquire_timeout (float): seconds to wait for a free connection
+        category_cache (CategoryCache): cache of users' categories
+    """
+
+    HAS_PREDICTIONS = (
+        "SELECT 1 FROM predictions.raw_predictions"
+        " WHERE user_id = %s LIMIT 1"
+    )
+    CATEGORIES = (
+        "SELECT DISTINCT task_category FROM predictions.raw_predictions"
+        " WHERE user_id = %s"
+    )
+    PAGE_NEXT = (
+        f"SELECT {COLUMNS} FROM predictions.raw_predictions"
+        " WHERE user_id = %s{filter} AND id > %s ORDER BY id LIMIT %s"
+    )
+    PAGE_PREV = (
+        f"SELECT {COLUMNS} FROM predictions.raw_predictions"
+        " WHERE user_id = %s{filter} AND id < %s ORDER BY id DESC LIMIT %s"
+    )
+    CALIBRATION_ALL = (
+        "SELECT SUM(resolved), SUM(hits_50), SUM(hits_90)"
+        " FROM predictions.calibration_stats WHERE user_id = %s"
+    )
+    CALIBRATION_CATEGORY = (
+        "SELECT resolved, hits_50, hits_90"
+        " FROM predictions.calibration_stats"
+        " WHERE user_id = %s AND task_category = %s"
+    )
+    CALIBRATION_BY_CATEGORY = (
+        "SELECT task_category, resolved, hits_50, hits_90"
+        " FROM predictions.calibration_stats WHERE user_id = %s"
+    )
+    CALIBRATION_BY_MONTH = (
+        "SELECT YEAR(date), MONTH(date), COUNT(*),"
+        " SUM(pred_low_50_conf <= actual_outcome"
+        " AND pred_high_50_conf >= actual_outcome),"
+        " SUM(pred_low_90_conf <= actual_outcome"
+        " AND pred_high_90_conf >= actual_outcome)"
+        " FROM predictions.raw_predictions"
+        " WHERE user_id = %s AND actual_outcome IS NOT NULL"
+        " AND date IS NOT NULL"
+        " GROUP BY YEAR(date), MONTH(date)"
+    )
+    RESOLVED = (
+        "SELECT task_category, pred_low_50_conf, pred_high_50_conf,"
+        " pred_low_90_conf, pred_high_90_conf, actual_outcome"
+        " FROM predictions.raw_predictions"
+        " WHERE user_id = %s AND actual_outcome IS NOT NULL"
+    )
+    INSERT_PREDICTION = (
+        "INSERT INTO predictions.raw_predictions ("
+        " user_id, date, task_description, task_category,"
+        " unit_of_measure, pred_low_50_conf, pred_high_50_conf,"
+        " pred_low_90_conf, pred_high_90_conf, actual_outcome,"
+        " resolve_by)"
+        " VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+    )
+    UPDATE_BOUNDS = (
+        "UPDATE predictions.raw_predictions SET"
+        " pred_low_50_conf = %s, pred_high_50_conf = %s,"
+        " pred_low_90_conf = %s, pred_high_90_conf = %s"
+        " WHERE id = %s AND user_id = %s"
+    )
+    SET_OUTCOME = (
+        "UPDATE predictions.raw_predictions SET actual_outcome = %s"
+        " WHERE id = %s AND user_id = %s"
+    )
+    DELETE_PREDICTION = (
+        "DELETE FROM predictions.raw_predictions"
+        " WHERE id = %s AND user_id = %s"
+    )
+    OWNED_IDS = (
+        "SELECT id FROM predictions.raw_predictions"
+        " WHERE user_id = %s AND id IN ({ids})"
+    )
+    DUE_PREDICTIONS = (
+        "SELECT id, user_id, task_description, resolve_by"
+        " FROM predictions.raw_predictions"
+        " WHERE reminded_at IS NULL AND actual_outcome IS NULL"
+        " AND resolve_by <= %s AND MOD(user_id, %s) = %s"
+        " AND (resolve_by, id) > (%s, %s)"
+        " ORDER BY resolve_by, id LIMIT %s"
+    )
+    PENDING_REMINDERS = (
+        "SELECT id FROM predictions.raw_predictions WHERE id IN ({ids})"
+        " AND actual_outcome IS NULL AND reminded_at IS NULL FOR UPDATE"
+    )
+    MARK_REMINDED = (
+        "UPDATE predictions.raw_predictions"
+        " SET reminded_at = CURRENT_TIMESTAMP WHERE id IN ({ids})"
+    )
+    SELECT_CHECKPOINT = (
+        "SELECT seq FROM predictions.journal_checkpoint WHERE name = %s"
+    )
+    SAVE_CHECKPOINT = (
+        "REPLACE INTO predictions.journal_checkpoint (name, seq)"
+        " VALUES (%s, %s)"
+    )
+    LOCK_PREDICTIONS = "SELECT id FROM predictions.raw_predictions FOR SHARE"
+    EXPECTED_STATS = (
+        "SELECT user_id, task_category, COUNT(*),"
+        " SUM(pred_low_50_conf <= actual_outcome"
+        " AND pred_high_50_conf >= actual_outcome),"
+        " SUM(pred_low_90_conf <= actual_outcome"
+        " AND pred_high_90_conf >= actual_outcome)"
+        " FROM predictions.raw_predictions"
+        " WHERE actual_outcome IS NOT NULL"
+        " GROUP BY user_id, task_category"
+    )
+    STORED_STATS = (
+        "SELECT user_id, task_category, resolved, hits_50, hits_90"
+        " FROM predictions.calibration_stats"
+    )
+    REPLACE_STATS = (
+        "REPLACE INTO predictions.calibration_stats"
+        " (user_id, task_category, resolved, hits_50, hits_90)"
+        " VALUES (%s, %s, %s, %s, %s)"
+    )
+
+    EXPLAIN = "EXPLAIN FORMAT=TREE "
+    FULL_SCAN = r"(Table|Index) scan on"
+    ANALYZE = (
+        "ANALYZE TABLE predictions.raw_predictions,"
+        " predictions.calibration_stats"
+    )
+
+    transient_errors = (
+        mysql.connector.errors.OperationalError,
+        mysql.connector.errors.InterfaceError,
+    )
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        database: str,
+        minsize: int = 2,
+        maxsize: int = 10,
+        acquire_timeout: float = 10.0,
+        category_cache: Optional[CategoryCache] = None,
+    ):
+        super().__init__(category_cache)
+        self.pool = Pool(
+            partial(
+                mysql.connector.connect,
+                host=host,
+                user=user,
+                password=password,
+                database=database,
+                autocommit=True,
+                # Report matched rather than changed rows, ownership checks
+                # rely on it when a value is rewritten with itself
+                client_flags=[ClientFlag.FOUND_ROWS],
+            ),
+            minsize=minsize,
+            maxsize=maxsize,
+            acquire_timeout=acquire_timeout,
+            prepare=True,
+        )
+
+    async def open(self):
+        """Open the connection pool."""
+        await self.pool.open()
+
+    async def close(self):
+        """Close the connection pool."""
+        await self.pool.close()
+
+    async def migrate(self) -> list[int]:
+        """Apply pending migrations from migrations.py."""
+        return await migrate(self.pool)
+
+    def acquire(self):
+        """Borrow a pooled connection."""
+        return self.pool.acquire()
+
+    def transaction(self):
+        """Borrow a pooled connection within a transaction."""
+        return self.pool.transaction()
@@ -0,0 +1,345 @@
+"""Native-async PostgreSQL storage backend."""
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional, Sequence
+
+import asyncpg
+
+from cache import CategoryCache
+from metrics import QUERY_SECONDS, statement_name
+from storage import COLUMNS, Storage
+
+
+def _hit(row: str, level: int) -> str:
+    return (
+        f"({row}.pred_low_{level}_conf <= {row}.actual_outcome"
+        f" AND {row}.pred_high_{level}_conf >= {row}.actual_outcome)::int"
+    )
+
+
+STATS_FUNCTION: str = f"""
+CREATE OR REPLACE FUNCTION calibration_stats_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.actual_outcome IS NOT NULL THEN
+        UPDATE calibration_stats SET
+            resolved = resolved - 1,
+            hits_50 = hits_50 - {_hit("OLD", 50)},
+            hits_90 = hits_90 - {_hit("OLD", 90)}
+        WHERE user_id = OLD.user_id AND task_category = OLD.task_category;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.actual_outcome IS NOT NULL THEN
+        INSERT INTO calibration_stats
+            (user_id, task_category, resolved, hits_50, hits_90)
+        VALUES (NEW.user_id, NEW.task_category, 1,
+            {_hit("NEW", 50)}, {_hit("NEW", 90)})
+        ON CONFLICT (user_id, task_category) DO UPDATE SET
+            resolved = calibration_stats.resolved + 1,
+            hits_50 = calibration_stats.hits_50 + EXCLUDED.hits_50,
+            hits_90 = calibration_stats.hits_90 + EXCLUDED.hits_90;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql"""
+
+SCHEMA: list[tuple[int, str, list[str]]] = [
+    (1, "create tables", [
+        """CREATE TABLE IF NOT EXISTS raw_predictions (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            date DATE,
+            task_description VARCHAR(200),
+            task_category VARCHAR(50),
+            unit_of_measure VARCHAR(30),
+            pred_low_50_conf DOUBLE PRECISION,
+            pred_high_50_conf DOUBLE PRECISION,
+            pred_low_90_conf DOUBLE PRECISION,
+            pred_high_90_conf DOUBLE PRECISION,
+            actual_outcome DOUBLE PRECISION)""",
+        "CREATE INDEX IF NOT EXISTS ix_user_id"
+        " ON raw_predictions (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_category"
+        " ON raw_predictions (user_id, task_category)",
+        "CREATE INDEX IF NOT EXISTS ix_user_outcome"
+        " ON raw_predictions (user_id, actual_outcome)",
+        """CREATE TABLE IF NOT EXISTS calibration_stats (
+            user_id BIGINT NOT NULL,
+            task_category VARCHAR(50) NOT NULL,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            hits_50 INTEGER NOT NULL DEFAULT 0,
+            hits_90 INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, task_category))""",
+        STATS_FUNCTION,
+        "DROP TRIGGER IF EXISTS raw_predictions_stats ON raw_predictions",
+        "CREATE TRIGGER raw_predictions_stats"
+        " AFTER INSERT OR UPDATE OR DELETE ON raw_predictions"
+        " FOR EACH ROW EXECUTE FUNCTION calibration_stats_change()",
+        """CREATE TABLE IF NOT EXISTS journal_checkpoint (
+            name VARCHAR(100) PRIMARY KEY,
+            seq BIGINT NOT NULL)""",
+    ]),
+    (2, "add resolution dates", [
+        "ALTER TABLE raw_predictions ADD COLUMN IF NOT EXISTS resolve_by DATE",
+        "ALTER TABLE raw_predictions"
+        " ADD COLUMN IF NOT EXISTS reminded_at TIMESTAMP",
+        # Only predictions still waiting for a reminder are indexed
+        "CREATE INDEX IF NOT EXISTS ix_due"
+        " ON raw_predictions (resolve_by, id)"
+        " WHERE actual_outcome IS NULL AND reminded_at IS NULL"
+        " AND resolve_by IS NOT NULL",
+    ]),
+]
+
+
+class PgConnection:
+    """asyncpg connection with the interface of db.Connection.
+
+    asyncpg prepares and caches every statement it runs on a connection,
+    so repeated queries skip parsing and planning.
+    """
+
+    def __init__(self, raw: asyncpg.Connection):
+        self.raw = raw
+        self.rowcount: int = -1
+        self.lastrowid = None
+
+    async def fetchall(self, query: str, params: Sequence = None) -> list:
+        """Run a query and return all the rows it produced."""
+        with QUERY_SECONDS.time(statement_name(query)):
+            return await self.raw.fetch(query, *(params or ()))
+
+    async def fetchone(self, query: str, params: Sequence = None):
+        """Run a query and return its first row or None."""
+        with QUERY_SECONDS.time(statement_name(query)):
+            return await self.raw.fetchrow(query, *(params or ()))
+
+    async def execute(self, query: str, params: Sequence = None) -> int:
+        """Run a statement, return affected rows count."""
+        with QUERY_SECONDS.time(statement_name(query)):
+            status = await self.raw.execute(query, *(params or ()))
+        # Status looks like "UPDATE 3" or "INSERT 0 1"
+        last = status.rsplit(" ", 1)[-1]
+        self.rowcount = int(last) if last.isdigit() else -1
+        return self.rowcount
+
+    async def executemany(self, query: str, seq_params: Sequence) -> int:
+        """Run a statement for every parameters set in seq_params."""
+        with QUERY_SECONDS.time(statement_name(query)):
+            await self.raw.executemany(query, seq_params)
+        self.rowcount = len(seq_params)
+        return self.rowcount
+
+
+class PostgresStorage(Storage):
+    """Predictions kept in PostgreSQL, accessed with asyncpg.
+
+    Args:
+        host (str): database host
+        user (str): database user
+        password (str): database user's password
+        database (str): database name
+        port (int): database port, the driver's default if None
+        minsize (int): connections opened on start
+        maxsize (int): maximum number of simultaneous connections
+        acquire_timeout (float): seconds to wait for a free connection
+        category_cache (CategoryCache): cache of users' categories
+    """
+
+    HAS_PREDICTIONS = (
+        "SELECT 1 FROM raw_predictions WHERE user_id = $1 LIMIT 1"
+    )
+    CATEGORIES = (
+        "SELECT DISTINCT task_category FROM raw_predictions"
+        " WHERE user_id = $1"
+    )
+    PAGE_NEXT = (
+        f"SELECT {COLUMNS} FROM raw_predictions"
+        " WHERE user_id = $1{filter} AND id > $2 ORDER BY id LIMIT $3"
+    )
+    PAGE_PREV = (
+        f"SELECT {COLUMNS} FROM raw_predictions"
+        " WHERE user_id = $1{filter} AND id < $2 ORDER BY id DESC LIMIT $3"
+    )
+    CALIBRATION_ALL = (
+        "SELECT SUM(resolved), SUM(hits_50), SUM(hits_90)"
+        " FROM calibration_stats WHERE user_id = $1"
+    )
+    CALIBRATION_CATEGORY = (
+        "SELECT resolved, hits_50, hits_90 FROM calibration_stats"
+        " WHERE user_id = $1 AND task_category = $2"
+    )
+    CALIBRATION_BY_CATEGORY = (
+        "SELECT task_category, resolved, hits_50, hits_90"
+        " FROM calibration_stats WHERE user_id = $1"
+    )
+    CALIBRATION_BY_MONTH = (
+        "SELECT EXTRACT(YEAR FROM date)::int, EXTRACT(MONTH FROM date)::int,"
+        " COUNT(*),"
+        f" SUM({_hit('raw_predictions', 50)}),"
+        f" SUM({_hit('raw_predictions', 90)})"
+        " FROM raw_predictions"
+        " WHERE user_id = $1 AND actual_outcome IS NOT NULL"
+        " AND date IS NOT NULL"
+        " GROUP BY 1, 2"
+    )
+    RESOLVED = (
+        "SELECT task_category, pred_low_50_conf, pred_high_50_conf,"
+        " pred_low_90_conf, pred_high_90_conf, actual_outcome"
+        " FROM raw_predictions"
+        " WHERE user_id = $1 AND actual_outcome IS NOT NULL"
+    )
+    INSERT_PREDICTION = (
+        "INSERT INTO raw_predictions ("
+        " user_id, date, task_description, task_category,"
+        " unit_of_measure, pred_low_50_conf, pred_high_50_conf,"
+        " pred_low_90_conf, pred_high_90_conf, actual_outcome,"
+        " resolve_by)"
+        " VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)"
+    )
+    INSERT_RETURNING = INSERT_PREDICTION + " RETURNING id"
+    UPDATE_BOUNDS = (
+        "UPDATE raw_predictions SET"
+        " pred_low_50_conf = $1, pred_high_50_conf = $2,"
+        " pred_low_90_conf = $3, pred_high_90_conf = $4"
+        " WHERE id = $5 AND user_id = $6"
+    )
+    SET_OUTCOME = (
+        "UPDATE raw_predictions SET actual_outcome = $1"
+        " WHERE id = $2 AND user_id = $3"
+    )
+    DELETE_PREDICTION = (
+        "DELETE FROM raw_predictions WHERE id = $1 AND user_id = $2"
+    )
+    OWNED_IDS = (
+        "SELECT id FROM raw_predictions WHERE user_id = $1 AND id = ANY({ids})"
+    )
+    DUE_PREDICTIONS = (
+        "SELECT id, user_id, task_description, resolve_by"
+        " FROM raw_predictions"
+        " WHERE actual_outcome IS NULL AND reminded_at IS NULL"
+        " AND resolve_by <= $1 AND user_id % $2 = $3"
+        " AND (resolve_by, id) > ($4, $5)"
+        " ORDER BY resolve_by, id LIMIT $6"
+    )
+    PENDING_REMINDERS = (
+        "SELECT id FROM raw_predictions WHERE id = ANY({ids})"
+        " AND actual_outcome IS NULL AND reminded_at IS NULL FOR UPDATE"
+    )
+    MARK_REMINDED = (
+        "UPDATE raw_predictions SET reminded_at = CURRENT_TIMESTAMP"
+        " WHERE id = ANY({ids})"
+    )
+    SELECT_CHECKPOINT = "SELECT seq FROM journal_checkpoint WHERE name = $1"
+    SAVE_CHECKPOINT = (
+        "INSERT INTO journal_checkpoint (name, seq) VALUES ($1, $2)"
+        " ON CONFLICT (name) DO UPDATE SET seq = EXCLUDED.seq"
+    )
+    LOCK_PREDICTIONS = "LOCK TABLE raw_predictions IN SHARE MODE"
+    EXPECTED_STATS = (
+        "SELECT user_id, task_category, COUNT(*),"
+        f" SUM({_hit('raw_predictions', 50)}),"
+        f" SUM({_hit('raw_predictions', 90)})"
+        " FROM raw_predictions WHERE actual_outcome IS NOT NULL"
+        " GROUP BY user_id, task_category"
+    )
+    STORED_STATS = (
+        "SELECT user_id, task_category, resolved, hits_50, hits_90"
+        " FROM calibration_stats"
+    )
+    REPLACE_STATS = (
+        "INSERT INTO calibration_stats"
+        " (user_id, task_category, resolved, hits_50, hits_90)"
+        " VALUES ($1, $2, $3, $4, $5)"
+        " ON CONFLICT (user_id, task_category) DO UPDATE SET"
+        " resolved = EXCLUDED.resolved, hits_50 = EXCLUDED.hits_50,"
+        " hits_90 = EXCLUDED.hits_90"
+    )
+    SAVE_MIGRATION = (
+        "INSERT INTO schema_migrations (version, description)"
+        " VALUES ($1, $2)"
+    )
+    # Serialises schema changes of concurrently starting instances
+    SCHEMA_LOCK = "SELECT pg_advisory_xact_lock(7207454841)"
+
+    FULL_SCAN = r"Seq Scan on"
+    ANALYZE = "ANALYZE raw_predictions, calibration_stats"
+
+    transient_errors = (
+        asyncpg.PostgresConnectionError,
+        asyncpg.InterfaceError,
+        asyncpg.CannotConnectNowError,
+        asyncio.TimeoutError,
+    )
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        database: str,
+        port: Optional[int] = None,
+        minsize: int = 2,
+        maxsize: int = 10,
+        acquire_timeout: float = 10.0,
+        category_cache: Optional[CategoryCache] = None,
+    ):
+        super().__init__(category_cache)
+        self._connect_options = dict(
+            host=host,
+            port=port,
+            user=user,
+            password=password,
+            database=database,
+            min_size=minsize,
+            max_size=maxsize,
+        )
+        self.acquire_timeout = acquire_timeout
+        self.pool: Optional[asyncpg.Pool] = None
+
+    async def open(self):
+        """Open the connection pool."""
+        self.pool = await asyncpg.create_pool(**self._connect_options)
+
+    async def close(self):
+        """Close the connection pool."""
+        await self.pool.close()
+
+    def pool_usage(self) -> tuple[int, int, int]:
+        """Return connections in use, opened and allowed."""
+        size = self.pool.get_size() if self.pool else 0
+        idle = self.pool.get_idle_size() if self.pool else 0
+        return size - idle, size, self._connect_options["max_size"]
+
+    async def migrate(self) -> list[int]:
+        """Create the schema if it isn't there yet."""
+        return await self._apply_schema(SCHEMA)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow a pooled connection."""
+        async with self.pool.acquire(timeout=self.acquire_timeout) as raw:
+            yield PgConnection(raw)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Borrow a pooled connection within a transaction."""
+        async with self.pool.acquire(timeout=self.acquire_timeout) as raw:
+            async with raw.transaction():
+                yield PgConnection(raw)
+
+    def _with_ids(
+        self, query: str, ids: Sequence, start: int = 1
+    ) -> tuple[str, tuple]:
+        """Pass the ids as one array parameter.
+
+        The statement's text doesn't depend on the number of ids, so
+        asyncpg prepares it once per connection.
+        """
+        return query.format(ids=f"${start}::bigint[]"), (list(ids),)
+
+    async def _insert(self, conn: PgConnection, params: Sequence) -> int:
+        """Insert a prediction returning its id in the same round trip."""
+        row = await conn.fetchone(
+            self.INSERT_RETURNING, params)
+        return row[0]
@@ -0,0 +1,289 @@
+"""Embedded SQLite storage backend for single-node installs and CI."""
+from __future__ import annotations
+
+import sqlite3
+from datetime import date as date_type
+from typing import Optional
+
+from cache import CategoryCache
+from db import Pool
+from storage import COLUMNS, Storage
+
+sqlite3.register_adapter(date_type, date_type.isoformat)
+sqlite3.register_converter(
+    "DATE", lambda value: date_type.fromisoformat(value.decode()))
+
+
+def _hit(row: str, level: int) -> str:
+    return (
+        f"({row}.pred_low_{level}_conf <= {row}.actual_outcome"
+        f" AND {row}.pred_high_{level}_conf >= {row}.actual_outcome)"
+    )
+
+
+def _stats_trigger(name: str, event: str, row: str, sign: str) -> str:
+    """Trigger moving calibration_stats by a row's contribution."""
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event}"
+        f" ON raw_predictions WHEN {row}.actual_outcome IS NOT NULL BEGIN"
+        " INSERT INTO calibration_stats"
+        " (user_id, task_category, resolved, hits_50, hits_90)"
+        f" VALUES ({row}.user_id, {row}.task_category, {sign}1,"
+        f" {sign}{_hit(row, 50)}, {sign}{_hit(row, 90)})"
+        " ON CONFLICT (user_id, task_category) DO UPDATE SET"
+        " resolved = resolved + excluded.resolved,"
+        " hits_50 = hits_50 + excluded.hits_50,"
+        " hits_90 = hits_90 + excluded.hits_90;"
+        " END"
+    )
+
+
+SCHEMA: list[tuple[int, str, list[str]]] = [
+    (1, "create tables", [
+        """CREATE TABLE IF NOT EXISTS raw_predictions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date DATE,
+            task_description TEXT,
+            task_category TEXT,
+            unit_of_measure TEXT,
+            pred_low_50_conf REAL,
+            pred_high_50_conf REAL,
+            pred_low_90_conf REAL,
+            pred_high_90_conf REAL,
+            actual_outcome REAL)""",
+        "CREATE INDEX IF NOT EXISTS ix_user_id"
+        " ON raw_predictions (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_category"
+        " ON raw_predictions (user_id, task_category)",
+        "CREATE INDEX IF NOT EXISTS ix_user_outcome"
+        " ON raw_predictions (user_id, actual_outcome)",
+        """CREATE TABLE IF NOT EXISTS calibration_stats (
+            user_id INTEGER NOT NULL,
+            task_category TEXT NOT NULL,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            hits_50 INTEGER NOT NULL DEFAULT 0,
+            hits_90 INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, task_category)) WITHOUT ROWID""",
+        _stats_trigger("raw_predictions_ai", "INSERT", "NEW", "+"),
+        _stats_trigger("raw_predictions_au_old", "UPDATE", "OLD", "-"),
+        _stats_trigger("raw_predictions_au_new", "UPDATE", "NEW", "+"),
+        _stats_trigger("raw_predictions_ad", "DELETE", "OLD", "-"),
+        """CREATE TABLE IF NOT EXISTS journal_checkpoint (
+            name TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL)""",
+    ]),
+    (2, "add resolution dates", [
+        "ALTER TABLE raw_predictions ADD COLUMN resolve_by DATE",
+        "ALTER TABLE raw_predictions ADD COLUMN reminded_at TIMESTAMP",
+        # Only predictions still waiting for a reminder are indexed
+        "CREATE INDEX IF NOT EXISTS ix_due"
+        " ON raw_predictions (resolve_by, id)"
+        " WHERE actual_outcome IS NULL AND reminded_at IS NULL"
+        " AND resolve_by IS NOT NULL",
+    ]),
+]
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a connection in autocommit and WAL mode.
+
+    Args:
+        path (str): database file
+
+    Returns:
+        sqlite3.Connection: connection usable from any pool thread
+    """
+    conn = sqlite3.connect(
+        path,
+        timeout=30,
+        isolation_level=None,
+        check_same_thread=False,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL keeps the database consistent after a crash without a full sync
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SQLiteStorage(Storage):
+    """Predictions kept in a local SQLite file.
+
+    WAL mode lets readers proceed while a write is in progress, writes
+    start with BEGIN IMMEDIATE so concurrent writers wait for the lock
+    instead of failing on upgrade.
+
+    Args:
+        path (str): database file
+        maxsize (int): maximum number of simultaneous connections
+        acquire_timeout (float): seconds to wait for a free connection
+        category_cache (CategoryCache): cache of users' categories
+    """
+
+    HAS_PREDICTIONS = (
+        "SELECT 1 FROM raw_predictions WHERE user_id = ? LIMIT 1"
+    )
+    CATEGORIES = (
+        "SELECT DISTINCT task_category FROM raw_predictions"
+        " WHERE user_id = ?"
+    )
+    PAGE_NEXT = (
+        f"SELECT {COLUMNS} FROM raw_predictions"
+        " WHERE user_id = ?{filter} AND id > ? ORDER BY id LIMIT ?"
+    )
+    PAGE_PREV = (
+        f"SELECT {COLUMNS} FROM raw_predictions"
+        " WHERE user_id = ?{filter} AND id < ? ORDER BY id DESC LIMIT ?"
+    )
+    CALIBRATION_ALL = (
+        "SELECT SUM(resolved), SUM(hits_50), SUM(hits_90)"
+        " FROM calibration_stats WHERE user_id = ?"
+    )
+    CALIBRATION_CATEGORY = (
+        "SELECT resolved, hits_50, hits_90 FROM calibration_stats"
+        " WHERE user_id = ? AND task_category = ?"
+    )
+    CALIBRATION_BY_CATEGORY = (
+        "SELECT task_category, resolved, hits_50, hits_90"
+        " FROM calibration_stats WHERE user_id = ?"
+    )
+    CALIBRATION_BY_MONTH = (
+        "SELECT CAST(strftime('%Y', date) AS INTEGER),"
+        " CAST(strftime('%m', date) AS INTEGER), COUNT(*),"
+        f" SUM({_hit('raw_predictions', 50)}),"
+        f" SUM({_hit('raw_predictions', 90)})"
+        " FROM raw_predictions"
+        " WHERE user_id = ? AND actual_outcome IS NOT NULL"
+        " AND date IS NOT NULL"
+        " GROUP BY 1, 2"
+    )
+    RESOLVED = (
+        "SELECT task_category, pred_low_50_conf, pred_high_50_conf,"
+        " pred_low_90_conf, pred_high_90_conf, actual_outcome"
+        " FROM raw_predictions"
+        " WHERE user_id = ? AND actual_outcome IS NOT NULL"
+    )
+    INSERT_PREDICTION = (
+        "INSERT INTO raw_predictions ("
+        " user_id, date, task_description, task_category,"
+        " unit_of_measure, pred_low_50_conf, pred_high_50_conf,"
+        " pred_low_90_conf, pred_high_90_conf, actual_outcome,"
+        " resolve_by)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    UPDATE_BOUNDS = (
+        "UPDATE raw_predictions SET"
+        " pred_low_50_conf = ?, pred_high_50_conf = ?,"
+        " pred_low_90_conf = ?, pred_high_90_conf = ?"
+        " WHERE id = ? AND user_id = ?"
+    )
+    SET_OUTCOME = (
+        "UPDATE raw_predictions SET actual_outcome = ?"
+        " WHERE id = ? AND user_id = ?"
+    )
+    DELETE_PREDICTION = (
+        "DELETE FROM raw_predictions WHERE id = ? AND user_id = ?"
+    )
+    OWNED_IDS = (
+        "SELECT id FROM raw_predictions WHERE user_id = ? AND id IN ({ids})"
+    )
+    DUE_PREDICTIONS = (
+        "SELECT id, user_id, task_description, resolve_by"
+        " FROM raw_predictions"
+        " WHERE actual_outcome IS NULL AND reminded_at IS NULL"
+        " AND resolve_by <= ? AND user_id % ? = ?"
+        " AND (resolve_by, id) > (?, ?)"
+        " ORDER BY resolve_by, id LIMIT ?"
+    )
+    PENDING_REMINDERS = (
+        "SELECT id FROM raw_predictions WHERE id IN ({ids})"
+        " AND actual_outcome IS NULL AND reminded_at IS NULL"
+    )
+    MARK_REMINDED = (
+        "UPDATE raw_predictions SET reminded_at = CURRENT_TIMESTAMP"
+        " WHERE id IN ({ids})"
+    )
+    SELECT_CHECKPOINT = "SELECT seq FROM journal_checkpoint WHERE name = ?"
+    SAVE_CHECKPOINT = (
+        "INSERT INTO journal_checkpoint (name, seq) VALUES (?, ?)"
+        " ON CONFLICT (name) DO UPDATE SET seq = excluded.seq"
+    )
+    EXPECTED_STATS = (
+        "SELECT user_id, task_category, COUNT(*),"
+        f" SUM({_hit('raw_predictions', 50)}),"
+        f" SUM({_hit('raw_predictions', 90)})"
+        " FROM raw_predictions WHERE actual_outcome IS NOT NULL"
+        " GROUP BY user_id, task_category"
+    )
+    STORED_STATS = (
+        "SELECT user_id, task_category, resolved, hits_50, hits_90"
+        " FROM calibration_stats"
+    )
+    REPLACE_STATS = (
+        "INSERT INTO calibration_stats"
+        " (user_id, task_category, resolved, hits_50, hits_90)"
+        " VALUES (?, ?, ?, ?, ?)"
+        " ON CONFLICT (user_id, task_category) DO UPDATE SET"
+        " resolved = excluded.resolved, hits_50 = excluded.hits_50,"
+        " hits_90 = excluded.hits_90"
+    )
+    SAVE_MIGRATION = (
+        "INSERT INTO schema_migrations (version, description) VALUES (?, ?)"
+    )
+
+    PLACEHOLDER = "?"
+
+    EXPLAIN = "EXPLAIN QUERY PLAN "
+    # SEARCH lines use an index range, SCAN lines read everything
+    FULL_SCAN = r"^SCAN (TABLE )?(raw_predictions|calibration_stats)\b"
+    ANALYZE = "ANALYZE"
+
+    transient_errors = (sqlite3.OperationalError,)
+
+    def __init__(
+        self,
+        path: str,
+        maxsize: int = 4,
+        acquire_timeout: float = 10.0,
+        category_cache: Optional[CategoryCache] = None,
+    ):
+        super().__init__(category_cache)
+        self.path = path
+        self.pool = Pool(
+            lambda: connect(path),
+            minsize=1,
+            maxsize=maxsize,
+            acquire_timeout=acquire_timeout,
+            begin="BEGIN IMMEDIATE",
+        )
+
+    async def open(self):
+        """Open the connection pool."""
+        await self.pool.open()
+
+    async def close(self):
+        """Close the connection pool."""
+        await self.pool.close()
+
+    async def migrate(self) -> list[int]:
+        """Create the schema if it isn't there yet."""
+        return await self._apply_schema(SCHEMA)
+
+    def is_transient(self, error: BaseException) -> bool:
+        """Tell whether retrying after an error may succeed.
+
+        Only a lock held by another connection goes away; other
+        operational errors, e.g. a missing table, are there to stay.
+        """
+        message = str(error)
+        return super().is_transient(error) and (
+            "locked" in message or "busy" in message)
+
+    def acquire(self):
+        """Borrow a pooled connection."""
+        return self.pool.acquire()
+
+    def transaction(self):
+        """Borrow a pooled connection within a transaction."""
+        return self.pool.transaction()
@@ -0,0 +1,262 @@
+"""Cases every Storage backend has to pass.
+
+SQLite runs in a temporary file. MySQL and PostgreSQL run against the
+databases in TEST_MYSQL_URL and TEST_POSTGRES_URL, given as
+``user:password@host[:port]/database``, and are skipped without them; the
+cases use fresh random user ids, so a shared scratch database will do.
+"""
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import random
+from datetime import date
+from urllib.parse import unquote, urlsplit
+
+import pytest
+
+from export import FIELDS, export_predictions
+from importer import import_file
+from storage import BACKENDS, create_storage
+
+# Far in the past, so rows of other runs in a shared database are due too
+# and are told apart by their owners
+RESOLVE_BY = date(2000, 1, 10)
+
+
+def _options(backend: str, url: str) -> dict:
+    parts = urlsplit(f"//{url}")
+    options = dict(
+        host=parts.hostname,
+        user=unquote(parts.username or ""),
+        password=unquote(parts.password or ""),
+        database=parts.path.lstrip("/"),
+        minsize=1,
+        maxsize=4,
+    )
+    if backend == "postgres" and parts.port:
+        options["port"] = parts.port
+    return options
+
+
+@pytest.fixture(params=BACKENDS)
+def storage(request, tmp_path):
+    backend = request.param
+    if backend == "sqlite":
+        return create_storage(backend, path=str(tmp_path / "predictions.db"))
+    url = os.getenv(f"TEST_{backend.upper()}_URL")
+    if not url:
+        pytest.skip(f"TEST_{backend.upper()}_URL is not set")
+    return create_storage(backend, **_options(backend, url))
+
+
+@pytest.fixture
+def users():
+    # Two users no other case or run has
+    first = random.randrange(10 ** 9, 10 ** 12) * 2
+    return first, first + 1
+
+
+def run(storage, scenario, migrate=True):
+    """Run a coroutine function with the opened storage."""
+    async def main():
+        await storage.open()
+        try:
+            if migrate:
+                await storage.migrate()
+            await scenario(storage)
+        finally:
+            await storage.close()
+    asyncio.run(main())
+
+
+def prediction(category="work", resolve_by=None, outcome=None):
+    """add's arguments after user_id."""
+    return (
+        date(2024, 1, 1), "Задача", category, "час",
+        1, 3, 0, 4, outcome, resolve_by,
+    )
+
+
+def test_migrate_is_idempotent(storage, users):
+    async def scenario(storage):
+        await storage.migrate()
+        assert await storage.migrate() == []
+        assert await storage.ping()
+        assert not await storage.has_predictions(users[0])
+
+    run(storage, scenario, migrate=False)
+
+
+def test_mutations_are_scoped_to_owner(storage, users):
+    owner, stranger = users
+
+    async def scenario(storage):
+        pred_id = await storage.add(owner, *prediction())
+        assert await storage.has_predictions(owner)
+        assert not await storage.has_predictions(stranger)
+
+        assert not await storage.update_bounds(stranger, pred_id, 0, 5, 0, 9)
+        assert not await storage.set_outcome(stranger, pred_id, 2)
+        assert not await storage.delete(stranger, pred_id)
+
+        assert await storage.update_bounds(owner, pred_id, 1, 3, 0, 5)
+        assert await storage.set_outcome(owner, pred_id, 2)
+        assert await storage.calibration(owner) == (1, 1, 1)
+        assert await storage.calibration(owner, "work") == (1, 1, 1)
+        assert await storage.calibration(stranger) == (0, 0, 0)
+
+        assert await storage.delete(owner, pred_id)
+        assert not await storage.has_predictions(owner)
+        assert await storage.calibration(owner) == (0, 0, 0)
+
+    run(storage, scenario)
+
+
+def test_bulk_operations(storage, users):
+    owner, stranger = users
+
+    async def scenario(storage):
+        assert await storage.add_many(owner, [
+            prediction("work"), prediction("home"), prediction("work")
+        ]) == 3
+        assert await storage.categories(owner) == {"work", "home"}
+        rows, _, _ = await storage.page(owner, "whole", 10)
+        ids = [row[0] for row in rows]
+        foreign = await storage.add(stranger, *prediction())
+
+        assert await storage.set_outcomes(
+            owner, [(ids[0], 2), (ids[1], 10), (foreign, 2)]
+        ) == {ids[0], ids[1]}
+        assert await storage.calibration(owner) == (2, 1, 1)
+        assert await storage.calibration(stranger) == (0, 0, 0)
+
+        assert await storage.update_many(
+            owner, [(ids[1], 5, 15, 0, 20), (foreign, 5, 15, 0, 20)]
+        ) == {ids[1]}
+        assert await storage.calibration(owner) == (2, 2, 2)
+
+        assert await storage.delete_many(owner, [ids[1], foreign]) == {ids[1]}
+        assert await storage.categories(owner) == {"work"}
+        assert await storage.has_predictions(stranger)
+        async with storage.acquire() as conn:
+            assert await storage.owned_ids(
+                conn, owner, [*ids, foreign]) == {ids[0], ids[2]}
+
+    run(storage, scenario)
+
+
+def test_keyset_paging(storage, users):
+    owner, _ = users
+
+    async def scenario(storage):
+        await storage.add_many(owner, [
+            prediction(outcome=2 if i % 2 else None) for i in range(7)])
+        ids = [
+            row[0] for rows in [
+                rows async for rows in storage.iter_predictions(owner, 3)]
+            for row in rows
+        ]
+        assert len(ids) == 7 and ids == sorted(ids)
+
+        first, has_prev, has_next = await storage.page(owner, "whole", 3)
+        assert [r[0] for r in first] == ids[:3]
+        assert (has_prev, has_next) == (False, True)
+        last, has_prev, has_next = await storage.page(
+            owner, "whole", 3, "next", ids[5])
+        assert [r[0] for r in last] == ids[6:]
+        assert (has_prev, has_next) == (True, False)
+        back, has_prev, _ = await storage.page(
+            owner, "whole", 3, "prev", ids[6])
+        assert [r[0] for r in back] == ids[3:6]
+        assert has_prev
+
+        empty, _, has_next = await storage.page(owner, "empty", 10)
+        assert [r[0] for r in empty] == ids[::2]
+        assert not has_next
+
+    run(storage, scenario)
+
+
+def _records(data: bytes, fmt: str) -> list[dict]:
+    text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", newline="")
+    if fmt == "csv":
+        return list(csv.DictReader(text))
+    return [json.loads(line) for line in text]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+@pytest.mark.parametrize("compress", [False, True])
+def test_export_import_round_trip(storage, users, fmt, compress):
+    owner, other = users
+    name = f"predictions.{fmt}" + (".gz" if compress else "")
+
+    async def export(user_id):
+        file, count = await export_predictions(storage, user_id, fmt, compress)
+        with file:
+            data = file.read()
+        return (gzip.decompress(data) if compress else data), count
+
+    async def scenario(storage):
+        await storage.add_many(owner, [
+            prediction("work", RESOLVE_BY),
+            prediction("home", outcome=2.5),
+        ])
+        data, count = await export(owner)
+        assert count == 2
+        exported = _records(data, fmt)
+        assert [list(r) for r in exported] == [list(FIELDS)] * 2
+        assert exported[0]["resolve_by"] == RESOLVE_BY.isoformat()
+
+        file = io.BytesIO(gzip.compress(data) if compress else data)
+        report = await import_file(storage, other, file, name)
+        assert [error for _, error in report] == [None, None]
+
+        imported = _records((await export(other))[0], fmt)
+
+        def comparable(record):
+            # Ids are new, numbers may come back as text or as floats
+            return {
+                field: None if value in (None, "") else str(value)
+                .removesuffix(".0")
+                for field, value in record.items() if field != "id"
+            }
+        assert list(map(comparable, imported)) == list(
+            map(comparable, exported))
+
+    run(storage, scenario)
+
+
+def test_claim_reminders(storage, users):
+    owner, other = users
+
+    async def scenario(storage):
+        due = await storage.add(owner, *prediction(resolve_by=RESOLVE_BY))
+        later = await storage.add(
+            owner, *prediction(resolve_by=date(2000, 2, 1)))
+        resolved = await storage.add(
+            owner, *prediction(resolve_by=RESOLVE_BY, outcome=2))
+        await storage.add(owner, *prediction())
+        others = await storage.add(other, *prediction(resolve_by=RESOLVE_BY))
+
+        async def due_ids(workers=1, worker=0):
+            rows = await storage.due_predictions(
+                RESOLVE_BY, workers, worker, limit=100000)
+            return [r[0] for r in rows if r[1] in users]
+
+        assert await due_ids() == [due, others]
+        # Users are sharded by the remainder of their ids, owner's is even
+        assert await due_ids(2, 0) == [due]
+        assert await due_ids(2, 1) == [others]
+        rows = await storage.due_predictions(RESOLVE_BY, limit=100000)
+        assert (due, owner, "Задача", RESOLVE_BY) in rows
+
+        assert await storage.claim_reminders(
+            [due, later, resolved]) == {due, later}
+        assert await storage.claim_reminders([due, later]) == set()
+        assert await due_ids() == [others]
+        assert await storage.claim_reminders([]) == set()
+
+    run(storage, scenario)
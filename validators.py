@@ -1,6 +1,10 @@
 """Validating functions."""
 
 import re
+from datetime import date, datetime
+
+# Format of dates users enter
+DATE_FORMAT: str = "%d.%m.%Y"
 
 
 def validate_creating(ans):
@@ -40,14 +44,6 @@ def validate_updating(ans):
     )
 
 
-def validate_checking(string: str):
-    commands = ["/start", "Показать предсказания", "Мои категории", "Как пользоваться"]
-    for comm in commands:
-        if re.match(comm, string):
-            return False
-    return True
-
-
 def validate_calibration(ans):
     """This function here entirely for the backward compatibility."""
     return True
@@ -75,3 +71,97 @@ def validate_outcome(ans: str):
         bool: whether given string mathes the pattern or not
     """
     return re.fullmatch(r"^\d+;\s[+-]?(\d*\.)?\d+$", ans)
+
+
+def validate_description(ans: str):
+    """Validate a prediction's text, the rule of validate_creating.
+
+    Args:
+        ans (str): prediction's text
+
+    Returns:
+        bool: whether given text mathes the pattern or not
+    """
+    return re.fullmatch(r"[a-яА-ЯЁё\w.?,!'\s]{1,200}", ans)
+
+
+def validate_category(ans: str):
+    """Validate a category name, the rule of validate_creating.
+
+    Args:
+        ans (str): category's name
+
+    Returns:
+        bool: whether given name mathes the pattern or not
+    """
+    return re.fullmatch(r"[a-яА-ЯЁё\w]{1,50}", ans)
+
+
+def validate_unit(ans: str):
+    """Validate a unit of measure, the rule of validate_creating.
+
+    Args:
+        ans (str): unit's name
+
+    Returns:
+        bool: whether given name mathes the pattern or not
+    """
+    return re.fullmatch(r"[a-яА-ЯЁё\w]{1,30}", ans)
+
+
+def validate_number(ans: str):
+    """Validate a bound or an outcome.
+
+    Args:
+        ans (str): user's number
+
+    Returns:
+        bool: whether given string mathes the pattern or not
+    """
+    return re.fullmatch(r"[+-]?(\d*\.)?\d+", ans)
+
+
+def validate_resolution_date(
+    ans: str, fmt: str = DATE_FORMAT, future: bool = True
+):
+    """Validate a resolution date, "-" meaning there is none.
+
+    Args:
+        ans (str): user's date as ДД.ММ.ГГГГ or "-"
+        fmt (str): format of the date
+        future (bool): whether the date may not be earlier than today,
+        otherwise its reminder would be sent straight away
+
+    Returns:
+        bool: whether given string is "-" or an existing date
+    """
+    if ans.strip() == "-":
+        return True
+    try:
+        resolve_by = datetime.strptime(ans.strip(), fmt).date()
+    except ValueError:
+        return False
+    return not future or resolve_by >= date.today()
+
+
+def validate_lines(ans: str, validator):
+    """Validate a message with one record per line.
+
+    Args:
+        ans (str): user's message
+        validator (Callable): validating function of a single record
+
+    Returns:
+        tuple: records of non-empty lines and numbers of the lines which
+        didn't pass the validator, counting from 1
+    """
+    records, invalid = [], []
+    for number, line in enumerate(ans.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if validator(line):
+            records.append(line)
+        else:
+            invalid.append(number)
+    return records, invalid
@@ -0,0 +1,172 @@
+"""Multi-process mode: a front process receives updates, workers handle them.
+
+Run ``python workers.py`` instead of the bot. The front process only
+receives updates from Telegram and hands each one to worker
+``user_id % WORKERS``, so a user is always served by the same worker.
+Workers are complete bots (see ru_calibration_bot.main) with their own
+Telegram sessions, database connections, caches and rate limits; they
+reply to their users themselves. Conversations are written through to a
+shared SQLite file, so a restarted worker picks its users up where they
+left off.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from typing import Optional
+
+from telethon import TelegramClient, events, utils
+from telethon.tl import types
+
+logger = logging.getLogger(__name__)
+
+# Updates the workers handle, the rest aren't used by the bot
+HANDLED_UPDATES: list = [types.UpdateNewMessage, types.UpdateBotCallbackQuery]
+# Seconds between checks that the workers are alive
+WATCH_INTERVAL: float = 1.0
+# Seconds a worker waits for an update before checking on the front process
+POLL_INTERVAL: float = 1.0
+
+
+def update_user(update) -> Optional[int]:
+    """Return the id of the user an update came from."""
+    if isinstance(update, types.UpdateBotCallbackQuery):
+        return update.user_id
+    message = update.message
+    peer = getattr(message, "from_id", None) or message.peer_id
+    return utils.get_peer_id(peer)
+
+
+def shard(user_id: int, count: int) -> int:
+    """Return the index of the worker serving a user."""
+    return user_id % count
+
+
+def run_worker(index: int, count: int, updates: multiprocessing.Queue):
+    """Run a worker, the target of a worker process."""
+    # The bot imports consume from here
+    from ru_calibration_bot import Config, main
+
+    main(Config.from_env(worker_index=index, workers=count), updates)
+
+
+async def consume(client: TelegramClient, updates: multiprocessing.Queue):
+    """Dispatch updates handed over by the front process until it stops.
+
+    Args:
+        client (TelegramClient): worker's client with the handlers
+        updates (multiprocessing.Queue): worker's updates, None stops it
+    """
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    handling: set[asyncio.Task] = set()
+
+    def next_update():
+        try:
+            return updates.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            return queue.Empty
+
+    while True:
+        update = await loop.run_in_executor(None, next_update)
+        if update is queue.Empty:
+            if parent is not None and not parent.is_alive():
+                logger.warning("Front process is gone, stopping")
+                break
+            continue
+        if update is None:
+            break
+        # Users the front process has seen, to be able to reply to them
+        client.session.process_entities(
+            list(getattr(update, "_entities", {}).values()))
+        # Telethon's own dispatching, the handlers see the usual events
+        task = loop.create_task(client._dispatch_update(update))
+        handling.add(task)
+        task.add_done_callback(handling.discard)
+    await asyncio.gather(*handling, return_exceptions=True)
+
+
+class Front:
+    """Front process's end of the workers.
+
+    Args:
+        count (int): number of worker processes
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue() for _ in range(count)]
+        self.processes: list = [None] * count
+        self.forwarded: list[int] = [0] * count
+
+    def start_worker(self, index: int):
+        """Start or restart a worker process."""
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.count, self.queues[index]),
+            name=f"worker{index}",
+        )
+        process.start()
+        self.processes[index] = process
+
+    async def forward(self, update):
+        """Hand an update over to the worker serving its user."""
+        user_id = update_user(update)
+        index = shard(user_id, self.count)
+        self.queues[index].put(update)
+        self.forwarded[index] += 1
+
+    async def watch(self):
+        """Restart workers which have exited."""
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning(
+                        f"Worker {index} exited with {process.exitcode},"
+                        " restarting")
+                    self.start_worker(index)
+
+    def stop(self, timeout: float = 30.0):
+        """Let the workers finish their updates and stop them."""
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} didn't stop, terminating")
+                process.terminate()
+
+
+def main():
+    from ru_calibration_bot import Config
+
+    config = Config.from_env()
+    # Unlike the bot's, the default is a worker per core
+    count = int(os.getenv("WORKERS", os.cpu_count() or 1))
+    client = TelegramClient(
+        config.session_name, config.api_id, config.api_hash
+    ).start(bot_token=config.telegram_token)
+    front = Front(count)
+    client.add_event_handler(front.forward, events.Raw(HANDLED_UPDATES))
+    for index in range(count):
+        front.start_worker(index)
+    watcher = client.loop.create_task(front.watch())
+    logger.info(f"Front started with {count} workers")
+    try:
+        client.run_until_disconnected()
+    finally:
+        watcher.cancel()
+        front.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()